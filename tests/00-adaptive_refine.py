@@ -0,0 +1,38 @@
+# get_cell_properties_adaptive() splits the energy intervals where the stability changes or the results are far from linear.
+
+def make_data(kes):
+	data = gcp.GCPData(len(kes), info=dict(periodic=True, particle="p"))
+	data['KE'] = kes
+	data['found_co'] = True
+	data['stable'] = True
+	data['Y'] = numpy.asarray(kes) * 1e-6
+	data['T'] = 0
+	data['NU_Y'] = 0.2
+	data['NU_Z'] = 0.3
+	return data
+
+tol = dict(Y=0.01, T=0.1, NU_Y=0.001, NU_Z=0.001)
+
+# linear results need no more energies
+data = make_data(numpy.linspace(10e6, 20e6, 6))
+assert not gcp._adaptive_split(data, tol, 0).any()
+
+# a jump in the tune at 13e6 splits the intervals around the points next to it
+data['NU_Y'][data['KE'] > 13e6] = 0.25
+split = gcp._adaptive_split(data, tol, 0)
+assert list(split) == [True, True, True, False, False]
+
+# a change in stability splits that interval, ignoring the values of the unstable energies
+data = make_data(numpy.linspace(10e6, 20e6, 6))
+data['stable'][4:] = False
+data['NU_Y'][4:] = numpy.nan
+assert list(gcp._adaptive_split(data, tol, 0)) == [False, False, False, True, False]
+
+# but not once the interval is too small
+assert not gcp._adaptive_split(data, tol, 2e6).any()
+
+# the closed orbit is checked wherever it was found
+data = make_data([10e6, 11e6, 11.5e6, 12e6])
+data['stable'] = False
+data['Y'][2] += 0.1
+assert list(gcp._adaptive_split(data, tol, 0)) == [True, True, True]
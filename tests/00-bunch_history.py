@@ -0,0 +1,77 @@
+import tempfile
+
+nturns = 5
+my_bunch = Bunch.gen_halo_x_xp_y_yp(20, 1e-3, 1e-3, 4, 5, 1e-3, 2e-2, ke=50e6, mass=PROTON_MASS, charge=1)
+
+history = BunchHistory(nturns, len(my_bunch), mass=PROTON_MASS, charge=1)
+for turn in range(nturns):
+	history.record(turn, my_bunch)
+	my_bunch.particles()['Y'] += 1
+
+assert(len(history) == nturns)
+assert(history.nparticles() == 20)
+assert(numpy.all(history.lost_turn() == -1))
+
+# per particle time series
+ys = history.get_particle(3)['Y']
+assert(numpy.allclose(ys[1:] - ys[:-1], 1))
+assert(history.coord('Y').shape == (nturns, 20))
+
+# a turn is a view, not a copy
+turn_2 = history.get_turn(2, drop_lost=False)
+turn_2.particles()['T'][0] = 42
+assert(history.coord('T')[2, 0] == 42)
+
+# lose some particles on turn 3
+survivors = numpy.arange(0, 20, 2)
+part_bunch = Bunch(rigidity=my_bunch.get_bunch_rigidity(), mass=PROTON_MASS, charge=1, particles=my_bunch.particles()[survivors])
+history.record(3, part_bunch, ids=survivors)
+history.record(4, part_bunch, ids=survivors)
+assert(len(history.get_turn(3)) == 10)
+lost = history.lost_turn()
+assert(numpy.all(lost[survivors] == -1))
+assert(numpy.all(lost[1::2] == 3))
+
+# memory mapped version
+tmpdir = tempfile.mkdtemp()
+fname = os.path.join(tmpdir, "history.npy")
+mm_history = BunchHistory(nturns, 20, mass=PROTON_MASS, charge=1, fname=fname)
+for turn in range(nturns):
+	mm_history.record(turn, my_bunch)
+mm_history.flush()
+del mm_history
+re_history = BunchHistory.load(fname, mass=PROTON_MASS, charge=1)
+assert(numpy.all(re_history.coord('Y') == my_bunch.particles()['Y']))
+assert(numpy.all(re_history.alive()))
+import shutil
+shutil.rmtree(tmpdir)
+
+# particle IDs are used to place a partial bunch
+id_bunch = Bunch.gen_halo_x_xp_y_yp(20, 1e-3, 1e-3, 4, 5, 1e-3, 2e-2, ke=50e6, mass=PROTON_MASS, charge=1)
+id_bunch.set_ids()
+split = list(id_bunch.split_bunch(max_particles=100, n_slices=2))
+assert(numpy.all(split[1].get_ids() == numpy.arange(10, 20)))
+id_history = BunchHistory(1, len(id_bunch))
+id_history.record(0, split[1])
+assert(numpy.all(id_history.alive()[0] == (numpy.arange(20) >= 10)))
+assert(numpy.all(id_history.get_turn(0).get_ids() == numpy.arange(10, 20)))
+
+# IDs given as a list are stored as an array, so they can be masked
+id_bunch.set_ids(list(range(100, 120)))
+assert(id_bunch.get_ids().dtype == numpy.int32)
+assert(numpy.all(id_bunch.get_ids()[id_bunch.coords['Y'] > 0] == numpy.arange(100, 120)[id_bunch.coords['Y'] > 0]))
+
+# a bunch with other IDs is matched to the history's IDs
+id_history = BunchHistory(1, len(id_bunch), ids=numpy.arange(100, 120))
+split = list(id_bunch.split_bunch(max_particles=100, n_slices=2))
+id_history.record(0, split[1])
+assert(numpy.all(id_history.alive()[0] == (numpy.arange(20) >= 10)))
+assert(numpy.all(id_history.get_turn(0).get_ids() == numpy.arange(110, 120)))
+assert(numpy.all(id_history.get_turn(0).particles()['Y'] == id_bunch.particles()['Y'][10:]))
+# but not to the default IDs, the particle index
+try:
+	BunchHistory(1, len(id_bunch)).record(0, id_bunch)
+except ValueError:
+	pass
+else:
+	raise AssertionError("recording IDs that are not in the history should raise ValueError")
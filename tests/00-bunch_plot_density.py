@@ -0,0 +1,25 @@
+import tempfile
+import os
+import shutil
+import matplotlib
+matplotlib.use("Agg")
+
+my_bunch = Bunch.gen_gauss_x_xp_y_yp(20000, 1e-6, 1e-6, 4, 5, 0.5, -0.3, ke=50e6, mass=PROTON_MASS, charge=1, seed=1)
+other_bunch = Bunch.gen_gauss_x_xp_y_yp(2000, 2e-6, 1e-6, 4, 5, 0, 0, ke=50e6, mass=PROTON_MASS, charge=1, seed=2)
+
+# rms ellipse in Y-T should match the bunch twiss parameters
+emit = my_bunch.get_emittance_rms()
+beta_y, alpha_y, beta_z, alpha_z = my_bunch.get_twiss_rms(emit)
+ex, ey = my_bunch._rms_ellipse('Y', 'T', npoints=1000)
+assert(abs((ex.max() - my_bunch.particles()['Y'].mean()) / sqrt(emit[0] * beta_y) - 1) < 1e-3)
+
+tmpdir = tempfile.mkdtemp()
+try:
+	fname = os.path.join(tmpdir, "density.png")
+	my_bunch.plot(fname, density=True, bins=50, add_bunch=other_bunch, rms_ellipse=True)
+	assert(os.path.getsize(fname) > 0)
+	fname = os.path.join(tmpdir, "points.png")
+	my_bunch.plot(fname, add_bunch=other_bunch, rms_ellipse=True)
+	assert(os.path.getsize(fname) > 0)
+finally:
+	shutil.rmtree(tmpdir)
@@ -0,0 +1,28 @@
+my_bunch = Bunch.gen_halo_x_xp_y_yp(1001, 1e-3, 1e-3, 4, 5, 1e-3, 2e-2, ke=50e6, mass=PROTON_MASS, charge=1)
+orig_coords = my_bunch.particles().copy()
+
+# descriptors cover the bunch in the same way as split_bunch()
+slices = list(my_bunch.shared_slices(max_particles=100, n_slices=4))
+split_lens = [len(b) for b in my_bunch.split_bunch(max_particles=100, n_slices=4)]
+assert([l for o, l in slices] == split_lens)
+assert(slices[0][0] == 0)
+assert(sum(l for o, l in slices) == len(my_bunch))
+
+name = my_bunch.to_shared_memory()
+assert(numpy.all(my_bunch.particles() == orig_coords))
+
+# attach to each slice, as a worker would, and write in place
+for offset, length in slices:
+	worker_bunch = Bunch.attach_shared_memory(name, len(my_bunch), offset, length, rigidity=my_bunch.get_bunch_rigidity(), mass=PROTON_MASS, charge=1)
+	assert(len(worker_bunch) == length)
+	assert(numpy.all(worker_bunch.particles() == orig_coords[offset:offset+length]))
+	worker_bunch.particles()['X'] = offset
+	worker_bunch.close_shared_memory(keep_data=False)
+
+for offset, length in slices:
+	assert(numpy.all(my_bunch.particles()['X'][offset:offset+length] == offset))
+
+my_bunch.close_shared_memory(unlink=True)
+# data is kept after the block is freed
+assert(numpy.all(my_bunch.particles()['Y'] == orig_coords['Y']))
+assert(my_bunch.particles()['X'][-1] == slices[-1][0])
@@ -0,0 +1,106 @@
+# content_hash() of elements and Lines depends only on their contents, and follows changes to them.
+import tempfile
+
+def make_cell(name):
+	cell = Line(name)
+	cell.add(DRIFT("d1", XL=50))
+	cell.add(QUADRUPO("q1", XL=10, B_0=1, XPAS=(10, 20, 10)))
+	cell.add(DRIFT("d1", XL=50))
+	return cell
+
+q_a = QUADRUPO("q1", XL=10, B_0=1, XPAS=(10, 20, 10))
+q_b = QUADRUPO("q1", XL=10, B_0=1, XPAS=(10, 20, 10))
+h = q_a.content_hash()
+assert h == q_b.content_hash()
+assert h == copy.deepcopy(q_a).content_hash()
+assert h != MULTIPOL("q1", XL=10, XPAS=(10, 20, 10)).content_hash()
+
+# cached, and dropped on every kind of change
+assert q_a.__dict__["_content_hash"] == h
+q_a.set(B_0=2)
+assert q_a.content_hash() != h
+q_a.B_0 = 1
+assert q_a.content_hash() == h
+q_a.label1 = "q2"
+assert q_a.content_hash() != h
+q_a.label1 = "q1"
+q_a.XPAS = (10, 20, 11)
+assert q_a.content_hash() != h
+q_a.XPAS = (10, 20, 10)
+assert q_a.content_hash() == h
+
+c_a = CHANGREF(YCE=1)
+h = c_a.content_hash()
+c_a.reverse()
+assert c_a.content_hash() != h
+
+f_a = FFAG("f", AT=10)
+h = f_a.content_hash()
+f_a.add(ACN=5)
+assert f_a.content_hash() != h
+
+ob = OBJET2(BORO=1000)
+h = ob.content_hash()
+ob.add(Y=1)
+h1 = ob.content_hash()
+assert h1 != h
+ob.add(Y=2)
+assert ob.content_hash() not in [h, h1]
+ob.clear()
+assert ob.content_hash() == h
+
+# parameters set as attributes change the output, so also the hash
+ob.BORO = 2000
+assert ob.get('BORO') == 2000
+assert ob.content_hash() != h
+ob.set(BORO=1000)
+assert ob.content_hash() == h
+line_a = Line("line")
+line_a.add(ob, END())
+ob.add(Y=1)
+h = line_a.content_hash()
+out = line_a.output()
+assert line_a.content_hash() == h # rendering does not change it
+ob.BORO = 2000
+assert line_a.output() != out
+assert line_a.content_hash() != h
+ob.particles = ob.particles[:0]
+ob.add(Y=2)
+assert list(ob.particles['Y']) == [2]
+
+fake = FAKE_ELEM("'DRIFT'\n10\n")
+assert fake.content_hash() != FAKE_ELEM("'DRIFT'\n11\n").content_hash()
+
+# lines
+line_a = Line("line")
+line_a.add(OBJET2(BORO=1000), make_cell("cell"), make_cell("cell"), END())
+line_b = Line("line")
+line_b.add(OBJET2(BORO=1000), make_cell("other_name"), make_cell("cell"), END())
+h = line_a.content_hash()
+assert h == line_b.content_hash() # sub line names are not output
+assert h == copy.deepcopy(line_a).content_hash()
+line_c = Line("line")
+line_c.add(OBJET2(BORO=1000), END())
+# the same elements, but flat, so the zgoubi.dat has no blank lines between cells
+line_c.insert(1, *reversed(list(line_a.element_list[1].elements()) + list(line_a.element_list[2].elements())))
+assert line_c.content_hash() != h
+
+# changing an element in a sub line changes the line
+list(line_a.elements())[2].set(B_0=3)
+assert line_a.content_hash() != h
+list(line_a.elements())[2].set(B_0=1)
+assert line_a.content_hash() == h
+line_a.remove(1)
+assert line_a.content_hash() != h
+
+# input file contents are part of the hash
+tmpdir = tempfile.mkdtemp()
+map_file = os.path.join(tmpdir, "field.map")
+open(map_file, "w").write("1 2 3\n")
+line_b.add_input_files([map_file])
+h = line_b.content_hash()
+open(map_file, "w").write("1 2 3 4\n")
+assert line_b.content_hash() != h
+open(map_file, "w").write("1 2 3\n")
+assert line_b.content_hash() == h
+shutil.rmtree(tmpdir)
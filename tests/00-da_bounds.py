@@ -0,0 +1,57 @@
+# get_dynamic_aperture(batch_trials=N) narrows the bounds on the DA from each batch of trial emittances with _da_update_bounds().
+
+def survival(stable, n_parts=16, lost=16):
+	"Survival of the particles of each trial, with lost particles lost from each unstable trial"
+	survived = numpy.ones([len(stable), n_parts], bool)
+	for tn, stab in enumerate(stable):
+		if not stab:
+			survived[tn, :lost] = False
+	return survived
+
+trials = numpy.array([1., 2., 3., 4.])
+tol = 0.01
+min_val = 1e-10
+
+# the DA is bracketed by the highest stable and lowest unstable trials
+stabs, bounds, da = gcp._da_update_bounds(trials, survival([True, True, False, False]), None, (None, None), tol, min_val)
+assert list(stabs) == [True, True, False, False]
+assert bounds == (2, 3) and da is None
+# and found once they are within tol
+stabs, bounds, da = gcp._da_update_bounds(numpy.array([2.99, 2.995]), survival([True, False]), None, (2, 3), tol, min_val)
+assert bounds == (2.99, 2.995) and da == 2.99
+
+# a stable trial above an unstable one is not used for the lower bound
+stabs, bounds, da = gcp._da_update_bounds(trials, survival([True, False, True, False]), None, (None, None), tol, min_val)
+assert bounds == (1, 2)
+
+# unbounded up, all stable, only the lower bound moves
+stabs, bounds, da = gcp._da_update_bounds(trials, survival([True] * 4), None, (None, None), tol, min_val)
+assert bounds == (4, None) and da is None
+stabs, bounds, da = gcp._da_update_bounds(trials, survival([True] * 4), None, (0.5, 10), tol, min_val)
+assert bounds == (4, 10) and da is None
+
+# unbounded down, all unstable, only the upper bound moves
+stabs, bounds, da = gcp._da_update_bounds(trials, survival([False] * 4), None, (None, None), tol, min_val)
+assert bounds == (None, 1) and da is None
+# until it is below min_val, when there is no DA
+stabs, bounds, da = gcp._da_update_bounds(trials * 1e-11, survival([False] * 4), None, (None, 1e-10), tol, min_val)
+assert bounds == (None, 1e-11) and da == 0
+
+# a trial losing a few particles is stable if its island check particles all survive
+survived = survival([True, True, False, False], lost=2)
+island_survived = survival([True, True, True, False], lost=2)
+stabs, bounds, da = gcp._da_update_bounds(trials, survived, island_survived, (None, None), tol, min_val)
+assert list(stabs) == [True, True, True, False]
+assert bounds == (3, 4)
+# but not without island checks
+stabs, bounds, da = gcp._da_update_bounds(trials, survived, None, (None, None), tol, min_val)
+assert bounds == (2, 3)
+# or when half or more of its 16 particles are lost
+survived = survival([True, True, False, False], lost=8)
+stabs, bounds, da = gcp._da_update_bounds(trials, survived, island_survived, (None, None), tol, min_val)
+assert list(stabs) == [True, True, False, False]
+# the quick modes have 1 particle per trial, so are always checked
+survived = survival([True, True, False, False], n_parts=1, lost=1)
+island_survived = survival([True, True, True, False], n_parts=1, lost=1)
+stabs, bounds, da = gcp._da_update_bounds(trials, survived, island_survived, (None, None), tol, min_val)
+assert list(stabs) == [True, True, True, False]
@@ -0,0 +1,17 @@
+import zgoubi.elements
+import zgoubi_metadata.elements
+
+# the cache is up to date, and matches processing the definitions from scratch
+cache_path = zgoubi.elements._definitions_cache_path(zgoubi.elements._definitions_key())
+assert(os.path.exists(cache_path))
+fresh_defs = zgoubi.elements.process_definitions(zgoubi_metadata.elements.get_parsed())
+assert(zgoubi.elements.load_definitions() == fresh_defs)
+assert(zgoubi.elements.load_definitions(use_cache=False) == fresh_defs)
+
+# classes are made from the definitions, and star imports bind them
+for name in fresh_defs:
+	assert(name in zgoubi.elements.__all__)
+	assert(getattr(zgoubi.elements, name) is getattr(zgoubi.core, name))
+assert(zgoubi.elements.QUADRUPO is QUADRUPO)
+assert(QUADRUPO(XL=2).XL == 2)
+assert(not hasattr(zgoubi.elements, "NOT_AN_ELEMENT"))
@@ -0,0 +1,80 @@
+# profile1d(), profile2d() and plot_element_fields() share the field samples of each magnet, through an LRU cache keyed on the magnet contents and input files.
+import tempfile
+
+n_runs = [0]
+def fake_get_tracks_multi(tline, starts_YTZP, particle, ke, full_tracking=False, n_runs=n_runs, **kwargs):
+	"A field rising linearly across and along the magnet, instead of running zgoubi"
+	n_runs[0] += 1
+	ptracks = []
+	for y in starts_YTZP[:, 0]:
+		pt = numpy.zeros(11, [(c, 'f8') for c in ['Y', 'Z', 'X', 'BY', 'BZ', 'BX']])
+		pt['Y'] = y
+		pt['X'] = numpy.linspace(0, 1, 11)
+		pt['BZ'] = y + pt['X']
+		ptracks.append(pt)
+	return dict(ptrack=ptracks)
+
+real_get_tracks_multi = gcp.get_tracks_multi
+real_cache_size = gcp._field_sample_cache_size
+gcp.get_tracks_multi = fake_get_tracks_multi
+gcp._field_sample_cache.clear()
+try:
+	magnet = QUADRUPO("q", XL=10, B_0=1)
+	field, ys = gcp.profile1d(magnet, -5, 5, 11)
+	assert n_runs[0] == 1
+	assert numpy.allclose(field, ys + 0.5)
+	# the 2d profile and repeats use the same samples, and the same interpolator
+	int_field, extents = gcp.profile2d(magnet, -5, 5, 11)
+	gcp.profile1d(magnet, -5, 5, 11)
+	assert n_runs[0] == 1
+	samples = gcp._sample_field(magnet, -5, 5, 11, 0)
+	assert samples.interpolator() is samples.interpolator()
+	assert n_runs[0] == 1
+
+	# an equal magnet has the same content_hash(), so uses the samples too
+	gcp.profile1d(QUADRUPO("q", XL=10, B_0=1), -5, 5, 11)
+	assert n_runs[0] == 1
+	# but not a changed one, or another grid of rays
+	magnet.B_0 = 2
+	gcp.profile1d(magnet, -5, 5, 11)
+	assert n_runs[0] == 2
+	gcp.profile1d(magnet, -5, 5, 21)
+	assert n_runs[0] == 3
+
+	# the least recently used samples are dropped
+	gcp._field_sample_cache.clear()
+	gcp._field_sample_cache_size = 2
+	a, b, c = [QUADRUPO("q", XL=10, B_0=x) for x in [1, 2, 3]]
+	n_runs[0] = 0
+	gcp.profile1d(a, -5, 5, 11)
+	gcp.profile1d(b, -5, 5, 11)
+	gcp.profile1d(a, -5, 5, 11)
+	gcp.profile1d(c, -5, 5, 11)
+	assert n_runs[0] == 3
+	assert len(gcp._field_sample_cache) == 2
+	gcp.profile1d(a, -5, 5, 11)
+	assert n_runs[0] == 3
+	gcp.profile1d(b, -5, 5, 11)
+	assert n_runs[0] == 4
+
+	# an edited field map is sampled again
+	tmpdir = tempfile.mkdtemp()
+	map_fname = os.path.join(tmpdir, "field.map")
+	with open(map_fname, "w") as f:
+		f.write("1 2 3\n")
+	line = Line("map")
+	line.add(QUADRUPO("q", XL=10, B_0=1))
+	line.add_input_files(map_fname)
+	n_runs[0] = 0
+	gcp.profile1d(line, -5, 5, 11)
+	gcp.profile1d(line, -5, 5, 11)
+	assert n_runs[0] == 1
+	mtime = os.path.getmtime(map_fname) + 10
+	os.utime(map_fname, (mtime, mtime))
+	gcp.profile1d(line, -5, 5, 11)
+	assert n_runs[0] == 2
+	shutil.rmtree(tmpdir)
+finally:
+	gcp.get_tracks_multi = real_get_tracks_multi
+	gcp._field_sample_cache_size = real_cache_size
+	gcp._field_sample_cache.clear()
@@ -0,0 +1,75 @@
+# gcp scans save completed rows to a checkpoint, and an interrupted scan picks up where it stopped.
+import tempfile
+
+def new_data():
+	data = gcp.GCPData(5, info=dict(periodic=True, particle="p"))
+	data['KE'] = numpy.linspace(1e6, 5e6, 5)
+	data['found_co'] = False
+	return data
+
+tmpdir = tempfile.mkdtemp()
+path = os.path.join(tmpdir, "checkpoint")
+
+# a scan that stops after 3 rows
+data = new_data()
+checkpoint = gcp._Checkpoint(path, data)
+for n in range(3):
+	assert not checkpoint.done("co", n)
+	data['Y'][n] = n * 10
+	data['found_co'][n] = True
+	data.set_heavy(n, 'ptrack', numpy.arange(n + 1))
+	checkpoint.finish("co", n)
+checkpoint.finish("twiss", 0)
+# each finish() only writes the rows it completed, the main files are not rewritten
+assert sorted(f for f in os.listdir(path) if f.startswith("rows_")) == ["rows_%d.pickle" % n for n in range(1, 5)]
+assert not gcp.GCPData.load(path).info['checkpoint_done']
+
+# run again, the done rows are restored
+data = new_data()
+checkpoint = gcp._Checkpoint(path, data)
+assert sorted(checkpoint.stages["co"]) == [0, 1, 2]
+assert checkpoint.done("co", 2) and not checkpoint.done("co", 3)
+assert checkpoint.done("twiss", 0) and not checkpoint.done("twiss", 1)
+assert list(data['Y'][:3]) == [0, 10, 20]
+assert list(data['found_co']) == [True, True, True, False, False]
+assert list(data[2]['ptrack']) == [0, 1, 2]
+# the rows of the last run are merged into the main files
+assert not [f for f in os.listdir(path) if f.startswith("rows_")]
+assert gcp.GCPData.load(path).info['checkpoint_done']['co'] == set(range(3))
+checkpoint.finish("co", 3, 4)
+data = new_data()
+checkpoint = gcp._Checkpoint(path, data)
+assert gcp.GCPData.load(path).info['checkpoint_done']['co'] == set(range(5))
+assert list(data[2]['ptrack']) == [0, 1, 2]
+
+# a different scan can not use the checkpoint
+other = new_data()
+other['KE'][4] = 6e6
+try:
+	gcp._Checkpoint(path, other)
+except ValueError:
+	pass
+else:
+	raise AssertionError("checkpoint from a different scan should raise ValueError")
+
+# without a path, nothing is saved
+checkpoint = gcp._Checkpoint(None, new_data())
+checkpoint.finish("co", 0)
+assert not checkpoint.done("co", 0)
+shutil.rmtree(tmpdir)
+
+# info arrays with an entry per row, such as the Newton iterations, are kept for the rows done
+tmpdir = tempfile.mkdtemp()
+path = os.path.join(tmpdir, "checkpoint")
+data = new_data()
+data.info['co_iterations'] = numpy.zeros(5, int)
+checkpoint = gcp._Checkpoint(path, data)
+data.info['co_iterations'][1] = 7
+checkpoint.finish("co", 1)
+data.info['co_iterations'][2] = 3
+for x in range(2):
+	data = new_data()
+	data.info['co_iterations'] = numpy.zeros(5, int)
+	checkpoint = gcp._Checkpoint(path, data)
+	assert list(data.info['co_iterations']) == [0, 7, 0, 0, 0]
+shutil.rmtree(tmpdir)
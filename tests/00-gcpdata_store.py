@@ -0,0 +1,70 @@
+# GCPData.save() and GCPData.load(), with the track and profile columns kept on disk and read when used.
+import tempfile
+
+data = gcp.GCPData(3, info=dict(periodic=True, particle="p"))
+data['KE'] = [1e6, 2e6, 3e6]
+data['stable'] = [True, False, True]
+data['NU_Y'] = [0.1, 0.2, 0.3]
+data['matrix'] = numpy.arange(36).reshape(6, 6)
+track_dtype = [('Y', 'f8'), ('S', 'f8'), ('element_label1', 'S10')]
+for n in [0, 2]:
+	track = numpy.zeros(100, track_dtype)
+	track['Y'] = numpy.arange(100) * (n + 1)
+	track['element_label1'] = b"q%d" % n
+	data.set_heavy(n, 'ptrack', track)
+	data[n]['DA'] = numpy.array([n, n + 0.5])
+data.info['co_iterations'] = numpy.array([3, 0, 4])
+
+tmpdir = tempfile.mkdtemp()
+path = os.path.join(tmpdir, "scan")
+data.save(path)
+
+loaded = gcp.GCPData.load(path)
+assert loaded.info['periodic'] and loaded.info['particle'] == "p"
+assert list(loaded.info['co_iterations']) == [3, 0, 4]
+for key in ['KE', 'stable', 'NU_Y', 'matrix']:
+	assert numpy.all(loaded[key] == data[key]), key
+# small object columns are loaded with the rest
+assert list(loaded[2]['DA']) == [2, 2.5]
+assert loaded[1]['DA'] is None
+
+# heavy columns are handles, read when used
+assert loaded[1]['ptrack'] is None
+handle = loaded[2]['ptrack']
+assert isinstance(handle, gcp.GCPColumnValue)
+assert handle['Y'][10] == 30
+assert handle.dtype == numpy.dtype(track_dtype)
+assert len(handle) == 100
+assert numpy.all(numpy.asarray(handle) == data[2]['ptrack'])
+# copies can be written to, without changing the file
+copied = numpy.array(handle, copy=True)
+copied['Y'][10] = -1
+assert handle['Y'][10] == 30
+copied = handle.__array__(copy=True)
+copied['Y'][10] = -1
+assert handle['Y'][10] == 30
+try:
+	handle.__array__(dtype=[('Y', 'f4')], copy=False)
+except ValueError:
+	pass
+else:
+	raise AssertionError("converting without a copy should raise ValueError")
+assert handle.load()['element_label1'][0] == b"q2"
+assert max(pt['Y'].max() for pt in loaded[loaded['stable']]['ptrack']) == 297
+
+# new values go to the loaded store, and saving again keeps the existing files
+loaded.set_heavy(1, 'ftrack', numpy.ones(5))
+assert isinstance(loaded[1]['ftrack'], gcp.GCPColumnValue)
+assert os.path.dirname(loaded[1]['ftrack'].fname) == os.path.abspath(path)
+n_files = len(os.listdir(path))
+loaded.save(path)
+assert len(os.listdir(path)) == n_files
+reloaded = gcp.GCPData.load(path)
+assert reloaded[1]['ftrack'].sum() == 5
+assert reloaded[0]['ptrack']['Y'][99] == 99
+
+# moving existing values out of memory
+data.set_store(os.path.join(tmpdir, "store"))
+assert isinstance(data[0]['ptrack'], gcp.GCPColumnValue)
+assert data[0]['ptrack']['Y'][5] == 5
+shutil.rmtree(tmpdir)
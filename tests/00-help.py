@@ -0,0 +1,21 @@
+# pyzgoubi --help lists the elements, and the parameters of an element
+import subprocess
+
+# scripts run inside pyzgoubi, so it is the main module
+pyzgoubi_path = os.path.abspath(sys.modules["__main__"].__file__)
+
+out = subprocess.check_output([sys.executable, pyzgoubi_path, "--help", "elements"], universal_newlines=True).split("\n")
+assert out[0] == "available elements"
+for name in ["DRIFT", "QUADRUPO", "OBJET2", "PROTON"]:
+	assert name in out, "%s not listed in elements help" % name
+assert "zgoubi_particul" not in out
+
+out = subprocess.check_output([sys.executable, pyzgoubi_path, "--help", "quadrupo"], universal_newlines=True).split("\n")
+assert out[0] == "QUADRUPO"
+assert out[1] == "zgoubi name: QUADRUPO"
+assert "XL" in out and "B_0" in out
+
+proc = subprocess.Popen([sys.executable, pyzgoubi_path, "--help", "NOT_AN_ELEMENT"], stdout=subprocess.PIPE, universal_newlines=True)
+out = proc.communicate()[0]
+assert proc.returncode == 1
+assert "There is no help for NOT_AN_ELEMENT" in out
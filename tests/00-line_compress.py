@@ -0,0 +1,80 @@
+# Line.output(compress=True) writes repeated cells as one cell and a REBELOTE.
+# Check the compressed output, and that fai data is re-numbered to match the uncompressed line.
+import tempfile
+
+ob = OBJET2(BORO=1000)
+ob.add(Y=1)
+part = PARTICUL(M=938.272, Q=1.602e-19)
+d1 = DRIFT("d1", XL=50)
+q1 = QUADRUPO("q1", XL=10, B_0=1, XPAS=0.1)
+q2 = QUADRUPO("q2", XL=10, B_0=-1, XPAS=0.1)
+fai = FAISCNL(FNAME='zgoubi.fai')
+end = END()
+
+cell = Line("cell")
+cell.add(d1, q1, d1, q2)
+
+# cells made with *
+start = Line("ring")
+start.add(ob, part)
+finish = Line("finish")
+finish.add(fai, end)
+ring = start + 4 * cell + finish
+
+expected = Line("ring")
+expected.add(ob, part, d1, q1, d1, q2, REBELOTE(NPASS=3, KWRIT=1, K=99), fai, end)
+assert ring.output(compress=True) == expected.output()
+assert ring.output() != expected.output()
+# compressing again reuses the kept rendering
+assert ring.output(compress=True) == expected.output()
+
+pieces, compression = ring._dat_pieces(compress=True)
+assert compression == dict(head=2, period=4, repeats=4)
+
+# the same sub line added several times
+ring2 = Line("ring")
+ring2.add(ob, part)
+for x in range(4):
+	ring2.add(cell)
+ring2.add(fai, end)
+expected2 = Line("ring")
+expected2.add(ob, part, cell, REBELOTE(NPASS=3, KWRIT=1, K=99), fai, end)
+assert ring2.output(compress=True) == expected2.output()
+
+# lines that can not be compressed are unchanged
+cav = CAVITE()
+for line_elements in [[ob, d1, q1, q2, fai, end], # no repeats
+                      [ob, q1, d1, q1, d1, REBELOTE(NPASS=3, K=99), end], # already looping
+                      [ob, d1, ob, d1, ob, end], # period contains OBJET
+                      [d1, q1, d1, q1, end], # no OBJET
+                      [ob, d1, cav, d1, cav, end], # CAVITE depends on the pass number, so would see a REBELOTE pass as a turn
+                      [ob, q1, d1, q1, d1, MATRIX(), end], # not in compress_allowed_types
+                      [ob, q1, d1, q1, d1, FAKE_ELEM("'FAKE'\n"), end],
+                      ]:
+	line = Line("line")
+	line.add(*line_elements)
+	assert line.output(compress=True) == line.output()
+	assert line._dat_pieces(compress=True)[1] is None
+
+# elements between the OBJET and the repeats would be repeated by REBELOTE, so the run must start after the head
+line = Line("line")
+line.add(ob, d1, q1, q2, q1, q2, end)
+assert line._dat_pieces(compress=True)[1] is None
+
+# fai records numbered as zgoubi would for the compressed line: OBJET, PARTICUL, 4 cell elements, REBELOTE, FAISCNL, END
+dtype = [('NOEL', 'i4'), ('PASS', 'i4'), ('Y', 'f8')]
+data = numpy.zeros(4 * 4 + 1, dtype=dtype)
+for p in range(4):
+	for n in range(4):
+		data[p*4 + n] = (3 + n, p + 1, p*4 + n)
+data[-1] = (8, 4, 99)
+res = Results(rundir=tempfile.mkdtemp(), compression=compression)
+data = res._expand_numbering(data)
+assert list(data['NOEL']) == list(range(3, 19)) + [19]
+assert all(data['PASS'] == 1)
+# check against the element list of the uncompressed line
+flat = list(ring.elements())
+for noel, element in zip(data['NOEL'][:4], [d1, q1, d1, q2]):
+	assert flat[noel-1] is element
+assert flat[data['NOEL'][-1] - 1] is fai
+res.clean()
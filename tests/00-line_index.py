@@ -0,0 +1,90 @@
+# Lines keep an index of their sub lines, for positions, identities and labels.
+# Check it always matches walking the line, as the line and its sub lines are changed.
+import random
+random.seed(1)
+
+def check_index(line):
+	"compare the indexed lookups with a walk of the line"
+	flat = list(line.elements())
+	for n, e in enumerate(flat):
+		subline, pos = line._find_by_index(n)
+		assert subline.element_list[pos] is e
+		assert n in line.find_elements(e)
+		assert n in line.find_labels(e.label1)
+	for e in flat:
+		assert line.find_elements(e) == [n for n, f in enumerate(flat) if f is e]
+	for label in set(e.label1 for e in flat):
+		assert line.find_labels(label) == [n for n, f in enumerate(flat) if f.label1 == label]
+	for bad_index in [-1, len(flat)]:
+		try:
+			line._find_by_index(bad_index)
+		except ValueError:
+			pass
+		else:
+			raise AssertionError("index %s should be out of range" % bad_index)
+
+d1 = DRIFT("d1", XL=50)
+q1 = QUADRUPO("q1", XL=10)
+q2 = QUADRUPO("q2", XL=10)
+
+cell = Line("cell")
+cell.add(d1, q1, d1, q2)
+inner = Line("inner")
+inner.add(DRIFT("i1"), DRIFT("i2"))
+cell.add(inner)
+
+line = Line("test")
+line.add(OBJET2())
+line.add(cell)
+line.add(Line("empty"))
+line.add(d1)
+line.add(cell)
+line.add(END())
+check_index(line)
+assert len(list(line.elements())) == 15
+
+# edits through the flat index, including the shared sub line
+line.insert(3, DRIFT("new1"))
+check_index(line)
+line.insert(8, MARKER("m1"), MARKER("m2"))
+assert [e.label1 for e in list(line.elements())[8:10]] == ["m2", "m1"]
+check_index(line)
+line.remove(4)
+check_index(line)
+q3 = QUADRUPO("q3", XL=10)
+line.replace(q2, q3, select_index=1)
+assert line.find_elements(q2) == []
+check_index(line)
+
+# edits made to the sub lines directly
+inner.add(DRIFT("i3"))
+check_index(line)
+cell.prepend(MARKER("start"))
+check_index(line)
+d1.label1 = "d1_renamed"
+line.changed()
+check_index(line)
+
+# many random edits, as misalign_element does
+for x in range(200):
+	n = len(list(line.elements()))
+	if random.random() < 0.6 or n < 10:
+		line.insert(random.randrange(n), CHANGREF("c%d" % x))
+	else:
+		line.remove(random.randrange(n))
+check_index(line)
+
+# copies have their own index
+line2 = copy.copy(line)
+line2.insert(0, MARKER("only_in_copy"))
+assert line.find_labels("only_in_copy") == []
+check_index(line)
+check_index(line2)
+
+# pickled lines rebuild their index
+import pickle
+line3 = pickle.loads(pickle.dumps(line))
+check_index(line3)
+line3.insert(0, MARKER("only_in_pickle"))
+check_index(line3)
+assert line.find_labels("only_in_pickle") == []
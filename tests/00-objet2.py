@@ -0,0 +1,35 @@
+from zgoubi.test_macros import *
+
+ob = OBJET2(BORO=100)
+ob.add(Y=0.1, T=0.2, LET='A')
+ob.add(Z=0.3, D=1.1)
+assert(len(ob.particles) == 2)
+assert(ob.particles[1]['D'] == 1.1)
+assert(ob.particles[0]['LET'] == 'A')
+
+lines = ob.output().split("\n")
+assert(lines[3] == "2 2")
+assert(lines[4] == "%.12e %.12e %.12e %.12e %.12e %.12e 'A'" % (0.1, 0.2, 0, 0, 0, 1))
+assert(lines[5] == "%.12e %.12e %.12e %.12e %.12e %.12e ' '" % (0, 0, 0.3, 0, 0, 1.1))
+assert(lines[6] == "1 1 ")
+
+# bulk add, with a line break after every 10 flags
+ob.add(Y=numpy.linspace(0, 1, 20))
+assert(len(ob.particles) == 22)
+lines = ob.output().split("\n")
+assert(lines[3] == "22 22")
+assert(lines[26] == "1 " * 10)
+assert(lines[28] == "1 1 ")
+
+# sorted by D, with one D value per group
+ob.clear()
+assert(len(ob.particles) == 0)
+ob.sorted = True
+ob.add(D=1.2, Y=1)
+ob.add(D=1.0, Y=2)
+ob.add(D=1.2, Y=3)
+assert(list(ob.particles['D']) == [1.0, 1.2, 1.2])
+assert(list(ob.particles['Y']) == [2, 1, 3])
+assert(ob.output().split("\n")[3] == "3 2")
+
+assert_eval_raises("ob.add(XX=1)", locals(), ValueError)
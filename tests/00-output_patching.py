@@ -0,0 +1,61 @@
+# Line.output() keeps the last rendering and only re-renders changed elements.
+# Check it always matches rendering from scratch.
+
+def fresh_output(line, recurse):
+	"the output, rendered the simple way. Pass fresh_output as recurse, as test scripts are run with exec()"
+	out = ""
+	if line.full_line:
+		out = line.name + "\n"
+	for element in line.element_list:
+		if isinstance(element, Line):
+			out += recurse(element, recurse) + "\n"
+		else:
+			out += element.output() + "\n"
+	return out
+
+ob = OBJET2(BORO=1000)
+ob.add(Y=1)
+q1 = QUADRUPO("q1", XL=10, B_0=1, XPAS=0.1)
+q2 = QUADRUPO("q2", XL=10, B_0=-1, XPAS=(10, 20, 10))
+d1 = DRIFT("d1", XL=50)
+
+cell = Line("cell")
+cell.add(d1, q1, d1, q2)
+
+line = Line("test")
+line.add(ob)
+line.add(cell)
+line.add(d1)
+line.add(cell)
+line.add(FAISCNL(FNAME='zgoubi.fai'))
+line.add(END())
+
+assert(line.output() == fresh_output(line, fresh_output))
+assert(line.output() == fresh_output(line, fresh_output))
+
+# same length change, patched in place
+q1.set(B_0=2)
+assert(line.output() == fresh_output(line, fresh_output))
+q1.B_0 = 3
+assert(line.output() == fresh_output(line, fresh_output))
+
+# length change
+d1.label1 = "a_longer_label"
+assert(line.output() == fresh_output(line, fresh_output))
+ob.BORO = -12345.678
+assert(line.output() == fresh_output(line, fresh_output))
+ob.add(Y=2)
+assert(line.output() == fresh_output(line, fresh_output))
+
+# structure changes
+cell.add(DRIFT("d2", XL=1))
+assert(line.output() == fresh_output(line, fresh_output))
+line.remove(2)
+assert(line.output() == fresh_output(line, fresh_output))
+
+# a copy does not share the kept rendering
+line2 = copy.deepcopy(line)
+q2.set(XL=20)
+assert(line.output() == fresh_output(line, fresh_output))
+assert(line2.output() == fresh_output(line2, fresh_output))
+assert(line.output() != line2.output())
@@ -13,11 +13,11 @@ b.set(XL=2)
 assert(b.XL == 2)
 assert(b.get("XL") == 2)
 
-# FIXME should also make this work properly
-#b.XL = 3
-#assert(b.XL == 3)
-#print b.get("XL")
-#assert(b.get("XL") == 3)
+b.XL = 3
+assert(b.XL == 3)
+assert(b.get("XL") == 3)
+assert(isinstance(b.XL, float))
+assert("XL" not in b.__dict__)
 
 
 b = BEND(XL=4, IL=1)
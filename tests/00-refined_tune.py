@@ -0,0 +1,30 @@
+# refined_tune() finds tunes from a few hundred turns to much better than the FFT bin size, for many particles at once.
+
+numpy.random.seed(1)
+n_particles = 50
+n_turns = 300
+# away from 1/3, where the second harmonic aliases onto the tune
+tunes = numpy.random.uniform(0.05, 0.3, n_particles)
+turns = numpy.arange(n_turns)
+phases = numpy.random.uniform(0, 2*pi, n_particles)
+# betatron motion about a closed orbit, with a small second harmonic
+coords = (3.5 + numpy.cos(2*pi*tunes[:, numpy.newaxis]*turns + phases[:, numpy.newaxis])
+          + 0.05 * numpy.cos(4*pi*tunes[:, numpy.newaxis]*turns))
+
+found = refined_tune(coords)
+assert found.shape == (n_particles,)
+print("max error", abs(found - tunes).max())
+assert abs(found - tunes).max() < 1e-6
+
+# a single particle gives a float
+assert isinstance(refined_tune(coords[0]), float)
+assert abs(refined_tune(coords[0]) - tunes[0]) < 1e-6
+
+# fourier_tune() uses it, unless refine=False, which gives the FFT bin
+line = Line("ring")
+line.add(OBJET2(), FAISCNL(), REBELOTE(), END())
+tune_y, tune_z = fourier_tune(line, [], 1, 1, coords=[coords[0], coords[1]])
+assert abs(tune_y - tunes[0]) < 1e-6 and abs(tune_z - tunes[1]) < 1e-6
+tune_y, tune_z = fourier_tune(line, [], 1, 1, coords=[coords[0], coords[1]], refine=False)
+assert tune_y * n_turns == round(tunes[0] * n_turns)
+assert abs(tune_y - tunes[0]) <= 0.5 / n_turns
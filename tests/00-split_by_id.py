@@ -0,0 +1,22 @@
+# get_tracks_multi() tracks many particles in one run, and splits the records by particle ID with _split_by_id().
+
+# 4 particles, recorded interleaved as zgoubi writes them, with particle 3 never recorded
+track = numpy.zeros(10, dtype=[('ID', 'i4'), ('S', 'f8')])
+track['ID'] = [1, 2, 4, 1, 2, 4, 1, 4, 2, 1]
+track['S'] = numpy.arange(10)
+
+split = gcp._split_by_id(track, 4)
+assert len(split) == 4
+assert list(split[0]['S']) == [0, 3, 6, 9]
+assert list(split[1]['S']) == [1, 4, 8]
+assert split[2] is None
+assert list(split[3]['S']) == [2, 5, 7]
+for n in [0, 1, 3]:
+	assert numpy.all(split[n]['ID'] == n + 1)
+
+# IDs beyond n_rays are ignored
+assert len(gcp._split_by_id(track, 2)) == 2
+assert list(gcp._split_by_id(track, 2)[1]['S']) == [1, 4, 8]
+
+# no track file, such as the plt without full_tracking
+assert gcp._split_by_id(None, 3) == [None, None, None]
@@ -0,0 +1,17 @@
+# Outside pyzgoubi, a star import of zgoubi.core gives the element classes
+import subprocess
+import zgoubi
+
+star_import_code = """
+from zgoubi.core import *
+line = Line("line")
+line.add(DRIFT("d", XL=10), QUADRUPO("q", XL=5, B_0=1), END())
+print(line.output())
+"""
+
+env = dict(os.environ)
+env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(zgoubi.__file__))), env.get("PYTHONPATH", "")])
+
+out = subprocess.check_output([sys.executable, "-c", star_import_code], env=env, universal_newlines=True)
+assert "'DRIFT' d" in out
+assert "'QUADRUPO' q" in out
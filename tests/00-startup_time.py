@@ -0,0 +1,33 @@
+# Starting pyzgoubi should be quick, and should not load the heavy modules
+import subprocess
+import zgoubi
+
+startup_budget = 1.0 # seconds
+
+startup_code = """
+import time, sys
+t0 = time.time()
+from zgoubi.utils import *
+from zgoubi.core import *
+from zgoubi.constants import *
+from zgoubi.bunch import *
+from zgoubi.common import lazy_import
+gcp = lazy_import("zgoubi.gcp")
+print(time.time() - t0)
+loaded = [m for m in ["scipy", "matplotlib", "pylab", "yaml", "pkg_resources", "zgoubi.lab_plot", "zgoubi.ellipse"] if m in sys.modules]
+if type(sys.modules["zgoubi.gcp"]).__name__ != "_LazyModule":
+	loaded.append("zgoubi.gcp")
+print(" ".join(loaded))
+"""
+
+env = dict(os.environ)
+env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(zgoubi.__file__))), env.get("PYTHONPATH", "")])
+
+times = []
+for n in range(3):
+	out = subprocess.check_output([sys.executable, "-c", startup_code], env=env, universal_newlines=True).split("\n")
+	times.append(float(out[0]))
+	assert out[1] == "", "heavy modules loaded at startup: %s" % out[1]
+
+print("startup times", times)
+assert min(times) < startup_budget, "startup took %s s, budget is %s s" % (min(times), startup_budget)
@@ -0,0 +1,91 @@
+# calc_transfer_matrix() and the twiss functions work on arrays of ray sets and matrices, as used by batched_transfer_matrices().
+# Check them against known matrices, and against calculating one set at a time.
+
+def make_matrix(mu_y, beta_y, alpha_y, mu_z, beta_z, alpha_z, disp_y, disp_py):
+	"a 6x6 matrix with the given periodic twiss and dispersion"
+	tm = numpy.identity(6)
+	for i, mu, beta, alpha in [(0, mu_y, beta_y, alpha_y), (2, mu_z, beta_z, alpha_z)]:
+		gamma = (1 + alpha**2) / beta
+		tm[i:i+2,i:i+2] = [[cos(mu) + alpha*sin(mu), beta*sin(mu)], [-gamma*sin(mu), cos(mu) - alpha*sin(mu)]]
+	# periodic dispersion D = M D + M[:,5]
+	tm[0:2,5] = numpy.dot(numpy.identity(2) - tm[0:2,0:2], [disp_y, disp_py])
+	return tm
+
+params = [(1.0, 5.0, 0.5, 2.0, 3.0, -0.2, 1.5, 0.1),
+          (4.0, 2.0, -1.0, 0.5, 8.0, 0.0, -0.3, 0.0),
+          (2.5, 1.0, 0.0, 5.5, 1.0, 1.0, 0.0, -0.2)]
+matrices = []
+for p in params:
+	matrices.append(make_matrix(*p))
+matrices = numpy.array(matrices)
+
+# tracking 11 OBJET5 rays through a linear map recovers the matrix
+def track_rays(tm):
+	start = numpy.zeros(11, dtype=[(c, 'f8') for c in "DYTZPS"])
+	start['D'] = 1
+	for n, (c, step) in enumerate(zip("YTZPD", [1e-5, 1e-5, 1e-5, 1e-5, 1e-3])):
+		start[c][2*n+1] += step
+		start[c][2*n+2] -= step
+	coords = numpy.array([start['Y'], start['T'], start['Z'], start['P'], start['S'], start['D'] - 1])
+	moved = numpy.dot(tm, coords)
+	end = start.copy()
+	for n, c in enumerate("YTZPS"):
+		end[c] = moved[n]
+	return start, end
+
+starts = []
+ends = []
+for tm in matrices:
+	start, end = track_rays(tm)
+	starts.append(start)
+	ends.append(end)
+starts = numpy.array(starts)
+ends = numpy.array(ends)
+
+batch = calc_transfer_matrix(starts, ends)
+assert batch.shape == (3, 6, 6)
+for n in range(3):
+	single = calc_transfer_matrix(starts[n], ends[n])
+	assert single.shape == (6, 6)
+	assert numpy.allclose(batch[n], single)
+	assert numpy.allclose(batch[n][0:4,0:4], matrices[n][0:4,0:4])
+	assert numpy.allclose(batch[n][0:4,5], matrices[n][0:4,5])
+
+# tunes, twiss and dispersion
+mu_y, mu_z = calc_phase_ad_from_matrix(matrices)
+params_a = numpy.array(params)
+assert numpy.allclose(mu_y, params_a[:,0])
+assert numpy.allclose(mu_z, params_a[:,3])
+twiss = numpy.array(calc_twiss_from_matrix(matrices))
+for n, p in enumerate(params):
+	assert numpy.allclose(calc_twiss_from_matrix(matrices[n]), twiss[:,n])
+	assert numpy.allclose([twiss[0][n], twiss[1][n], twiss[3][n], twiss[4][n]], [p[1], p[2], p[4], p[5]])
+	assert isinstance(calc_phase_ad_from_matrix(matrices[n])[0], float)
+disp_y, disp_py, disp_z, disp_pz = calc_dispersion_from_matrix(matrices)
+assert numpy.allclose(disp_y, params_a[:,6])
+assert numpy.allclose(disp_py, params_a[:,7])
+assert numpy.allclose(disp_z, 0)
+
+# the periodic solution is unchanged by its own matrix
+for n, p in enumerate(params):
+	tp = twiss_param_array(beta_y=p[1], alpha_y=p[2], beta_z=p[4], alpha_z=p[5], disp_y=p[6], disp_py=p[7])
+	out = propagate_twiss_through_matrix(matrices[n], tp)
+	assert out.shape == (1,)
+	for key in tp.dtype.names:
+		assert numpy.allclose(out[key], tp[key]), key
+# an array of matrices gives a row for each
+out = propagate_twiss_through_matrix(matrices, twiss_param_array(beta_y=1, alpha_y=0, beta_z=1, alpha_z=0))
+assert out.shape == (3,)
+assert numpy.allclose(out['beta_y'], matrices[:,0,0]**2 + matrices[:,0,1]**2)
+
+# unstable matrices give nan in arrays, and raise for a single matrix
+unstable = numpy.identity(6)
+unstable[0:2,0:2] = [[2, 1], [1, 1]]
+mu_y, mu_z = calc_phase_ad_from_matrix(numpy.array([matrices[0], unstable]))
+assert not numpy.isnan(mu_y[0]) and numpy.isnan(mu_y[1])
+try:
+	calc_phase_ad_from_matrix(unstable)
+except ValueError:
+	pass
+else:
+	raise AssertionError("unstable matrix should raise ValueError")
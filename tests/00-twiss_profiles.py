@@ -0,0 +1,52 @@
+# get_twiss_profiles() from the 11 OBJET5 rays of an existing run, here straight lines through a drift, where beta(s) is known.
+
+class DriftResults(object):
+	"The plt records of 11 rays through a 2 m drift, interleaved as zgoubi writes them"
+	def __init__(self):
+		names = ['LET', 'D0-1', 'Y0', 'T0', 'Z0', 'P0', 'D-1', 'Y', 'T', 'Z', 'P', 'S', 'X', 'BORO', 'element_label1']
+		dtype = [(n, 'U1' if n == 'LET' else 'U10' if n == 'element_label1' else 'f8') for n in names]
+		s = numpy.linspace(0, 200, 101)
+		self.plt = numpy.zeros([len(s), 11], dtype)
+		offsets = [('Y0', 0)] + [(c, d) for c in ['Y0', 'T0', 'Z0', 'P0', 'D0-1'] for d in [1e-3, -1e-3]]
+		for n, (let, (c, d)) in enumerate(zip("OABCDEFGHIJ", offsets)):
+			ray = self.plt[:, n]
+			ray['LET'] = let
+			ray[c] = d
+			ray['Y'] = ray['Y0'] + ray['T0'] * s / 1000
+			ray['T'] = ray['T0']
+			ray['Z'] = ray['Z0'] + ray['P0'] * s / 1000
+			ray['P'] = ray['P0']
+			ray['D-1'] = ray['D0-1']
+			ray['S'] = s
+			ray['X'] = s
+		self.plt = self.plt.reshape(-1)
+		self.plt['BORO'] = 1000
+		self.plt['element_label1'] = " drift"
+
+	def get_all(self, file):
+		if file != 'plt':
+			raise IOError("no %s file" % file)
+		return self.plt
+
+line = Line("drift")
+line.add(OBJET5())
+line.add(DRIFT("drift", XL=200))
+line.add(MATRIX())
+line.add(END())
+
+init_twiss = twiss_param_array(beta_y=3, alpha_y=1, beta_z=2, alpha_z=-0.5)
+profile = get_twiss_profiles(line, input_twiss_parameters=init_twiss, calc_dispersion=False, results=DriftResults())
+assert len(profile) == 101
+s = profile['s']
+assert numpy.allclose(s[-1], 2)
+for p in "yz":
+	beta_0, alpha_0, gamma_0 = init_twiss['beta_'+p][0], init_twiss['alpha_'+p][0], init_twiss['gamma_'+p][0]
+	assert numpy.allclose(profile['beta_'+p], beta_0 - 2*s*alpha_0 + s**2*gamma_0)
+	assert numpy.allclose(profile['alpha_'+p], alpha_0 - s*gamma_0)
+	assert numpy.allclose(profile['gamma_'+p], gamma_0)
+	# the phase advance through a drift never reaches pi
+	mu = profile['mu_'+p]
+	assert mu[0] == 0 and numpy.all(numpy.diff(mu) >= 0) and mu[-1] < pi
+assert numpy.allclose(profile['mu_y'][-1], atan2(2, 3 - 2))
+assert numpy.all(profile['label'] == b"drift")
+assert numpy.all(profile['disp_y'] == -1)
@@ -76,3 +76,19 @@ assert( abs((Z0-Z1)) < 1e-10  )
 assert( abs((P0-P1)) < 1e-10  )
 
 
+
+# Newton's method from the one turn map, should need just a few iterations
+closed_orbit, iterations = find_closed_orbit_newton(emma, init_YTZP=[0,0,0,0], tol=1e-12, return_iterations=True)
+print("Newton iterations", iterations)
+Y1, T1, Z1, P1 = closed_orbit
+assert( abs((Y0-Y1)/Y0) < 1e-8  )
+assert( abs((T0-T1)/T0) < 1e-8  )
+assert( abs((Z0-Z1)) < 1e-8  )
+assert( abs((P0-P1)) < 1e-8  )
+assert( iterations < 10 )
+
+# from a poor starting point, searching from a grid of particles, with the searches from the best survivors run in parallel
+closed_orbit = find_closed_orbit_range(emma, init_YTZP=[0,40,0,0], range_YTZP=[1,40,0,0], count_YTZP=[3,9,0,0], tol=1e-10, n_threads=3)
+Y1, T1, Z1, P1 = closed_orbit
+assert( abs((Y0-Y1)/Y0) < 1e-6  )
+assert( abs((T0-T1)/T0) < 1e-6  )
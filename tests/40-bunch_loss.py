@@ -12,3 +12,11 @@ test_line.add(DRIFT(XL=1))
 print("These should raise some warnings")
 outbunch = test_line.track_bunch(inbunch)
 assert (len(outbunch) == 50)
+
+# keep track of which particles survived, and which were lost
+outbunch = test_line.track_bunch(inbunch, track_ids=True)
+assert (inbunch.get_ids() is None)
+assert (numpy.all(outbunch.get_ids() == numpy.arange(50)))
+losses = outbunch.get_losses()
+assert (numpy.all(numpy.sort(losses['ID']) == numpy.arange(50, 100)))
+assert (numpy.all(losses['IEX'] == -4))
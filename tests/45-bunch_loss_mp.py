@@ -0,0 +1,22 @@
+inbunch = Bunch(nparticles=100, ke=100e6, mass=PROTON_MASS, charge=1)
+
+inbunch.particles()['Y'] = numpy.linspace(0,1,len(inbunch))
+
+
+test_line = Line("t")
+
+test_line.add(CHAMBR(IA=1, IFORM=1, ZL=1, YL=50))
+test_line.add(DRIFT(XL=1))
+
+print("These should raise some warnings")
+outbunch = test_line.track_bunch_mp(inbunch, max_particles=30)
+assert (len(outbunch) == 50)
+assert (numpy.all(outbunch.particles()['Y'] < 0.5))
+
+# keep track of which particles survived, and which were lost
+outbunch = test_line.track_bunch_mp(inbunch, max_particles=30, track_ids=True)
+assert (inbunch.get_ids() is None)
+assert (numpy.all(outbunch.get_ids() == numpy.arange(50)))
+losses = outbunch.get_losses()
+assert (numpy.all(numpy.sort(losses['ID']) == numpy.arange(50, 100)))
+assert (numpy.all(losses['IEX'] == -4))
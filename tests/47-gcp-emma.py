@@ -59,3 +59,37 @@ for prop in ["Y", "T", "NU_Y", "NU_Z"]:
 	max_error = (data[prop] - expected[prop]).max()
 	print("  max error", max_error)
 	assert ( max_error < 1e-8)
+
+# parallel scan, the closed orbits of each block are searched from the first energy of the block, so it matches a serial scan with the same blocks exactly
+data_mt = gcp.get_cell_properties(cell=emma_cell, min_ke=10e6, max_ke=20e6, ke_steps=11, particle='e', n_threads=3)
+data_chains = gcp.get_cell_properties(cell=emma_cell, min_ke=10e6, max_ke=20e6, ke_steps=11, particle='e', n_threads=1, n_chains=3)
+assert(numpy.all(data_mt['stable']))
+for prop in data_mt.dtype.names:
+	print("Checking parallel", prop)
+	numpy.testing.assert_array_equal(data_mt[prop], data_chains[prop])
+# and only differs from the single chain scan within the search tolerance
+for prop in ["Y", "T", "NU_Y", "NU_Z"]:
+	max_error = abs(data_mt[prop] - data[prop]).max()
+	print("  max error", prop, max_error)
+	assert ( max_error < 1e-5)
+
+# all the transfer matrices from one zgoubi run
+data_batch = gcp.get_cell_properties(cell=emma_cell, min_ke=10e6, max_ke=20e6, ke_steps=11, particle='e', batch_twiss=True)
+assert(numpy.all(data_batch['stable']))
+for prop in ["NU_Y", "NU_Z", "BETA_Y", "BETA_Z"]:
+	print("Checking batch", prop)
+	max_error = abs(data_batch[prop] - data[prop]).max()
+	print("  max error", max_error)
+	assert ( max_error < 1e-4 * abs(data[prop]).max())
+
+# starting a nonperiodic cell from the periodic solution, the end twiss propagated through the matrix is unchanged
+row = data[5]
+init_twiss = twiss_param_array(beta_y=row['BETA_Y'], alpha_y=row['ALPHA_Y'], beta_z=row['BETA_Z'], alpha_z=row['ALPHA_Z'], disp_y=row['DISP_Y'], disp_py=row['DISP_PY'])
+data_np = gcp.get_cell_properties_nonperiodic(cell=emma_cell, min_ke=row['KE'], particle='e', init_YTZP=[row['Y'], row['T'], row['Z'], row['P']], init_twiss=init_twiss, twiss_profile=True)
+for prop in ["BETA_Y", "BETA_Z", "ALPHA_Y", "ALPHA_Z", "DISP_Y"]:
+	print("Checking nonperiodic", prop)
+	max_error = abs(data_np[prop][0] - data_np[prop+"0"][0])
+	print("  max error", max_error)
+	assert ( max_error < 1e-3 * max(abs(row['BETA_Y']), abs(row['BETA_Z'])))
+# and the profile from the same run ends at the same place
+assert abs(data_np[0]['twiss_profile']['beta_y'][-1] - data_np['BETA_Y'][0]) < 1e-3 * row['BETA_Y']
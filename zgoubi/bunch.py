@@ -41,8 +41,14 @@ class Bunch(object):
 	('tof', numpy.float64), # these are for accumulating
 	('X', numpy.float64),
 	]
+	loss_data_def = [
+	('ID', numpy.int32), # stable particle id, see set_ids()
+	('IEX', numpy.int8), # zgoubi loss code, see Results.loss_summary()
+	('NOEL', numpy.int32), # element number and pass where zgoubi flagged the particle as lost
+	('PASS', numpy.int32),
+	]
 
-	def __init__(self, nparticles=0, ke=None, rigidity=0, mass=0, charge=1, particles=None):
+	def __init__(self, nparticles=0, ke=None, rigidity=0, mass=0, charge=1, particles=None, ids=None):
 		"""Bunch constructor.
 
 		"""
@@ -55,19 +61,96 @@ class Bunch(object):
 		self.mass = mass
 		self.charge = charge
 		self.rigidity = rigidity
+		self.ids = ids
+		self.losses = numpy.zeros(0, self.loss_data_def)
 		if ke is not None:
 			self.set_bunch_ke(ke)
 
+	def set_ids(self, ids=None):
+		"""Give each particle a stable ID, by default its current index. The IDs are kept in the ids array, next to the coords, and follow the surviving particles through Line.track_bunch() and Line.track_bunch_mt(). Particles that are lost are recorded in the losses array (see loss_data_def)."""
+		if ids is None:
+			ids = numpy.arange(len(self.coords), dtype=numpy.int32)
+		if len(ids) != len(self.coords):
+			raise ValueError("Need one ID per particle")
+		self.ids = numpy.asarray(ids, dtype=numpy.int32)
+
+	def get_ids(self):
+		"Returns the array of particle IDs, or None if they have not been set"
+		return self.ids
+
+	def get_losses(self):
+		"Returns the record of lost particles, a structured array with ID, IEX, NOEL and PASS columns"
+		return self.losses
+
 	def split_bunch(self, max_particles, n_slices):
 		"Split a bunch into n_slices smaller bunches, or more if they would have too many particles in."
 		if ceil(len(self.coords) / n_slices) > max_particles:
 			n_slices = ceil(len(self.coords)/max_particles)
 
 		rigidity = self.get_bunch_rigidity()
-		for pslice in numpy.array_split(self.coords, n_slices):
+		if self.ids is None:
+			id_slices = itertools.repeat(None)
+		else:
+			id_slices = numpy.array_split(self.ids, n_slices)
+		for pslice, id_slice in zip(numpy.array_split(self.coords, n_slices), id_slices):
 			if pslice.size != 0:
 				yield Bunch(rigidity=rigidity, mass=self.mass, charge=self.charge,
-			            particles=pslice)
+			            particles=pslice, ids=id_slice)
+
+	def shared_slices(self, max_particles, n_slices):
+		"""Like split_bunch(), but yields (offset, length) descriptors rather than new Bunch objects. Used with to_shared_memory() and attach_shared_memory(), so that other processes can work on a slice without the coordinates being pickled."""
+		if ceil(len(self.coords) / n_slices) > max_particles:
+			n_slices = ceil(len(self.coords)/max_particles)
+
+		# same slice sizes as numpy.array_split
+		base, extra = divmod(len(self.coords), int(n_slices))
+		offset = 0
+		for n in range(int(n_slices)):
+			length = base + 1 if n < extra else base
+			if length != 0:
+				yield offset, length
+			offset += length
+
+	def to_shared_memory(self):
+		"""Move the coordinates into a new multiprocessing.shared_memory block, and return its name. The block stays in place until close_shared_memory(unlink=True) is called. Requires Python 3.8 or newer.
+		Note that close_shared_memory() will fail if there are still numpy views of particles() in use.
+		"""
+		from multiprocessing import shared_memory
+		coords = self.coords
+		shm = shared_memory.SharedMemory(create=True, size=max(coords.nbytes, 1))
+		self.coords = numpy.ndarray(coords.shape, dtype=coords.dtype, buffer=shm.buf)
+		self.coords[:] = coords
+		self._shm = shm
+		return shm.name
+
+	@staticmethod
+	def attach_shared_memory(name, nparticles, offset=0, length=None, rigidity=0, mass=0, charge=1, dtype=None):
+		"""Create a Bunch whose coordinates are particles offset to offset+length of a bunch that was put in shared memory with to_shared_memory(). Changes to the particles are seen by all processes attached to the block. Call close_shared_memory() when done.
+		"""
+		from multiprocessing import shared_memory
+		if dtype is None:
+			dtype = Bunch.min_data_def
+		if length is None:
+			length = nparticles - offset
+		shm = shared_memory.SharedMemory(name=name)
+		coords = numpy.ndarray(nparticles, dtype=dtype, buffer=shm.buf)[offset:offset+length]
+		bunch = Bunch(rigidity=rigidity, mass=mass, charge=charge, particles=coords)
+		bunch._shm = shm
+		return bunch
+
+	def close_shared_memory(self, unlink=False, keep_data=True):
+		"""Detach from a shared memory block. If keep_data is true, the coordinates are first copied into normal memory, so the bunch can still be used. unlink=True frees the block, which should be done once, by the process that created it."""
+		shm = getattr(self, "_shm", None)
+		if shm is None:
+			return
+		if keep_data:
+			self.coords = self.coords.copy()
+		else:
+			self.coords = numpy.zeros(0, self.coords.dtype)
+		shm.close()
+		if unlink:
+			shm.unlink()
+		self._shm = None
 
 	def __str__(self):
 		out = "Bunch:\n"
@@ -565,9 +648,13 @@ class Bunch(object):
 		"Returns length of bunch. Use len(my_bunch)"
 		return len(self.coords)
 
-	def plot(self, fname=None, lims=None, add_bunch=None, fmt=None, longitudinal=True):
+	def plot(self, fname=None, lims=None, add_bunch=None, fmt=None, longitudinal=True, density=False, bins=200, rms_ellipse=False):
 		"""Plot a bunch, if no file name give plot is displayed on screen. lims can be used to force axis limits eg [lY,lT,lZ,lP,lX,lD] would plot limit plot from -lY to +lY in Y, etc. Additional bunches can be passed, as add_bunch, to overlay onto the same plot.
 		fmt can be a list of formats in matplotlib style, eg ['rx', 'bo']
+
+		For large bunches (over ~1e5 particles) set density=True. Each projection is then binned into a bins by bins 2D histogram and drawn as an image, rather than drawing every particle. Any add_bunch bunches are drawn as contours of their histograms on top of the image.
+
+		rms_ellipse=True draws the rms ellipse of each bunch in each projection. In x-x' and y-y' this is the ellipse given by get_emittance_rms() and get_twiss_rms().
 		"""
 		import pylab
 		if fmt is None:
@@ -599,10 +686,31 @@ class Bunch(object):
 			
 			pylab.subplot(2, 2, n)
 			pylab.grid()
-			for abunch, f in zip(bunches, itertools.cycle(fmt)):
-				pylab.plot(abunch.coords[coordsz[x]], abunch.coords[coordsz[y]], f)
+			if density:
+				if lims is not None and n != 4:
+					hist_range = [[-lims[x], lims[x]], [-lims[y], lims[y]]]
+				else:
+					hist_range = [[min(b.coords[coordsz[x]].min() for b in bunches), max(b.coords[coordsz[x]].max() for b in bunches)],
+					              [min(b.coords[coordsz[y]].min() for b in bunches), max(b.coords[coordsz[y]].max() for b in bunches)]]
+				for bn, abunch in enumerate(bunches):
+					hist, x_edges, y_edges = numpy.histogram2d(abunch.coords[coordsz[x]], abunch.coords[coordsz[y]], bins=bins, range=hist_range)
+					if bn == 0:
+						# mask empty bins, so that background is left blank
+						pylab.imshow(numpy.ma.masked_equal(hist.T, 0), extent=[x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]],
+						             origin="lower", aspect="auto", interpolation="nearest", cmap="viridis")
+					else:
+						pylab.contour((x_edges[1:] + x_edges[:-1]) / 2, (y_edges[1:] + y_edges[:-1]) / 2, hist.T, 4, colors="C%d" % bn, linewidths=0.5)
 				pylab.xlabel(coords[x])
 				pylab.ylabel(coords[y])
+			else:
+				for abunch, f in zip(bunches, itertools.cycle(fmt)):
+					pylab.plot(abunch.coords[coordsz[x]], abunch.coords[coordsz[y]], f)
+					pylab.xlabel(coords[x])
+					pylab.ylabel(coords[y])
+			if rms_ellipse:
+				for bn, abunch in enumerate(bunches):
+					ex, ey = abunch._rms_ellipse(coordsz[x], coordsz[y])
+					pylab.plot(ex, ey, "-", color="C%d" % bn, linewidth=1)
 			if lims is not None and n != 4:
 				pylab.xlim(-lims[x], lims[x])
 				pylab.ylim(-lims[y], lims[y])
@@ -614,6 +722,20 @@ class Bunch(object):
 			pylab.savefig(fname, dpi=300)
 			pylab.clf()
 
+	def _rms_ellipse(self, xname, yname, npoints=100):
+		"""Return points on the rms ellipse in the xname-yname projection.
+		Uses the covariance of the two coordinates. For Y-T and Z-P this is emittance * [[beta, -alpha], [-alpha, gamma]], with the same emittance and twiss values as get_emittance_rms() and get_twiss_rms()
+		"""
+		xs = self.coords[xname]
+		ys = self.coords[yname]
+		sigma = numpy.cov(xs, ys, bias=True)
+		# eigh rather than cholesky, so that a zero width projection (eg. all D=1) still works
+		w, v = numpy.linalg.eigh(sigma)
+		phi = numpy.linspace(0, 2*pi, npoints)
+		circle = numpy.array([numpy.cos(phi), numpy.sin(phi)])
+		points = numpy.dot(v * numpy.sqrt(numpy.maximum(w, 0)), circle)
+		return points[0] + xs.mean(), points[1] + ys.mean()
+
 	def get_emittance(self):
 		"return emittance h and v in m rad. Uses the bunch full width, so should only be used for a hard edge distribution"
 		self.check_bunch()
@@ -722,3 +844,185 @@ class Bunch(object):
 		return beta_h, alpha_h, beta_v, alpha_v
 
 
+
+
+class BunchHistory(object):
+	"""Store the coordinates of a bunch of particles over many turns in a single preallocated array.
+	All values are in SI units, as in :py:class:`Bunch`. The coordinates are held in a structured numpy array of shape (nturns, nparticles), so the bunch at a given turn, or the time series of a given particle, can be read without copying::
+
+		history = BunchHistory(nturns=100, nparticles=len(my_bunch), mass=PROTON_MASS, charge=1)
+		for turn in range(100):
+			history.record(turn, my_bunch)
+			my_bunch = cell.track_bunch(my_bunch)
+
+		ys = history.coord('Y')[:, 5] # horizontal position of particle 5 on every turn
+		turn_10 = history.get_turn(10) # a Bunch
+
+	Particles that are not recorded on a turn (e.g. because they were lost) are marked in the alive mask, see :py:meth:`alive` and :py:meth:`lost_turn`.
+
+	If fname is given the arrays are memory mapped to .npy files, so histories larger than the available RAM can be stored. They can be reopened with :py:meth:`BunchHistory.load`.
+
+	Each particle of the history has an ID, by default its index. Bunches with IDs (see :py:meth:`Bunch.set_ids`) are recorded by matching their IDs to these, so for a bunch with other IDs give them when creating the history::
+
+		history = BunchHistory(nturns=100, nparticles=len(my_bunch), ids=my_bunch.get_ids())
+
+	"""
+	def __init__(self, nturns, nparticles, ke=None, rigidity=0, mass=0, charge=1, fname=None, ids=None):
+		nturns = int(nturns)
+		nparticles = int(nparticles)
+		if ids is None:
+			ids = numpy.arange(nparticles, dtype=numpy.int32)
+		if len(ids) != nparticles:
+			raise ValueError("Need one ID per particle")
+		self.ids = numpy.asarray(ids, dtype=numpy.int32)
+		if fname is not None:
+			self.coords = numpy.lib.format.open_memmap(fname, mode="w+", dtype=Bunch.min_data_def, shape=(nturns, nparticles))
+			self.alive_mask = numpy.lib.format.open_memmap(self._alive_fname(fname), mode="w+", dtype=numpy.bool_, shape=(nturns, nparticles))
+		else:
+			self.coords = numpy.zeros((nturns, nparticles), Bunch.min_data_def)
+			self.alive_mask = numpy.zeros((nturns, nparticles), numpy.bool_)
+		self.fname = fname
+		self.mass = mass
+		self.charge = charge
+		self.rigidity = rigidity
+		if ke is not None:
+			self.rigidity = rel_conv.ke_to_rigidity(mass=mass, ke=ke, charge=charge)
+
+	@staticmethod
+	def _alive_fname(fname):
+		"Name of the file that holds the alive mask for a memory mapped history"
+		if fname.endswith(".npy"):
+			fname = fname[:-4]
+		return fname + "_alive.npy"
+
+	@staticmethod
+	def load(fname, mass=0, charge=1, rigidity=0, mode="r"):
+		"""Reopen a history that was created with fname set. The arrays are memory mapped, with mode passed to numpy.load (use "r+" to allow modification)::
+
+			history = BunchHistory.load("history.npy", mass=PROTON_MASS, charge=1)
+
+		"""
+		history = BunchHistory(0, 0, rigidity=rigidity, mass=mass, charge=charge)
+		history.coords = numpy.load(fname, mmap_mode=mode)
+		history.alive_mask = numpy.load(BunchHistory._alive_fname(fname), mmap_mode=mode)
+		history.fname = fname
+		history.ids = numpy.arange(history.coords.shape[1], dtype=numpy.int32)
+		return history
+
+	def __len__(self):
+		"Returns the number of turns"
+		return self.coords.shape[0]
+
+	def __str__(self):
+		out = "BunchHistory:\n"
+		out += "\t"+str(self.coords.shape[0]) + " turns\n"
+		out += "\t"+str(self.coords.shape[1]) + " particles\n"
+		return out
+
+	def nparticles(self):
+		"Returns the number of particles"
+		return self.coords.shape[1]
+
+	def record(self, turn, bunch, ids=None):
+		"""Copy the coordinates of bunch into the history at the given turn.
+		If some particles have been lost, the original index of each particle in bunch must be given in ids, so that it is stored in the right place. Particles not given are marked as not alive on that turn. If ids is not given, and the bunch has IDs (see Bunch.set_ids()), each particle is stored with the history particle of the same ID. A ValueError is raised if any are not in the history's IDs.
+		"""
+		if ids is None and bunch.get_ids() is not None:
+			ids = self._index_of_ids(bunch.get_ids())
+		if ids is None:
+			if len(bunch) != self.coords.shape[1]:
+				raise ValueError("Bunch has %s particles, history has %s. Pass ids to record a partial bunch" % (len(bunch), self.coords.shape[1]))
+			self.coords[turn] = bunch.particles()
+			self.alive_mask[turn] = True
+		else:
+			ids = numpy.asarray(ids)
+			self.alive_mask[turn] = False
+			self.coords[turn][ids] = bunch.particles()
+			self.alive_mask[turn][ids] = True
+		if self.rigidity == 0:
+			self.rigidity = bunch.get_bunch_rigidity()
+		if self.mass == 0:
+			self.mass = bunch.mass
+			self.charge = bunch.charge
+
+	def _index_of_ids(self, bunch_ids):
+		"The index in the history of each of bunch_ids"
+		bunch_ids = numpy.asarray(bunch_ids)
+		if len(self.ids) == 0:
+			index = numpy.zeros(len(bunch_ids), int)
+			missing = numpy.ones(len(bunch_ids), bool)
+		else:
+			order = numpy.argsort(self.ids, kind="stable")
+			index = order[numpy.minimum(numpy.searchsorted(self.ids, bunch_ids, sorter=order), len(order) - 1)]
+			missing = self.ids[index] != bunch_ids
+		if missing.any():
+			raise ValueError("Bunch IDs %s are not in the history's IDs. Create the history with ids=bunch.get_ids(), or pass ids to record() giving the index of each particle in the history" % bunch_ids[missing][:5])
+		return index
+
+	def get_turn(self, turn, drop_lost=True):
+		"""Returns a :py:class:`Bunch` with the particles at turn. If drop_lost is False all particles are returned, and the Bunch coords are a view into the history (changes will be written back), otherwise only the particles alive on that turn are returned. The Bunch IDs are the history's IDs, by default the particle index.
+		"""
+		particles = self.coords[turn]
+		ids = self.ids.copy()
+		if drop_lost and not self.alive_mask[turn].all():
+			particles = particles[self.alive_mask[turn]]
+			ids = ids[self.alive_mask[turn]]
+		return Bunch(rigidity=self.rigidity, mass=self.mass, charge=self.charge, particles=particles, ids=ids)
+
+	def get_particle(self, pid):
+		"Returns a structured array with the coordinates of particle pid on each turn. This is a view into the history, not a copy"
+		return self.coords[:, pid]
+
+	def coord(self, name):
+		"""Returns a (nturns, nparticles) array of one coordinate, eg 'Y'. This is a view into the history, not a copy. Values are not meaningful where the particle was not alive, so combine with :py:meth:`alive`::
+
+			ys = numpy.ma.masked_array(history.coord('Y'), ~history.alive())
+
+		"""
+		return self.coords[name]
+
+	def alive(self):
+		"Returns the (nturns, nparticles) boolean mask that is true where a particle was recorded"
+		return self.alive_mask
+
+	def lost_turn(self):
+		"Returns an array with the first turn on which each particle was not recorded, or -1 if the particle survived all turns"
+		lost = ~self.alive_mask
+		first_lost = lost.argmax(axis=0)
+		first_lost[~lost.any(axis=0)] = -1
+		return first_lost
+
+	def flush(self):
+		"Write any changes to disk, if memory mapped"
+		if hasattr(self.coords, "flush"):
+			self.coords.flush()
+			self.alive_mask.flush()
+
+	@staticmethod
+	def from_fai(all_c, end_label=None, mass=0, charge=1, fname=None):
+		"""Build a history from the data read from a fai file, e.g. with :py:meth:`zgoubi.core.Results.get_all`. Rows are placed by PASS and particle ID. As with :py:meth:`zgoubi.core.Results.get_bunch`, end_label can be used to only select the records from a MARKER with that label::
+
+			history = BunchHistory.from_fai(res.get_all('fai'), end_label="trackbun", mass=PROTON_MASS, charge=1)
+
+		"""
+		if end_label:
+			all_c = all_c[numpy.char.strip(all_c['element_label1']) == end_label.strip()]
+		if all_c.size == 0:
+			zlog.warn("No records in fai data. returning empty history")
+			return BunchHistory(0, 0, mass=mass, charge=charge, fname=fname)
+
+		turns = all_c['PASS'] - 1
+		ids = all_c['ID'] - 1
+		history = BunchHistory(turns.max()+1, ids.max()+1, rigidity=all_c[0]['BORO']/1000, mass=mass, charge=charge, fname=fname)
+		alive = all_c['IEX'] == 1
+		turns, ids, all_c = turns[alive], ids[alive], all_c[alive]
+
+		# convert to SI, as in Results.get_bunch()
+		history.coords['Y'][turns, ids] = all_c['Y'] /100
+		history.coords['T'][turns, ids] = all_c['T'] /1000
+		history.coords['Z'][turns, ids] = all_c['Z'] /100
+		history.coords['P'][turns, ids] = all_c['P'] /1000
+		history.coords['S'][turns, ids] = all_c['S'] /100
+		history.coords['D'][turns, ids] = all_c['D-1'] +1
+		history.alive_mask[turns, ids] = True
+		return history
@@ -20,6 +20,53 @@ def mkdir_p(path):
 		else:
 			raise
 
+def lazy_import(name):
+	"""Import a module, but only load it when one of its attributes is first used. Keeps the startup of pyzgoubi fast for modules that are not always needed::
+
+		gcp = lazy_import("zgoubi.gcp")
+
+	"""
+	import sys
+	import importlib.util
+	try:
+		return sys.modules[name]
+	except KeyError:
+		pass
+	spec = importlib.util.find_spec(name)
+	if spec is None:
+		raise ImportError("No module named %s" % name)
+	loader = importlib.util.LazyLoader(spec.loader)
+	spec.loader = loader
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[name] = module
+	loader.exec_module(module)
+	parent, dummy, child = name.rpartition(".")
+	if parent:
+		setattr(sys.modules[parent], child, module)
+	return module
+
+_file_hashes = {}
+
+def file_hash(path):
+	"""md5 hex digest of a file's contents. Kept until the file's size or modification time changes.
+	A missing file gives the digest of its name, so that it can be created later"""
+	import hashlib
+	try:
+		st = os.stat(path)
+	except OSError:
+		return hashlib.md5(("missing " + path).encode("utf-8")).hexdigest()
+	key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+	try:
+		return _file_hashes[key]
+	except KeyError:
+		pass
+	md5 = hashlib.md5()
+	with open(path, "rb") as fh:
+		for block in iter(lambda: fh.read(1 << 20), b""):
+			md5.update(block)
+	_file_hashes[key] = md5.hexdigest()
+	return _file_hashes[key]
+
 def open_file_or_name(forn, mode="r", mkdir=False):
 	"""Pass either a filename or file handle like object. Returns a file like object
 
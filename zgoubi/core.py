@@ -34,6 +34,8 @@ import re
 import struct
 from glob import glob
 import copy
+import hashlib
+import itertools
 import threading
 import queue
 import subprocess
@@ -69,6 +71,31 @@ zlog.setLevel(zgoubi_settings['log_level'])
 
 sys.setcheckinterval(10000)
 
+# elements that act the same on every pass, so that a Line made of them can be compressed with run(compress=True) into one cell and a REBELOTE
+# any other element stops compression, as those such as CAVITE, SCALING and REBELOTE depend on the pass number, so would see a REBELOTE pass as a turn rather than a cell
+compress_allowed_types = ["OBJET", "MCOBJET", "PARTICUL", "OPTIONS", "DRIFT", "ESL", "BEND", "MULTIPOL", "QUADRUPO", "DIPOLE", "DIPOLES", "FFAG", "TOSCA", "POLARMES", "YMY", "CHANGREF", "CHAMBR", "MARKER", "FAISCNL", "FAISCEAU", "SPNPRT", "SPNPRNL", "ORDRE", "END"]
+# elements that may come between the OBJET and the repeated cells of a compressed Line
+compress_head_types = ["PARTICUL", "OPTIONS"]
+
+def _z_array(seq):
+	"z[i] is the length of the longest common prefix of seq and seq[i:]"
+	n = len(seq)
+	z = [0] * n
+	if n:
+		z[0] = n
+	left, right = 0, 0
+	for i in range(1, n):
+		if i < right:
+			z[i] = min(right - i, z[i - left])
+		while i + z[i] < n and seq[z[i]] == seq[i + z[i]]:
+			z[i] += 1
+		if i + z[i] > right:
+			left, right = i, i + z[i]
+	return z
+
+# every change to a Line gets a new number, so a set of versions identifies the state of a tree of lines
+_line_versions = itertools.count()
+
 zgoubi_module_path = os.path.dirname(os.path.realpath(__file__))
 # something like
 # $PREFIX/lib/python2.6/site-packages/zgoubi
@@ -108,11 +135,27 @@ def read_n_lines(fh, n):
 		lines.append(fh.readline())
 	return lines
 
-
-
-try:
-	test_element = BEND()
-except NameError:
+def _track_bunch_mp_worker(task):
+	"Run by the worker processes of Line.track_bunch_mp(). Tracks one slice of the shared input bunch, and writes the survivors to the same offset in the shared output bunch"
+	line_output, in_name, out_name, nparticles, offset, length, rigidity, mass, charge, binary, ids, kwargs = task
+	in_bunch = zgoubi.bunch.Bunch.attach_shared_memory(in_name, nparticles, offset, length, rigidity=rigidity, mass=mass, charge=charge)
+	in_bunch.ids = ids
+	out_bunch = zgoubi.bunch.Bunch.attach_shared_memory(out_name, nparticles, offset, length, rigidity=rigidity, mass=mass, charge=charge)
+	try:
+		work_line = Line("mp_worker")
+		work_line.add(FAKE_ELEM(line_output))
+		done_bunch = work_line.track_bunch(in_bunch, binary=binary, **kwargs)
+		n_done = len(done_bunch)
+		out_bunch.particles()[:n_done] = done_bunch.particles()
+		done_ids, done_losses = done_bunch.get_ids(), done_bunch.get_losses()
+		del done_bunch
+	finally:
+		in_bunch.close_shared_memory(keep_data=False)
+		out_bunch.close_shared_memory(keep_data=False)
+	return offset, n_done, done_ids, done_losses
+
+
+if not zgoubi.elements.element_definitions:
 	zlog.error("Elements did not load correctly")
 	path_info = " zgoubi_module_path: %s\nzgoubi_path: %s\npyzgoubi_egg_path: %s" % (zgoubi_module_path, zgoubi_path, pyzgoubi_egg_path)
 	zlog.error(path_info)
@@ -134,11 +177,34 @@ class Line(object):
 		self.has_run = False
 		self.full_line = False # has an OBJET, dont allow full lines to be added to each other
 								# only a full line outputs its name into zgoubi.dat
+		self._dat_cache = None # last rendered zgoubi.dat, see _render_dat()
+		self._version = next(_line_versions)
+		self._index = None # see _line_index()
+		self._lookup = None # see _flat_lookup()
+		self._parents = weakref.WeakSet() # lines that have this line in their index
+		self._loop_element = None # REBELOTE used by run(compress=True)
+
+	def __getstate__(self):
+		"For pickling, the indexes are left out"
+		state = self.__dict__.copy()
+		for key in ['_dat_cache', '_index', '_lookup', '_parents', '_loop_element']:
+			state.pop(key, None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._dat_cache = None
+		self._version = next(_line_versions)
+		self._index = None
+		self._lookup = None
+		self._parents = weakref.WeakSet()
+		self._loop_element = None
 
 	def __copy__(self):
 		"A shallow copy, contains the same elements"
 		new_line = type(self)(self.name)
 		new_line.element_list = copy.copy(self.element_list)
+		new_line.changed()
 		new_line.no_more_xterm = self.no_more_xterm
 		new_line.input_files = self.input_files
 		new_line.full_line = self.full_line
@@ -148,6 +214,7 @@ class Line(object):
 		"A deep copy, contains the copies of elements"
 		new_line = type(self)(self.name)
 		new_line.element_list = copy.deepcopy(self.element_list, memo)
+		new_line.changed()
 		new_line.no_more_xterm = self.no_more_xterm
 		new_line.input_files = self.input_files
 		new_line.full_line = self.full_line
@@ -158,6 +225,7 @@ class Line(object):
 		new_line = copy.copy(self)
 		new_line.element_list = copy.deepcopy(new_line.element_list)
 		new_line.element_list.reverse()
+		new_line.changed()
 		for e in new_line.element_list:
 			e.reverse()
 		new_line.name = "-"+self.name
@@ -212,6 +280,7 @@ class Line(object):
 
 	def add(self, *elements):
 		"Add an elements to the line. Can also be used to add one line into another."
+		self.changed()
 		for element in elements:
 			self.element_list.append(element)
 			try:
@@ -222,6 +291,28 @@ class Line(object):
 			if hasattr(element, "input_files"):
 				self.add_input_files(element.input_files)
 	
+	def content_hash(self, _memo=None):
+		"""A hash of the line contents: the hashes of its elements and sub lines, and the contents of its input files. Lines with the same hash give the same zgoubi input, so it can be used as a key for caching results.
+		Elements keep their hash until they are changed, so this is much faster than hashing output()."""
+		if _memo is None:
+			_memo = {}
+		try:
+			return _memo[id(self)]
+		except KeyError:
+			pass
+		md5 = hashlib.md5(b"Line")
+		if self.full_line:
+			md5.update(self.name.encode("utf-8"))
+		for element in self.element_list:
+			if isinstance(element, Line):
+				md5.update(element.content_hash(_memo).encode("utf-8"))
+			else:
+				md5.update(element.content_hash().encode("utf-8"))
+		for input_file in self.input_files:
+			md5.update(file_hash(input_file).encode("utf-8"))
+		_memo[id(self)] = md5.hexdigest()
+		return _memo[id(self)]
+
 	def check_line(self):
 		"Check that line has OBJET or MCOBJET at the start, and an END at the end. Gives warnings otherwise. Called by run() if in debug mode."
 		has_end = False
@@ -311,23 +402,138 @@ class Line(object):
 	def remove_looping(self):
 		"removes any REBELOTE elements from the line"
 		self.element_list = [element for element in self.element_list if ("REBELOTE" not in str(type(element)).split("'")[1])]
+		self.changed()
 				
 		
-	def output(self):
-		"Generate the zgoubi.dat file, and return it as a string"
-		out = ""
+	def output(self, compress=False):
+		"Generate the zgoubi.dat file, and return it as a string. See run() for compress"
+		return self._render_dat(self._dat_pieces(compress)[0]).decode("utf-8")
+
+	def _dat_pieces(self, compress=False):
+		"""The output pieces, and the compression (as given by _compress_pieces()) or None"""
+		pieces = list(self._output_pieces())
+		if not compress:
+			return pieces, None
+		return self._compress_pieces(pieces)
+
+	def _compress_pieces(self, pieces):
+		"""Look for a run of identical periods straight after the OBJET, and replace it with a single period and a REBELOTE (K=99) that repeats it.
+		Elements are only considered identical if they are the same instance, as they are when made with * or by adding the same sub line several times.
+		Returns the new pieces, and a dict with the number of elements in the head (up to the period), in the period, and the number of repeats. If the line can not be compressed the pieces are returned unchanged, with None.
+		"""
+		elements = [p for p in pieces if not isinstance(p, str)]
+		not_allowed = set(getattr(e, "_zgoubi_name", None) for e in elements) - set(compress_allowed_types)
+		if not_allowed:
+			zlog.debug("Line contains %s, not in compress_allowed_types, not compressing", sorted(not_allowed, key=str))
+			return pieces, None
+
+		# head: OBJET and elements that are safe to pass through again on each REBELOTE pass
+		start = 0
+		n_head = 0
+		has_objet = False
+		for piece in pieces:
+			if not isinstance(piece, str):
+				name = getattr(piece, "_zgoubi_name", "")
+				if 'OBJET' in name:
+					has_objet = True
+				elif name not in compress_head_types:
+					break
+				n_head += 1
+			start += 1
+		if not has_objet:
+			zlog.debug("Line has no OBJET, not compressing")
+			return pieces, None
+
+		# find the period that covers the most of the rest of the line
+		key_ids = {}
+		keys = [key_ids.setdefault(p if isinstance(p, str) else id(p), len(key_ids)) for p in pieces[start:]]
+		z = _z_array(keys)
+		best_repeats, best_period = 0, 0
+		for period in range(1, len(keys)//2 + 1):
+			repeats = (period + z[period]) // period
+			if repeats >= 2 and repeats * period > best_repeats * best_period:
+				best_repeats, best_period = repeats, period
+		period_pieces = pieces[start:start+best_period]
+		n_period = len([p for p in period_pieces if not isinstance(p, str)])
+		if n_period == 0 or any('OBJET' in getattr(p, "_zgoubi_name", "") for p in period_pieces if not isinstance(p, str)):
+			zlog.debug("No repeated periods found, not compressing")
+			return pieces, None
+
+		if self._loop_element is None:
+			self._loop_element = REBELOTE(K=99, KWRIT=1)
+		self._loop_element.set(NPASS=best_repeats - 1)
+		zlog.debug("Compressing %s repeats of a %s element period", best_repeats, n_period)
+		new_pieces = pieces[:start+best_period] + [self._loop_element] + pieces[start+best_repeats*best_period:]
+		return new_pieces, dict(head=n_head, period=n_period, repeats=best_repeats)
+
+	def _output_pieces(self):
+		"The pieces of output() in order, either elements or fixed strings. Sub lines are flattened"
 		if self.full_line:
-			out = self.name + "\n"
-		
+			yield self.name + "\n"
 		for element in self.element_list:
-			out += element.output() + "\n"
-		
-		return out
+			if isinstance(element, Line):
+				for piece in element._output_pieces():
+					yield piece
+				yield "\n"
+			else:
+				yield element
+
+	def _render_dat(self, pieces=None):
+		"""Render zgoubi.dat as bytes, from pieces if given, otherwise from _output_pieces().
+		The last rendering is kept, along with the byte span of each element in it, and a snapshot of the element state. On the next call only elements that have changed are rendered again, and patched into the kept buffer. If their length changes, or elements were added or removed, the buffer is rebuilt.
+		"""
+		if pieces is None:
+			pieces = list(self._output_pieces())
+		cache = self._dat_cache
+		if cache is not None and len(cache['pieces']) == len(pieces) and all(
+		              p is cp or (isinstance(p, str) and p == cp) for p, cp in zip(pieces, cache['pieces'])):
+			texts, states, spans, buf = cache['texts'], cache['states'], cache['spans'], cache['buf']
+			rebuild = False
+		else:
+			texts = [None] * len(pieces)
+			states = [None] * len(pieces)
+			spans = [None] * len(pieces)
+			buf = None
+			rebuild = True
+
+		rendered = {} # elements may appear several times, only render once
+		for n, piece in enumerate(pieces):
+			if isinstance(piece, str):
+				if texts[n] is None:
+					texts[n] = piece.encode("utf-8")
+				continue
+			state = piece._output_state()
+			if state is not None and texts[n] is not None and state == states[n]:
+				continue
+			try:
+				text = rendered[id(piece)]
+			except KeyError:
+				text = (piece.output() + "\n").encode("utf-8")
+				rendered[id(piece)] = text
+			states[n] = state
+			if text == texts[n]:
+				continue
+			texts[n] = text
+			if not rebuild and len(text) == spans[n][1] - spans[n][0]:
+				buf[spans[n][0]:spans[n][1]] = text
+			else:
+				rebuild = True
+
+		if rebuild:
+			buf = bytearray(b"".join(texts))
+			pos = 0
+			for n, text in enumerate(texts):
+				spans[n] = (pos, pos + len(text))
+				pos += len(text)
+
+		self._dat_cache = dict(pieces=pieces, texts=texts, states=states, spans=spans, buf=buf)
+		return bytes(buf)
 
 		
-	def run(self, xterm=False, tmp_prefix=zgoubi_settings['tmp_dir'], silence=False, timer=False):
+	def run(self, xterm=False, tmp_prefix=zgoubi_settings['tmp_dir'], silence=False, timer=False, compress=False):
 		"""Run zgoubi on line.
 		If xterm is true, stop after running zgoubi, and open an xterm for the user in the tmp dir. From here zpop can be run.
+		If compress is true, and the line is made of repeated cells (e.g. 42 * cell), only one cell is written to zgoubi.dat, followed by a REBELOTE to repeat it. Lines are only compressed if all their elements are in compress_allowed_types, those that act the same on every pass, so lines with a REBELOTE, CAVITE or SCALING are not. The fai and plt data from the Results are re-numbered, so that NOEL and PASS are as they would be for the uncompressed line.
 		Returns a :py:class:`Results` object
 		"""
 		if timer: t0 = time.time()
@@ -358,8 +564,9 @@ class Line(object):
 			if hasattr(element, "setup"):
 				element.setup(tmpdir)
 		
-		infile = open(tmpdir+"/zgoubi.dat", 'w')
-		infile.write(self.output())
+		pieces, compression = self._dat_pieces(compress)
+		infile = open(tmpdir+"/zgoubi.dat", 'wb')
+		infile.write(self._render_dat(pieces))
 		infile.close()
 
 		command = zgoubi_settings['zgoubi_path']
@@ -407,7 +614,7 @@ class Line(object):
 		
 		element_types = [str(type(element)).split("'")[1].rpartition(".")[2] for element in self.elements()]
 		self.has_run = True	
-		result = Results(line=self, rundir=tmpdir, element_types=element_types)
+		result = Results(line=self, rundir=tmpdir, element_types=element_types, compression=compression)
 		self.results.append(weakref.ref(result))
 		self.last_result = result
 		if timer:
@@ -416,8 +623,10 @@ class Line(object):
 
 		return result
 	
-	def track_bunch(self, bunch, binary=False, keep_result=False, **kwargs):
-		"Track a bunch through a Line, and return the bunch. This function will uses the OBJET_bunch object, and so need needs a Line that does not already have a OBJET. If binary is true then particles are sent to zgoubi in binary (needs a version of zgoubi that supports this)"
+	def track_bunch(self, bunch, binary=False, keep_result=False, track_ids=False, **kwargs):
+		"""Track a bunch through a Line, and return the bunch. This function will uses the OBJET_bunch object, and so need needs a Line that does not already have a OBJET. If binary is true then particles are sent to zgoubi in binary (needs a version of zgoubi that supports this)
+		If track_ids is true, or the bunch already has IDs (see Bunch.set_ids()), the returned bunch has the IDs of the surviving particles, and the losses array has a record of the particles lost, added to any losses already in the bunch.
+		"""
 		if self.full_line:
 			raise BadLineError("If line already has an OBJET use run()")
 
@@ -435,11 +644,17 @@ class Line(object):
 		new_line.add(FAISCNL(FNAME='b_zgoubi.fai'))
 		new_line.add(END())
 
+		ids = bunch.get_ids()
+		if ids is None and track_ids:
+			ids = numpy.arange(bunch_len, dtype=numpy.int32)
+
 		# run the line
 		result = new_line.run(**kwargs)
 		del new_line
 		# return the track bunch
-		done_bunch = result.get_bunch('bfai', end_label="trackbun", old_bunch=bunch)
+		done_bunch = result.get_bunch('bfai', end_label="trackbun", old_bunch=bunch, ids=ids)
+		if ids is not None and len(bunch.get_losses()):
+			done_bunch.losses = numpy.concatenate([bunch.get_losses(), done_bunch.get_losses()])
 		done_bunch_len = len(done_bunch)
 		if bunch_len != done_bunch_len:
 			zlog.warn("Started with %s particles, finished with %s", bunch_len, done_bunch_len)
@@ -451,7 +666,7 @@ class Line(object):
 			result.clean()
 		return done_bunch
 		
-	def track_bunch_mt(self, bunch, n_threads=4, max_particles=None, binary=False, **kwargs):
+	def track_bunch_mt(self, bunch, n_threads=4, max_particles=None, binary=False, track_ids=False, **kwargs):
 		"This function should be used identically to the track_bunch function, apart from the addition of the n_threads argument. This will split the bunch into several slices and run them simultaneously. Set n_threads to the number of CPU cores that you have. max_particle can be set to limit how many particles are sent at a time."
 		in_q = queue.Queue()
 		out_q = queue.Queue()
@@ -476,7 +691,7 @@ class Line(object):
 					zlog.error("Exception in track_bunch() thread")
 					out_q.put((sys.exc_info()))
 				else:
-					out_q.put((start_index, done_bunch.particles()))
+					out_q.put((start_index, done_bunch))
 				in_q.task_done()
 				#print "Thread", name, "task done"
 
@@ -485,6 +700,11 @@ class Line(object):
 		new_line = Line(self.name)
 		new_line.add(FAKE_ELEM(line_output))
 
+		if track_ids and bunch.get_ids() is None:
+			# a shallow copy with IDs, so that the users bunch is left alone
+			bunch = zgoubi.bunch.Bunch(rigidity=bunch.get_bunch_rigidity(), mass=bunch.mass, charge=bunch.charge, particles=bunch.particles())
+			bunch.set_ids()
+
 		stop_flag = threading.Event()
 		for thread_n in range(n_threads):
 			t = threading.Thread(target=worker,
@@ -506,10 +726,8 @@ class Line(object):
 		#in_q.join()
 		#print "Work done"
 
-		final_bunch = zgoubi.bunch.Bunch(nparticles=len(bunch), rigidity=bunch.get_bunch_rigidity(), mass=bunch.mass, charge=bunch.charge)
-		survive_particles = numpy.zeros(len(bunch), dtype=numpy.bool) # bit map, set true when filling with particles
-
-		# workers may return out of order, so use start_index to put the coords in the correct place
+		# workers may return out of order, so use start_index to put the slices back in order
+		done_slices = {}
 		for x in range(n_tasks):
 			#print "collecting task", x
 			result = out_q.get()
@@ -526,11 +744,17 @@ class Line(object):
 				#reraise error message
 				raise result[0](result[1])
 			out_q.task_done()
-			final_bunch.particles()[start_index:start_index+len(done_bunch)] = done_bunch
-			survive_particles[start_index:start_index+len(done_bunch)] = True
+			done_slices[start_index] = done_bunch
 
-		if not numpy.all(survive_particles):
-			final_bunch.coords = final_bunch.particles()[survive_particles]
+		# join the surviving particles, ids and losses in one go
+		done_slices = [done_slices[k] for k in sorted(done_slices.keys())]
+		final_bunch = zgoubi.bunch.Bunch(rigidity=bunch.get_bunch_rigidity(), mass=bunch.mass, charge=bunch.charge,
+		                                 particles=numpy.concatenate([b.particles() for b in done_slices]))
+		if bunch.get_ids() is not None:
+			final_bunch.ids = numpy.concatenate([b.get_ids() for b in done_slices])
+			final_bunch.losses = numpy.concatenate([bunch.get_losses()] + [b.get_losses() for b in done_slices])
+
+		if len(final_bunch) != len(bunch):
 			zlog.warn("Started with %s particles, finished with %s", len(bunch), len(final_bunch))
 
 
@@ -538,6 +762,64 @@ class Line(object):
 		stop_flag.set()
 		return final_bunch
 
+	def track_bunch_mp(self, bunch, n_procs=4, max_particles=None, binary=False, track_ids=False, **kwargs):
+		"""Like track_bunch_mt(), but uses worker processes rather than threads. The bunch is placed in shared memory, and each worker is only sent the (offset, length) of its slice. The workers write the tracked particles straight into a shared output bunch, so no coordinates are pickled (only the integer IDs and losses, if tracked). Requires Python 3.8 or newer."""
+		import multiprocessing
+		if max_particles is None:
+			max_particles = 1e3
+
+		bunch_len = len(bunch)
+		if bunch_len == 0:
+			zlog.error("Bunch has zero particles")
+			raise ValueError
+		rigidity = bunch.get_bunch_rigidity()
+		ids = bunch.get_ids()
+		if ids is None and track_ids:
+			ids = numpy.arange(bunch_len, dtype=numpy.int32)
+
+		# pre process line output, so it does not have to be done in each process
+		line_output = self.output()
+
+		# shared copies, so that the users bunch is left alone
+		in_bunch = zgoubi.bunch.Bunch(rigidity=rigidity, mass=bunch.mass, charge=bunch.charge, particles=bunch.particles())
+		out_bunch = zgoubi.bunch.Bunch(nparticles=bunch_len, rigidity=rigidity, mass=bunch.mass, charge=bunch.charge)
+		in_name = in_bunch.to_shared_memory()
+		try:
+			out_name = out_bunch.to_shared_memory()
+			try:
+				tasks = [(line_output, in_name, out_name, bunch_len, offset, length, rigidity, bunch.mass, bunch.charge, binary,
+				          None if ids is None else ids[offset:offset+length], kwargs)
+				         for offset, length in in_bunch.shared_slices(max_particles=max_particles, n_slices=n_procs)]
+				survive_particles = numpy.zeros(bunch_len, dtype=bool) # bit map, set true when filling with particles
+				if ids is not None:
+					out_ids = numpy.zeros(bunch_len, dtype=ids.dtype)
+					losses = [bunch.get_losses()]
+				pool = multiprocessing.Pool(n_procs)
+				try:
+					# workers may return out of order, they report where they wrote to
+					for offset, n_done, done_ids, done_losses in pool.imap_unordered(_track_bunch_mp_worker, tasks):
+						survive_particles[offset:offset+n_done] = True
+						if ids is not None:
+							out_ids[offset:offset+n_done] = done_ids
+							losses.append(done_losses)
+				finally:
+					pool.terminate()
+					pool.join()
+			finally:
+				out_bunch.close_shared_memory(unlink=True)
+		finally:
+			in_bunch.close_shared_memory(unlink=True, keep_data=False)
+
+		if ids is not None:
+			out_bunch.ids = out_ids
+			out_bunch.losses = numpy.concatenate(losses)
+		if not numpy.all(survive_particles):
+			out_bunch.coords = out_bunch.particles()[survive_particles]
+			if ids is not None:
+				out_bunch.ids = out_ids[survive_particles]
+			zlog.warn("Started with %s particles, finished with %s", bunch_len, len(out_bunch))
+		return out_bunch
+
 	def clean(self):
 		"clean up temp directories"
 		for result in self.results:
@@ -578,25 +860,104 @@ class Line(object):
 		self.input_files += file_paths
 	
 
+	def changed(self):
+		"""Mark the line as changed, so that its indexes are rebuilt. The Line methods do this themselves, call it after changing element_list directly or changing the labels of elements already in the line."""
+		self._version = next(_line_versions)
+		self._index = None
+		for parent in list(self._parents):
+			parent.changed()
+
+	def _line_index(self):
+		"""Index of this line's element_list, as a dict with:
+		ends: flat position just after each entry, with sub lines counting as their length
+		subs: (position, sub line, length) for each sub line
+		Rebuilt when needed. Sub lines are told about this line, so that they can update or drop its index when they change.
+		"""
+		if self._index is not None:
+			return self._index
+		lens = numpy.ones(len(self.element_list), dtype=numpy.int64)
+		subs = []
+		for pos, element in enumerate(self.element_list):
+			if isinstance(element, Line):
+				lens[pos] = element._flat_len()
+				subs.append((pos, element, int(lens[pos])))
+				element._parents.add(self)
+		self._index = dict(ends=numpy.cumsum(lens), subs=subs)
+		return self._index
+
+	def _flat_len(self):
+		"Number of elements in line, including sub lines"
+		ends = self._line_index()['ends']
+		return int(ends[-1]) if len(ends) else 0
+
+	def _set_index(self, ends, subs, n_added):
+		"Store an updated index, and pass on the change in length to the parent lines"
+		self._version = next(_line_versions)
+		self._index = dict(ends=ends, subs=subs)
+		for parent in list(self._parents):
+			parent._sub_resized(self, n_added)
+
+	def _index_changed(self, pos, n_added):
+		"""Update the index of this line after n_added elements (negative for removed, 0 for replaced) were inserted into element_list at pos, rather than rebuilding it.
+		Only valid if the index was current before the change, and the elements are not sub lines."""
+		index = self._index
+		ends = index['ends']
+		before = ends[pos-1] if pos > 0 else 0
+		if n_added > 0:
+			ends = numpy.concatenate([ends[:pos], before + numpy.arange(1, n_added+1), ends[pos:] + n_added])
+		elif n_added < 0:
+			ends = numpy.concatenate([ends[:pos], ends[pos-n_added:] + n_added])
+		subs = [(p + n_added if p >= pos else p, sub, sub_len) for p, sub, sub_len in index['subs']]
+		self._set_index(ends, subs, n_added)
+
+	def _sub_resized(self, sub, n_added):
+		"Update the index of this line after sub line sub gained n_added elements"
+		index = self._index
+		if index is None:
+			self.changed()
+			return
+		ends = index['ends'].copy()
+		subs = []
+		n_found = 0
+		for pos, s, s_len in index['subs']:
+			if s is sub:
+				ends[pos:] += n_added
+				s_len += n_added
+				n_found += 1
+			subs.append((pos, s, s_len))
+		self._set_index(ends, subs, n_added * n_found)
+
+	def _flat_lookup(self):
+		"""Positions of each element in the flat line, by element identity and by label1.
+		Rebuilt after this line or any sub line is changed."""
+		lookup = self._lookup
+		if lookup is not None and lookup['version'] == self._version:
+			return lookup
+		self._line_index() # so that sub lines will report changes
+		by_id = {}
+		by_label = {}
+		for n, e in enumerate(self.elements()):
+			by_id.setdefault(id(e), []).append(n)
+			by_label.setdefault(getattr(e, "label1", None), []).append(n)
+		self._lookup = dict(version=self._version, by_id=by_id, by_label=by_label)
+		return self._lookup
+
 	def _find_by_index(self, index):
-		"""Iterate through sub lines to find element as if indexed in a flat list
+		"""Find element as if indexed in a flat list, by bisecting the index of each sub line
 		returns [line, index_in_line]"""
-		stack = [[self, -1]]
-		for n in range(index+1):
-			if stack[-1][1]+1 >= len(stack[-1][0].element_list):
-				# step back up
-				stack.pop()
-				if len(stack) == 0:
-					raise ValueError("Index %s out of range"%index)
-
-			# step along
-			stack[-1][1] += 1
-
-			if isinstance(stack[-1][0].element_list[stack[-1][1]], Line):
-				# step in
-				stack.append([stack[-1][0].element_list[stack[-1][1]], 0])
-		return  stack[-1]
-		
+		line = self
+		offset = index
+		while True:
+			ends = line._line_index()['ends']
+			if offset < 0 or len(ends) == 0 or offset >= ends[-1]:
+				raise ValueError("Index %s out of range"%index)
+			pos = int(numpy.searchsorted(ends, offset, side='right'))
+			if not isinstance(line.element_list[pos], Line):
+				return [line, pos]
+			if pos > 0:
+				offset -= int(ends[pos-1])
+			line = line.element_list[pos]
+
 	def replace(self, elementold, elementnew, select_index=0):
 		"""Replace an element in the line. setting select_index to n will replace the nth occurence of that item. If select index is not set, the first occurence is replaced.
 		
@@ -610,15 +971,23 @@ class Line(object):
 		index = indices[select_index]
 		subline, pos = self._find_by_index(index)
 		subline.element_list[pos] = elementnew
+		if isinstance(elementnew, Line):
+			subline.changed()
+		else:
+			subline._index_changed(pos, 0)
 
 	def insert(self, index, *elements):
 		"Insert elements into the line before position given by index, treats sub lines as linear list"
 		subline, pos = self._find_by_index(index)
-		for element in elements:
-			subline.element_list.insert(pos, element)
+		subline.element_list[pos:pos] = reversed(elements) # as if inserted one at a time
+		if any(isinstance(element, Line) for element in elements):
+			subline.changed()
+		else:
+			subline._index_changed(pos, len(elements))
 
 	def prepend(self, *elements):
 		"Add a elements to the start of the line"
+		self.changed()
 		for element in elements:
 			self.element_list.insert(0, element)
 
@@ -632,16 +1001,16 @@ class Line(object):
 		"Remove element at index, treats sub lines as linear list"
 		subline, pos = self._find_by_index(index)
 		subline.element_list.pop(pos)
+		subline._index_changed(pos, -1)
 
 
 	def find_elements(self, element):
 		"Returns all the positions of element in line, treats sub lines as linear list"
-		indices = []
-		for n, e in enumerate(self.elements()):
-			if e is element:
-				indices.append(n)
+		return list(self._flat_lookup()['by_id'].get(id(element), []))
 
-		return indices
+	def find_labels(self, label1):
+		"Returns all the positions of elements with the given label1 in line, treats sub lines as linear list"
+		return list(self._flat_lookup()['by_label'].get(label1, []))
 	
 	def get_objet(self):
 		"Find the OBJET element"
@@ -657,10 +1026,11 @@ class Results(object):
 	It is created automatically and returned by :py:meth:`Line.run()`
 
 	"""
-	def __init__(self, line=None, rundir=None, element_types=None):
+	def __init__(self, line=None, rundir=None, element_types=None, compression=None):
 		#self.line = line
 		self.rundir = rundir
 		self.element_types = element_types
+		self.compression = compression # set if the line was run with compress=True, see Line.run()
 		self.shutil = shutil # need to keep a reference to shutil
 
 	def clean(self):
@@ -786,9 +1156,22 @@ class Results(object):
 
 	def get_all_bin(self, file='bplt'):
 		if file == 'bplt':
-			return io.read_file(os.path.join(self.rundir, 'b_zgoubi.plt'))
+			return self._expand_numbering(io.read_file(os.path.join(self.rundir, 'b_zgoubi.plt')))
 		elif file == 'bfai':
-			return io.read_file(os.path.join(self.rundir, 'b_zgoubi.fai'))
+			return self._expand_numbering(io.read_file(os.path.join(self.rundir, 'b_zgoubi.fai')))
+
+	def _expand_numbering(self, data):
+		"""If the line was run compressed, change NOEL and PASS in data to what they would have been for the uncompressed line"""
+		if self.compression is None or not isinstance(data, numpy.ndarray) or data.dtype.names is None or 'NOEL' not in data.dtype.names:
+			return data
+		head, period, repeats = self.compression['head'], self.compression['period'], self.compression['repeats']
+		noel = data['NOEL']
+		in_period = (noel > head) & (noel <= head + period)
+		after = noel > head + period
+		noel[in_period] += (data['PASS'][in_period] - 1) * period
+		noel[after] += (repeats - 1) * period - 1 # also the REBELOTE is gone
+		data['PASS'] = 1
+		return data
 
 	def get_all(self, file='plt'):
 		"""Read all the data out of the file.
@@ -808,9 +1191,9 @@ class Results(object):
 			return self.get_all_bin(file=file)
 		else:
 			#open previously saved file
-			fh = open(file)
+			return io.read_file(open(file))
 
-		return io.read_file(fh)
+		return self._expand_numbering(io.read_file(fh))
 
 
 	def get_track(self, file, coord_list, multi_list=None):
@@ -900,9 +1283,10 @@ class Results(object):
 
 
 
-	def get_bunch(self, file, end_label=None, old_bunch=None, drop_lost=True):
+	def get_bunch(self, file, end_label=None, old_bunch=None, drop_lost=True, ids=None):
 		""""Get back a bunch object from the fai file. It is recommended that you put a MARKER before the last FAISCNL, and pass its label as end_label, so that only the bunch at the final position will be returned. All but the final lap is ignored automatically.
 		Optionally the an old_bunch can be passed to the function, its mass and charge will be copyed to the new bunch.
+		If ids is given (one per particle, in the order the particles were in the OBJET), the returned bunch will have these set as its IDs, and the lost particles will be recorded in its losses array, with the IEX code, and the NOEL and PASS of the first fai record where zgoubi marked them as lost.
 		"""
 		try:
 			all_c = self.get_all(file)
@@ -912,6 +1296,8 @@ class Results(object):
 			if old_bunch is not None:
 				empty_bunch.mass = old_bunch.mass
 				empty_bunch.charge = old_bunch.charge
+			if ids is not None:
+				empty_bunch.ids = numpy.zeros(0, ids.dtype)
 			return empty_bunch
 		except EmptyFileError:
 			zlog.warn("%s empty. returning empty bunch", file)
@@ -919,9 +1305,22 @@ class Results(object):
 			if old_bunch is not None:
 				empty_bunch.mass = old_bunch.mass
 				empty_bunch.charge = old_bunch.charge
+			if ids is not None:
+				empty_bunch.ids = numpy.zeros(0, ids.dtype)
 			return empty_bunch
 
+		losses = numpy.zeros(0, zgoubi.bunch.Bunch.loss_data_def)
 		loss_sum = self.loss_summary(all_c)
+		if loss_sum and ids is not None:
+			lost_c = all_c[all_c['IEX'] != 1]
+			# first record of each lost particle
+			lost_c = lost_c[numpy.lexsort((lost_c['NOEL'], lost_c['PASS']))]
+			dummy, first_index = numpy.unique(lost_c['ID'], return_index=True)
+			lost_c = lost_c[first_index]
+			losses = numpy.zeros(lost_c.size, zgoubi.bunch.Bunch.loss_data_def)
+			losses['ID'] = ids[lost_c['ID'] - 1]
+			for name in ['IEX', 'NOEL', 'PASS']:
+				losses[name] = lost_c[name]
 		if loss_sum:
 			for k, v in loss_sum.items():
 				zlog.warn("%s particles lost: %s" % (v, k))
@@ -947,7 +1346,10 @@ class Results(object):
 			if old_bunch is not None:
 				empty_bunch.mass = old_bunch.mass
 				empty_bunch.charge = old_bunch.charge
-				return empty_bunch
+			if ids is not None:
+				empty_bunch.ids = numpy.zeros(0, ids.dtype)
+				empty_bunch.losses = losses
+			return empty_bunch
 
 		#print last_lap[:10]['BORO']
 		#print last_lap[:10]['D-1']
@@ -965,6 +1367,9 @@ class Results(object):
 		particles['P'] = last_lap['P'] /1000
 		particles['S'] = last_lap['S'] /100
 		particles['D'] = last_lap['D-1'] +1
+		if ids is not None:
+			last_bunch.ids = ids[last_lap['ID'] - 1]
+			last_bunch.losses = losses
 
 		return last_bunch
 
@@ -21,19 +21,57 @@
 # a base class for all the beam line objects
 
 from __future__ import division, print_function
-import zgoubi_metadata.elements
+import os
+import glob
+import hashlib
+import logging
+import pickle
+import tempfile
 from numbers import Number
+from zgoubi.common import file_hash
 
 __all__ = ["zgoubi_element", "tXPAS", "zgoubi_element_def"]
 
 class zgoubi_element(object):
 	"A base class for zgoubi elements"
+	# content_hash() is kept until the element is changed. Elements that depend on data the element can not watch should set this to False
+	_hash_cacheable = True
+
 	def __init__(self):
 		pass
 
+	def __setattr__(self, name, value):
+		"any change to an attribute also drops the content hash"
+		self.__dict__.pop("_content_hash", None)
+		object.__setattr__(self, name, value)
+
+	def changed(self):
+		"Drop the cached content hash. Called by the element's own methods, call it after changing _params or subelements directly"
+		self.__dict__.pop("_content_hash", None)
+
+	def content_hash(self):
+		"""A hash of the class and contents (labels, parameters, sub-elements and input files) of the element. Elements with the same hash give the same zgoubi input, so it can be used as a key for caching results.
+		It is kept until the element is changed."""
+		digest = self.__dict__.get("_content_hash")
+		if digest is not None:
+			return digest
+		md5 = hashlib.md5(type(self).__name__.encode("utf-8"))
+		self._hash_content(md5)
+		for input_file in getattr(self, "input_files", []):
+			md5.update(file_hash(input_file).encode("utf-8"))
+		digest = md5.hexdigest()
+		if self._hash_cacheable:
+			self.__dict__["_content_hash"] = digest
+		return digest
+
+	def _hash_content(self, md5):
+		"Add the element contents to md5. By default its output() is used"
+		md5.update(self.output().encode("utf-8"))
+
 	def set_param(self, key, val):
 		if key in self._params.keys():
 			self._params[key] = val
+			self.changed()
 		else:
 			raise ValueError("no such param: '" + str(key) + "' In element " + self._zgoubi_name)
 
@@ -97,6 +135,11 @@ class zgoubi_element(object):
 		"Return a list of parameters"
 		return list(self._params)
 
+	def _output_state(self):
+		"""A snapshot of everything output() depends on, used by Line to decide if an element needs rendering again.
+		None means unknown, so the element is always rendered."""
+		return None
+
 	def reverse(self):
 		"Flip the element along the beam line direction, i.e. the entrance and exit properties are swapped"
 		if self._zgoubi_name in  ["DIPOLES", "FFAG"]:
@@ -112,6 +155,7 @@ class zgoubi_element(object):
 				sub_element["THETA_S"] *= -1
 		elif self._zgoubi_name == "CHANGREF":
 			self._params["YCE"] *= -1
+		self.changed()
 
 	def __neg__(self):
 		new_e = copy.deepcopy(self)
@@ -136,31 +180,65 @@ class tXPAS(object):
 		else:
 			return "#{:d}|{:d}|{:d}".format(*self.val)
 
+	def __repr__(self):
+		return "tXPAS(%r)" % (self.val,)
+
 param_type_classes = {"E":float, "I":int, "X":tXPAS, "A80": str}
 
+def _param_type_class(s):
+	try:
+		return param_type_classes[s]
+	except KeyError:
+		pass
+	if s.startswith("A"):
+		return str
+	raise ValueError("Unknown type in definition: %s"%s)
+
+def _def_attrs(cdefs):
+	"The attributes that are the same for every element made from a definition"
+	attrs = dict(cdefs=cdefs,
+	             template=cdefs["template_s"],
+	             _params_types=cdefs["params_types"],
+	             _param_coercers={k:_param_type_class(t) for k, t in cdefs["params_types"].items()},
+	             has_subelements="subelements" in cdefs)
+	if attrs["has_subelements"]:
+		attrs["subelement_template"] = cdefs["subelements"][0]["template_s"]
+		attrs["subelement_params"] = cdefs["subelements"][0]["init_params"]
+		attrs["subelement_params_types"] = cdefs["subelements"][0]["params_types"]
+	return attrs
+
 class zgoubi_element_def(zgoubi_element):
 	def __init__(self, cdefs, label1='', label2='', **settings):
-		self.cdefs = cdefs
+		if getattr(type(self), "_class_defs", None) is not cdefs:
+			# classes from make_zgoubi_element() already have these as class attributes
+			self.__dict__.update(_def_attrs(cdefs))
 		self.label1 = label1
 		self.label2 = label2
-		self.template = self.cdefs["template_s"]
-		self._params = self.cdefs["init_params"].copy()
-		self._params_types = self.cdefs["params_types"]
+		self._params = cdefs["init_params"].copy()
 		self.set(settings)
 
-		self.has_subelements = "subelements" in self.cdefs
 		if self.has_subelements:
 			self.subelements = []
-			self.subelement_template = self.cdefs["subelements"][0]["template_s"]
-			self.subelement_params = self.cdefs["subelements"][0]["init_params"]
-			self.subelement_params_types = self.cdefs["subelements"][0]["params_types"]
 
 	def set_param(self, key, val):
-		if key in self._params.keys():
-			param_type = param_type_classes[self._params_types[key]]
-			self._params[key] = param_type(val)
-		else:
+		try:
+			coerce = self._param_coercers[key]
+		except KeyError:
 			raise ValueError("no such param: '" + str(key) + "' In element " + self._zgoubi_name)
+		self._params[key] = coerce(val)
+		self.changed()
+
+	def _hash_content(self, md5):
+		"The labels, parameters and sub-elements, rather than rendering the output"
+		md5.update(repr((self.label1, self.label2, sorted(self._params.items()))).encode("utf-8"))
+		if self.has_subelements:
+			md5.update(repr([sorted(se.items()) for se in self.subelements]).encode("utf-8"))
+
+	def _output_state(self):
+		"The output only depends on the labels, parameters and sub-elements"
+		if self.has_subelements:
+			return (self.label1, self.label2, dict(self._params), [dict(se) for se in self.subelements])
+		return (self.label1, self.label2, dict(self._params))
 
 	def add(self, **kwargs):
 		if not self.has_subelements:
@@ -172,6 +250,7 @@ class zgoubi_element_def(zgoubi_element):
 			else:
 				raise ValueError("no such param: '" + str(key) + "' in sub element of " + self._zgoubi_name)
 		self.subelements.append(new_sub_params)
+		self.changed()
 
 	def output(self):
 		"Output the element in Zgoubi.dat format"
@@ -234,46 +313,123 @@ def render_template_string(template, params):
 		template_s = template_s[:-1]
 	return template_s
 
+def _param_property(key, coerce):
+	"A property giving direct access to a parameter, eg. my_element.XL"
+	def fget(self):
+		return self._params[key]
+	def fset(self, val):
+		self._params[key] = coerce(val)
+	return property(fget, fset, doc="%s parameter" % key)
+
 def make_zgoubi_element(cname, defs):
 	def init_func(self,*args, **kargs):
 		zgoubi_element_def.__init__(self, defs, *args, **kargs)
 
-	new_class = type(cname, (zgoubi_element_def,),
-	            {"__init__":init_func,
-	            "_class_name": defs['zgoubi_name'],
-	            "_zgoubi_name": defs['zgoubi_name'],
-	            "_class_defs": defs})
+	class_dict = {"__init__":init_func,
+	              "_class_name": defs['zgoubi_name'],
+	              "_zgoubi_name": defs['zgoubi_name'],
+	              "_class_defs": defs}
+	class_dict.update(_def_attrs(defs))
+	# parameters get a real property, so reading them does not need to go through __getattr__
+	# and assigning to them sets the parameter
+	for key, coerce in class_dict["_param_coercers"].items():
+		if not hasattr(zgoubi_element_def, key):
+			class_dict[key] = _param_property(key, coerce)
+
+	new_class = type(cname, (zgoubi_element_def,), class_dict)
 
 	globals()[cname] = new_class
-	__all__.append(cname)
-
-for e_name, e_def in zgoubi_metadata.elements.get_parsed().items():
-
-	# simple elements just have this template
-	if "template" in e_def:
-		template_s = render_template_string(e_def["template"], e_def["params"])
-		e_def["template_s"] = template_s
-		e_def["init_params"] = { _k:_v["default"] for _k, _v in e_def["params"].items() }
-		e_def["params_types"] = { _k:_v["type"] for _k, _v in e_def["params"].items() }
-	else: # elements like MARKER and END
-		e_def["template_s"] = ""
-		e_def["init_params"] = {}
-		e_def["params_types"] = {}
-
-	# if the element has a conditional section, then each version needs a template
-	if "cond_section" in e_def:
-		for cs in e_def["cond_section"]:
-			template_s = render_template_string(cs["template"], e_def["params"])
-			cs["template_s"] = template_s
-
-	if "subelements" in e_def:
-		for se in e_def["subelements"]:
-			template_s = render_template_string(se["template"], se["params"])
-			se["template_s"] = template_s
-			se["init_params"] = { _k:_v["default"] for _k,_v in se["params"].items() }
-			se["params_types"] = { _k:_v["type"] for _k,_v in se["params"].items() }
-
-	make_zgoubi_element(e_name, e_def)
+	if cname not in __all__:
+		__all__.append(cname)
+	return new_class
+
+def process_definitions(parsed_defs):
+	"Render the templates, and collect the defaults and types, for the definitions from zgoubi_metadata"
+	for e_name, e_def in parsed_defs.items():
+
+		# simple elements just have this template
+		if "template" in e_def:
+			template_s = render_template_string(e_def["template"], e_def["params"])
+			e_def["template_s"] = template_s
+			e_def["init_params"] = { _k:_v["default"] for _k, _v in e_def["params"].items() }
+			e_def["params_types"] = { _k:_v["type"] for _k, _v in e_def["params"].items() }
+		else: # elements like MARKER and END
+			e_def["template_s"] = ""
+			e_def["init_params"] = {}
+			e_def["params_types"] = {}
+
+		# if the element has a conditional section, then each version needs a template
+		if "cond_section" in e_def:
+			for cs in e_def["cond_section"]:
+				template_s = render_template_string(cs["template"], e_def["params"])
+				cs["template_s"] = template_s
+
+		if "subelements" in e_def:
+			for se in e_def["subelements"]:
+				template_s = render_template_string(se["template"], se["params"])
+				se["template_s"] = template_s
+				se["init_params"] = { _k:_v["default"] for _k,_v in se["params"].items() }
+				se["params_types"] = { _k:_v["type"] for _k,_v in se["params"].items() }
+	return parsed_defs
+
+# Parsing the yaml definitions is slow, so the processed definitions are cached in ~/.pyzgoubi
+# Bump the version if process_definitions() changes
+definitions_cache_version = 1
+definitions_cache_dir = os.path.join(os.path.expanduser('~'), ".pyzgoubi")
+
+def _definitions_key():
+	"A key that changes if the installed zgoubi_metadata or the cache format changes"
+	import zgoubi_metadata
+	yaml_dir = os.path.join(os.path.dirname(os.path.abspath(zgoubi_metadata.__file__)), "data", "elements_yaml")
+	key = hashlib.md5()
+	key.update(("%s %s\n" % (definitions_cache_version, yaml_dir)).encode())
+	for fname in sorted(os.listdir(yaml_dir)):
+		fstat = os.stat(os.path.join(yaml_dir, fname))
+		key.update(("%s %s %s\n" % (fname, fstat.st_size, fstat.st_mtime)).encode())
+	return key.hexdigest()
+
+def _definitions_cache_path(key):
+	return os.path.join(definitions_cache_dir, "element_defs_%s.pickle" % key)
+
+def load_definitions(use_cache=True):
+	"Returns the processed element definitions, from the cache if it is up to date"
+	try:
+		key = _definitions_key()
+	except (OSError, ImportError):
+		# eg. zgoubi_metadata installed as a zipped egg
+		key = None
+		use_cache = False
+
+	if use_cache:
+		try:
+			with open(_definitions_cache_path(key), "rb") as cache_file:
+				return pickle.load(cache_file)
+		except Exception:
+			# missing, from another python, or partly written
+			pass
+
+	import zgoubi_metadata.elements
+	defs = process_definitions(zgoubi_metadata.elements.get_parsed())
+
+	if key is not None:
+		try:
+			if not os.path.exists(definitions_cache_dir):
+				os.mkdir(definitions_cache_dir)
+			for old_cache in glob.glob(_definitions_cache_path("*")):
+				os.remove(old_cache)
+			# write then rename, so other processes never see a partial file
+			fd, tmp_path = tempfile.mkstemp(dir=definitions_cache_dir, prefix="element_defs_tmp")
+			with os.fdopen(fd, "wb") as cache_file:
+				pickle.dump(defs, cache_file, protocol=2)
+			os.rename(tmp_path, _definitions_cache_path(key))
+		except (IOError, OSError):
+			logging.getLogger('PyZgoubi').debug("Could not write element definition cache", exc_info=True)
+	return defs
+
+element_definitions = load_definitions()
+# making the classes is quick, it is processing the definitions that the cache saves
+for e_name in sorted(element_definitions):
+	make_zgoubi_element(e_name, element_definitions[e_name])
 
 
 import zgoubi.static_defs
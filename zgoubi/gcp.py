@@ -1,4 +1,12 @@
 from __future__ import division, print_function
+import collections
+import copy
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import queue
 import numpy
 from zgoubi.core import *
 from zgoubi.constants import *
@@ -101,6 +109,50 @@ data_def_nonperiodic = [
 ]
 
 
+# columns that hold a whole track or profile for each energy
+heavy_columns = ['twiss_profile', 'full_twiss_profile', 'ftrack', 'ptrack', 'phase_space']
+
+class GCPColumnValue(object):
+	"""A value from one of the heavy_columns of a GCPData, kept in a .npy file rather than in memory.
+	The file is memory mapped each time the value is used, and it can mostly be used in place of the array, eg data[n]['ptrack']['Y']. Use load() to get the array itself.
+	"""
+	def __init__(self, fname):
+		self.fname = fname
+
+	def load(self, mode="r"):
+		"Returns the array, memory mapped with mode as for numpy.load()"
+		try:
+			return numpy.load(self.fname, mmap_mode=mode)
+		except ValueError:
+			# arrays of objects can not be memory mapped
+			return numpy.load(self.fname, allow_pickle=True)
+
+	def __getitem__(self, key):
+		return self.load()[key]
+
+	def __len__(self):
+		return len(self.load())
+
+	def __iter__(self):
+		return iter(self.load())
+
+	def __array__(self, dtype=None, copy=None):
+		value = numpy.asarray(self.load())
+		if copy:
+			return numpy.array(value, dtype=dtype, copy=True)
+		if copy is False and dtype is not None and numpy.dtype(dtype) != value.dtype:
+			raise ValueError("Unable to avoid a copy converting %s to %s" % (value.dtype, dtype))
+		return numpy.asarray(value, dtype=dtype)
+
+	def __getattr__(self, name):
+		if name.startswith("_") or name == "fname":
+			raise AttributeError(name)
+		return getattr(self.load(), name)
+
+	def __repr__(self):
+		return "GCPColumnValue(%r)" % self.fname
+
+
 class GCPData(numpy.ndarray):
 	"Subclass of numpy.ndarray to add an info field"
 	# based on example in https://docs.scipy.org/doc/numpy/user/basics.subclassing.html
@@ -130,6 +182,171 @@ class GCPData(numpy.ndarray):
 		nc[:] = data[:]
 		return nc
 
+	def set_store(self, path):
+		"""Keep the values of the heavy_columns (tracks and profiles) in .npy files in the directory path, rather than in memory. Values already set are moved there, and values set later with set_heavy() go straight there, leaving a GCPColumnValue in the array.
+		"""
+		mkdir_p(path)
+		self.info['store'] = os.path.abspath(path)
+		for key in heavy_columns:
+			if key not in self.dtype.names:
+				continue
+			for n in range(len(self)):
+				value = self[n][key]
+				if value is not None and not isinstance(value, GCPColumnValue):
+					self.set_heavy(n, key, value)
+
+	def set_heavy(self, n, key, value):
+		"Set data[n][key] for one of the heavy_columns. If the data has a store, see set_store(), the value is written there."
+		store = self.info.get('store')
+		if store is not None and value is not None and not isinstance(value, GCPColumnValue):
+			fh, fname = tempfile.mkstemp(dir=store, prefix=key+"_", suffix=".npy")
+			with os.fdopen(fh, "wb") as f:
+				numpy.save(f, value)
+			value = GCPColumnValue(fname)
+		self[n][key] = value
+
+	def save(self, path):
+		"""Save to the directory path, to be read back with GCPData.load().
+		The other columns are saved together in one file, and each value of the heavy_columns in a .npy file of its own, so that the loaded data only reads them when used.
+		"""
+		mkdir_p(path)
+		path = os.path.abspath(path)
+		scalar_names = [name for name in self.dtype.names if not self.dtype[name].hasobject]
+		object_names = [name for name in self.dtype.names if self.dtype[name].hasobject]
+		scalars = numpy.zeros(self.shape, [(name, self.dtype[name]) for name in scalar_names])
+		for name in scalar_names:
+			scalars[name] = self[name]
+		# write to temporary files and then rename, so that an interrupted save leaves the last one intact
+		with open(os.path.join(path, "scalars.npy.tmp"), "wb") as f:
+			numpy.save(f, scalars)
+		os.replace(os.path.join(path, "scalars.npy.tmp"), os.path.join(path, "scalars.npy"))
+
+		objects = {}
+		heavy = {}
+		for key in object_names:
+			if key not in heavy_columns:
+				objects[key] = list(self[key])
+				continue
+			heavy[key] = {}
+			for n, value in enumerate(self[key]):
+				if value is None:
+					continue
+				if isinstance(value, GCPColumnValue) and os.path.dirname(os.path.abspath(value.fname)) == path:
+					heavy[key][n] = os.path.basename(value.fname)
+					continue
+				fname = "%s_%d.npy" % (key, n)
+				numpy.save(os.path.join(path, fname), numpy.asarray(value))
+				heavy[key][n] = fname
+		info = dict(self.info)
+		info.pop('store', None)
+		with open(os.path.join(path, "gcpdata.pickle.tmp"), "wb") as f:
+			pickle.dump(dict(dtype=self.dtype, shape=self.shape, info=info, objects=objects, heavy=heavy), f, protocol=2)
+		os.replace(os.path.join(path, "gcpdata.pickle.tmp"), os.path.join(path, "gcpdata.pickle"))
+
+	@classmethod
+	def load(cls, path):
+		"""Load data saved with save(). The heavy_columns hold GCPColumnValue handles, so they are only read when used, and the directory is used as the store for new values.
+		"""
+		path = os.path.abspath(path)
+		with open(os.path.join(path, "gcpdata.pickle"), "rb") as f:
+			index = pickle.load(f)
+		data = cls(index['shape'], dtype=index['dtype'], info=index['info'])
+		scalars = numpy.load(os.path.join(path, "scalars.npy"))
+		for name in scalars.dtype.names:
+			data[name] = scalars[name]
+		for key, values in index['objects'].items():
+			for n, value in enumerate(values):
+				data[n][key] = value
+		for key, fnames in index['heavy'].items():
+			data[key] = None
+			for n, fname in fnames.items():
+				data[n][key] = GCPColumnValue(os.path.join(path, fname))
+		data.info['store'] = path
+		return data
+
+
+class _Checkpoint(object):
+	"""Saves a GCPData to the directory path as rows are completed, so that an interrupted scan can be resumed.
+	Rows are completed in stages (eg closed orbit and twiss), recorded in info['checkpoint_done']. Each call to finish() only writes the rows it completed, to a small file of its own, and these are merged back in when the checkpoint is loaded. Rows completed by an earlier run of the same scan are copied back into data, along with their entries in the info arrays that have one per row, such as info['co_iterations']. With path None nothing is saved.
+	"""
+	def __init__(self, path, data):
+		self.path = path
+		self.data = data
+		self.lock = threading.Lock()
+		self.n_saves = 0
+		if path is None:
+			self.stages = {}
+			return
+		if not isinstance(data, GCPData):
+			raise ValueError("Checkpoints need the data to be a GCPData")
+		stages = {}
+		row_files = []
+		if os.path.exists(os.path.join(path, "gcpdata.pickle")):
+			old = GCPData.load(path)
+			if old.dtype != data.dtype or old.shape != data.shape or not numpy.all(old['KE'] == data['KE']):
+				raise ValueError("Checkpoint in %s is from a different scan" % path)
+			stages = old.info.get('checkpoint_done', {})
+			row_files = sorted((int(fname.split("_")[1].split(".")[0]), fname) for fname in os.listdir(path) if fname.startswith("rows_") and fname.endswith(".pickle"))
+			for n_save, fname in row_files:
+				with open(os.path.join(path, fname), "rb") as f:
+					saved = pickle.load(f)
+				for n, (values, heavy, info_values) in saved['rows'].items():
+					for name, value in values.items():
+						old[n][name] = value
+					for key, value in info_values.items():
+						old.info[key][n] = value
+					for name, value in heavy.items():
+						old[n][name] = GCPColumnValue(os.path.join(old.info['store'], value))
+				stages.setdefault(saved['stage'], set()).update(saved['rows'])
+			rows = sorted(set().union(*stages.values()))
+			row_info_keys = [key for key in self._row_info_keys(data) if key in self._row_info_keys(old)]
+			for n in rows:
+				data[n] = old[n]
+				for key in row_info_keys:
+					data.info[key][n] = old.info[key][n]
+			zlog.info("Resuming from checkpoint in %s, %d rows done" % (path, len(rows)))
+		self.stages = data.info['checkpoint_done'] = stages
+		data.set_store(path)
+		# merge the rows from the last run into the main files, so they do not pile up
+		data.save(path)
+		for n_save, fname in row_files:
+			os.remove(os.path.join(path, fname))
+
+	@staticmethod
+	def _row_info_keys(data):
+		"The keys of the info arrays with an entry for each row"
+		return [key for key, value in data.info.items() if isinstance(value, numpy.ndarray) and value.shape[:1] == data.shape]
+
+	def done(self, stage, n):
+		"True if row n has been completed for stage"
+		return n in self.stages.get(stage, ())
+
+	def finish(self, stage, *rows):
+		"Mark rows as completed for stage, and save just those rows"
+		if self.path is None:
+			return
+		saved = dict(stage=stage, rows={})
+		row_info_keys = self._row_info_keys(self.data)
+		for n in rows:
+			values = {}
+			heavy = {}
+			for name in self.data.dtype.names:
+				value = self.data[n][name]
+				if isinstance(value, GCPColumnValue) and os.path.dirname(os.path.abspath(value.fname)) == self.data.info['store']:
+					heavy[name] = os.path.basename(value.fname)
+				else:
+					values[name] = value
+			saved['rows'][n] = (values, heavy, dict((key, self.data.info[key][n]) for key in row_info_keys))
+		with self.lock:
+			self.n_saves += 1
+			fname = os.path.join(self.path, "rows_%d.pickle" % self.n_saves)
+		# write then rename, so that an interrupted save is ignored
+		with open(fname + ".tmp", "wb") as f:
+			pickle.dump(saved, f, protocol=2)
+		os.replace(fname + ".tmp", fname)
+		with self.lock:
+			self.stages.setdefault(stage, set()).update(rows)
+
 
 
 def part_info(particle):
@@ -155,7 +372,150 @@ def part_info(particle):
 	return part_ob, mass, charge_sign
 
 
-def get_cell_properties(cell, min_ke, max_ke=None, ke_steps=1, particle=None, tol=1e-6, stop_at_first_unstable=False, closed_orbit_range=None, closed_orbit_range_count=None, closed_orbit_init_YTZP=None, reuse_co_coords=True, closed_orbit_debug=False, full_tracking=False, smart_co_search=False):
+def _parallel_map(func, items, n_threads):
+	"""Call func on each of items, using n_threads threads. Returns the results in the same order as items.
+	Useful where func runs zgoubi, as the threads wait on the zgoubi processes. Exceptions in func are raised again in the calling thread."""
+	items = list(items)
+	if n_threads <= 1 or len(items) <= 1:
+		return [func(item) for item in items]
+	in_q = queue.Queue()
+	out_q = queue.Queue()
+	for n, item in enumerate(items):
+		in_q.put((n, item))
+
+	def worker():
+		"Gets run in threads"
+		while True:
+			try:
+				n, item = in_q.get(block=False)
+			except queue.Empty:
+				return
+			try:
+				out_q.put((n, func(item), None))
+			except Exception:
+				out_q.put((n, None, sys.exc_info()))
+
+	threads = [threading.Thread(target=worker, daemon=True) for x in range(min(n_threads, len(items)))]
+	for t in threads:
+		t.start()
+	results = [None] * len(items)
+	error = None
+	for x in range(len(items)):
+		n, result, exc_info = out_q.get()
+		results[n] = result
+		if exc_info is not None and error is None:
+			error = exc_info
+	for t in threads:
+		t.join()
+	if error is not None:
+		zlog.error("Exception in thread")
+		raise error[1].with_traceback(error[2])
+	return results
+
+
+# offsets of the 11 OBJET5 rays from the reference ray, in Y, T, Z, P (cm, mrad) and relative D
+_objet5_step_disp = 0.001 #cm
+_objet5_step_ang = 0.01 #mrad
+_objet5_step_d = 0.001
+_objet5_ray_steps = numpy.zeros((11, 5))
+for _ray, _coord, _step in [(1, 0, _objet5_step_disp), (3, 1, _objet5_step_ang), (5, 2, _objet5_step_disp), (7, 3, _objet5_step_ang), (9, 4, _objet5_step_d)]:
+	_objet5_ray_steps[_ray, _coord] = _step
+	_objet5_ray_steps[_ray+1, _coord] = -_step
+
+def batched_transfer_matrices(cell, particle, kes, ref_YTZP, full_tracking=False, max_particles=1000, n_threads=1):
+	"""Find the first order transfer matrices of cell for many energies, with one zgoubi run per max_particles particles, rather than a run per energy.
+	For each energy the 11 rays of an OBJET5 (the reference ray, then +- steps in Y, T, Z, P and D) are put into an OBJET2. The energy of each set of rays is given by D, around a BORO shared by the run. The rays are told apart by their particle ID.
+
+	cell: the Line to find the matrices for
+	particle: as for get_cell_properties()
+	kes: kinetic energies in eV
+	ref_YTZP: the reference ray for each energy, shape (len(kes), 4), in cm and mrad
+	n_threads: run this many zgoubi runs at a time
+
+	Returns a dict of arrays with an entry for each energy:
+	ok: True if all the rays reached the end of the cell
+	matrix: transfer matrices, as from calc_transfer_matrix(), in MKSA units (nan if not ok)
+	Y, T, Z, P, S, tof: the reference ray at the end of the cell, in zgoubi units
+	MAX_BY, MIN_BY, MAX_BZ, MIN_BZ: field seen by the rays (if full_tracking)
+	"""
+	kes = numpy.atleast_1d(kes)
+	ref_YTZP = numpy.asarray(ref_YTZP, dtype=float).reshape(len(kes), 4)
+	part_ob, mass, charge_sign = part_info(particle)
+	nrays = len(_objet5_ray_steps)
+
+	out = dict(ok=numpy.zeros(len(kes), bool), matrix=numpy.zeros((len(kes), 6, 6)) + numpy.nan)
+	for key in ["Y", "T", "Z", "P", "S", "tof", "MAX_BY", "MIN_BY", "MAX_BZ", "MIN_BZ"]:
+		out[key] = numpy.zeros(len(kes)) + numpy.nan
+
+	def run_batch(indices):
+		"Runs the energies at indices in one zgoubi run"
+		tline = Line('test_line')
+		tline.add_input_files(cell.input_files)
+		ob = OBJET2()
+		tline.add(ob)
+		tline.add(part_ob)
+		tline.add(DRIFT("fco", XL=0* cm_))
+		tline.add(FAISCNL(FNAME='zgoubi.fai',))
+		tline.add(cell)
+		tline.add(DRIFT("end", XL=0* cm_))
+		tline.add(FAISCNL("end",FNAME='zgoubi.fai',))
+		tline.add(END())
+		tline.full_tracking(full_tracking)
+
+		print("twiss, energies = ", kes[indices[0]], "to", kes[indices[-1]])
+		rigidities = numpy.array([ke_to_rigidity(ke, mass) / charge_sign for ke in kes[indices]])
+		boro = numpy.median(rigidities)
+		ob.set(BORO=boro)
+
+		start = numpy.zeros((len(indices), nrays), dtype=[(c, 'f8') for c in "DYTZPS"])
+		for c, coord in enumerate("YTZP"):
+			start[coord] = ref_YTZP[indices, c][:, None] + _objet5_ray_steps[:, c]
+		start['D'] = (rigidities / boro)[:, None] * (1 + _objet5_ray_steps[:, 4])
+		ob.add(Y=start['Y'].ravel(), T=start['T'].ravel(), Z=start['Z'].ravel(), P=start['P'].ravel(), X=0, D=start['D'].ravel())
+
+		res = tline.run()
+		fai = res.get_all('fai')
+		fai = fai[fai['NOEL'] == fai['NOEL'].max()] # at the end FAISCNL
+		end = numpy.zeros(start.shape, dtype=start.dtype)
+		arrived = numpy.zeros(start.shape, bool)
+		ray_index = numpy.unravel_index(fai['ID'] - 1, start.shape)
+		for coord in "YTZPS":
+			end[coord][ray_index] = fai[coord]
+		arrived[ray_index] = fai['IEX'] == 1
+		ok = arrived.all(axis=1)
+
+		# convert to SI, to give the same units as zgoubi's MATRIX
+		start_si = start.copy()
+		for coord, scale in [("Y", 100), ("T", 1000), ("Z", 100), ("P", 1000), ("S", 100)]:
+			start_si[coord] /= scale
+			end[coord] /= scale
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			matrices = calc_transfer_matrix(start_si, end)
+		matrices[~ok] = numpy.nan
+		out['ok'][indices] = ok
+		out['matrix'][indices] = matrices
+
+		ref = fai[(fai['ID'] - 1) % nrays == 0]
+		ref_n = indices[(ref['ID'] - 1) // nrays]
+		for key in ["Y", "T", "Z", "P", "S", "tof"]:
+			out[key][ref_n] = ref[key]
+
+		if full_tracking:
+			ptrack = res.get_all('plt')
+			set_n = indices[(ptrack['ID'] - 1) // nrays]
+			for key, field, func, init in [("MAX_BY", "BY", numpy.maximum, -numpy.inf), ("MIN_BY", "BY", numpy.minimum, numpy.inf),
+			                               ("MAX_BZ", "BZ", numpy.maximum, -numpy.inf), ("MIN_BZ", "BZ", numpy.minimum, numpy.inf)]:
+				out[key][indices] = init
+				func.at(out[key], set_n, ptrack[field])
+		res.clean()
+
+	batch_size = max(1, int(max_particles) // nrays)
+	batches = [numpy.arange(n, min(n + batch_size, len(kes))) for n in range(0, len(kes), batch_size)]
+	_parallel_map(run_batch, batches, n_threads)
+	return out
+
+
+def get_cell_properties(cell, min_ke, max_ke=None, ke_steps=1, particle=None, tol=1e-6, stop_at_first_unstable=False, closed_orbit_range=None, closed_orbit_range_count=None, closed_orbit_init_YTZP=None, reuse_co_coords=True, closed_orbit_debug=False, full_tracking=False, smart_co_search=False, n_threads=1, n_chains=None, batch_twiss=False, closed_orbit_method="ellipse", checkpoint=None):
 	"""Get the closed orbits and basic properties of a periodic cell.
 
 	cell: A PyZgoubi Line object containing the beamline elements
@@ -167,6 +527,11 @@ def get_cell_properties(cell, min_ke, max_ke=None, ke_steps=1, particle=None, to
 	reuse_co_coords: use closed orbit from previous energy to start search for next energy
 	closed_orbit_debug: output debuging information
 	full_tracking=True is required in order get minimum and maximum magnetic fields along orbit
+	n_threads: run zgoubi in this many threads. The closed orbit searches of the n_chains blocks run in parallel, and the twiss stage runs all energies in parallel. With n_threads=1 (the default) everything runs serially.
+	n_chains: split the energies into this many blocks for the closed orbit search (default n_threads). A quick serial scan finds the closed orbit at the first energy of each block, then the search in each block starts each energy from the previous one in its block, as in the serial search. The closed orbits depend on n_chains but not on n_threads, so a serial run (n_threads=1) with the same n_chains gives exactly the same results as a parallel one.
+	closed_orbit_method: "ellipse" to use zgoubi.utils.find_closed_orbit(), tracking for several laps and moving to the centre of the phase space ellipse, or "newton" to use zgoubi.utils.find_closed_orbit_newton(). The number of Newton iterations for each energy are stored in orbit_data.info['co_iterations']. If a closed_orbit_range is given, and the Newton search fails, find_closed_orbit_range() is tried.
+	batch_twiss: rather than a zgoubi run with an OBJET5 and MATRIX for each energy, find the transfer matrices for many energies at once with batched_transfer_matrices(), and calculate the tunes and periodic twiss parameters from them. Energies with no closed orbit are skipped.
+	checkpoint: a directory to save orbit_data to as each energy is done, with GCPData.save(). If the scan is interrupted, running it again with the same checkpoint skips the energies already done, and the closed orbit search starts from the last closed orbit found.
 
 	returns orbit_data, an array with ke_steps elements, with the following data
 	KE : particle KE in eV
@@ -184,23 +549,35 @@ def get_cell_properties(cell, min_ke, max_ke=None, ke_steps=1, particle=None, to
 	orbit_data = GCPData(ke_steps, info=dict(periodic=True, particle=particle))
 	for n, particle_ke in enumerate(ke_list):
 		orbit_data['KE'][n] = particle_ke
+	for flag in ['found_co', 'stable_tm_YT', 'stable_tm_ZP', 'stable']:
+		orbit_data[flag] = False
 
-	# get closed orbits
-	tline = Line('test_line')
-	tline.add_input_files(cell.input_files)
-	ob = OBJET2()
-	tline.add(ob)
 	part_ob, mass, charge_sign = part_info(particle)
-	tline.add(part_ob)
+	if closed_orbit_method not in ["ellipse", "newton"]:
+		raise ValueError("closed_orbit_method must be 'ellipse' or 'newton'")
+	if closed_orbit_method == "newton":
+		orbit_data.info['co_iterations'] = numpy.zeros(ke_steps, int)
+	checkpoint = _Checkpoint(checkpoint, orbit_data)
 
-	tline.add(DRIFT("fco", XL=0* cm_))
+	# get closed orbits
+	def co_line(method=closed_orbit_method):
+		"Each thread needs its own line. The Newton search only needs one lap"
+		tline = Line('test_line')
+		tline.add_input_files(cell.input_files)
+		ob = OBJET2()
+		tline.add(ob)
+		tline.add(part_ob)
 
-	tline.add(cell)
+		tline.add(DRIFT("fco", XL=0* cm_))
 
-	tline.add(DRIFT("end", XL=0* cm_))
-	tline.add(FAISCNL("end", FNAME='zgoubi.fai'))
-	tline.add(REBELOTE(NPASS=20, K=99))
-	tline.add(END())
+		tline.add(cell)
+
+		tline.add(DRIFT("end", XL=0* cm_))
+		tline.add(FAISCNL("end", FNAME='zgoubi.fai'))
+		if method == "ellipse":
+			tline.add(REBELOTE(NPASS=20, K=99))
+		tline.add(END())
+		return tline, ob
 
 	search_coords = [0,0,0,0]
 	if closed_orbit_init_YTZP is not None:
@@ -212,60 +589,107 @@ def get_cell_properties(cell, min_ke, max_ke=None, ke_steps=1, particle=None, to
 			if r == 0: closed_orbit_range_count.append(0)
 			else: closed_orbit_range_count.append(10)
 
-	for n, particle_ke in enumerate(ke_list):
-		orbit_data['found_co'][n] = False
-		orbit_data['stable_tm_YT'][n] = False
-		orbit_data['stable_tm_ZP'][n] = False
-		orbit_data['stable'][n] = False
-		print("closed orbit, energy = ", particle_ke)
-		rigidity = ke_to_rigidity(particle_ke,mass) / charge_sign
-		ob.set(BORO=rigidity)
-		good_cos = (orbit_data['found_co']*1).sum()
-		if smart_co_search and good_cos >= 2:
-			for coordn, coord in enumerate("Y"):
-				good_data = orbit_data[orbit_data['found_co']]
-				good_data = good_data[-5:]
-				co_poly = numpy.polyfit(good_data['KE'], good_data[coord], min(good_cos,4)-1) # get linear or quad fit
-				search_coords[coordn] = numpy.poly1d(co_poly)(particle_ke)
-
-		if closed_orbit_debug:
-			record_fname = "closedorbit_%s.log"%n
-		else:
-			record_fname = None
+	def co_search(indices, search_coords, first=None):
+		"""Find closed orbits at indices in turn, each search starting from the last closed orbit found.
+		smart_co_search uses the orbits found from index first (default indices[0]) onwards.
+		Returns the index of the first energy where none was found, or None"""
+		if first is None:
+			first = indices[0]
+		search_coords = list(search_coords)
+		tline, ob = co_line()
+		for n in indices:
+			if checkpoint.done("co", n):
+				# done in an earlier run, so just carry on from its closed orbit
+				if orbit_data['found_co'][n]:
+					search_coords = [orbit_data[c][n] for c in "YTZP"]
+				elif stop_at_first_unstable: return n
+				continue
+			particle_ke = ke_list[n]
+			print("closed orbit, energy = ", particle_ke)
+			rigidity = ke_to_rigidity(particle_ke,mass) / charge_sign
+			ob.set(BORO=rigidity)
+			done = orbit_data[first:n]
+			good_cos = (done['found_co']*1).sum()
+			if smart_co_search and good_cos >= 2:
+				for coordn, coord in enumerate("Y"):
+					good_data = done[done['found_co']]
+					good_data = good_data[-5:]
+					co_poly = numpy.polyfit(good_data['KE'], good_data[coord], min(good_cos,4)-1) # get linear or quad fit
+					search_coords[coordn] = numpy.poly1d(co_poly)(particle_ke)
 
-		if closed_orbit_range is None:
-			closed_orbit =  find_closed_orbit(tline, init_YTZP=search_coords, tol=tol, max_iterations=50, record_fname=record_fname)
-		else:
-			closed_orbit =  find_closed_orbit_range(tline, range_YTZP=closed_orbit_range, count_YTZP=closed_orbit_range_count, init_YTZP=search_coords, tol=tol, max_iterations=50, record_fname=record_fname)
-	
-		if closed_orbit is not None:
-			orbit_data['Y'][n],orbit_data['T'][n],orbit_data['Z'][n], orbit_data['P'][n]= closed_orbit
-			orbit_data['found_co'][n] = True
-			search_coords = closed_orbit
-		else:
-			zlog.warn("No closed orbit at: %s"% particle_ke)
 			if closed_orbit_debug:
-				plot_find_closed_orbit(data_fname=record_fname, outfile=record_fname+".pdf")
-				print("Search plots writen to ", record_fname+".pdf")
-			if stop_at_first_unstable: break
+				record_fname = "closedorbit_%s.log"%n
+			else:
+				record_fname = None
+
+			if closed_orbit_method == "newton":
+				closed_orbit, orbit_data.info['co_iterations'][n] = find_closed_orbit_newton(tline, init_YTZP=search_coords, tol=tol, record_fname=record_fname, return_iterations=True)
+				if closed_orbit is None and closed_orbit_range is not None:
+					range_line, range_ob = co_line("ellipse")
+					range_ob.set(BORO=rigidity)
+					closed_orbit =  find_closed_orbit_range(range_line, range_YTZP=closed_orbit_range, count_YTZP=closed_orbit_range_count, init_YTZP=search_coords, tol=tol, max_iterations=50, record_fname=record_fname)
+			elif closed_orbit_range is None:
+				closed_orbit =  find_closed_orbit(tline, init_YTZP=search_coords, tol=tol, max_iterations=50, record_fname=record_fname)
+			else:
+				closed_orbit =  find_closed_orbit_range(tline, range_YTZP=closed_orbit_range, count_YTZP=closed_orbit_range_count, init_YTZP=search_coords, tol=tol, max_iterations=50, record_fname=record_fname)
+		
+			if closed_orbit is not None:
+				orbit_data['Y'][n],orbit_data['T'][n],orbit_data['Z'][n], orbit_data['P'][n]= closed_orbit
+				orbit_data['found_co'][n] = True
+				search_coords = list(closed_orbit)
+				checkpoint.finish("co", n)
+			else:
+				zlog.warn("No closed orbit at: %s"% particle_ke)
+				if closed_orbit_debug:
+					plot_find_closed_orbit(data_fname=record_fname, outfile=record_fname+".pdf")
+					print("Search plots writen to ", record_fname+".pdf")
+				checkpoint.finish("co", n)
+				if stop_at_first_unstable: return n
+		return None
+
+	if n_chains is None:
+		n_chains = n_threads
+	n_chains = max(1, min(n_chains, ke_steps))
+	if n_chains == 1:
+		co_search(range(ke_steps), search_coords)
+	else:
+		# coarse scan of the first energy of each block, to seed the parallel searches
+		blocks = numpy.array_split(numpy.arange(ke_steps), n_chains)
+		first_fail = co_search([block[0] for block in blocks], search_coords)
+		seeds = []
+		for block in blocks:
+			if orbit_data['found_co'][block[0]]:
+				search_coords = [orbit_data[c][block[0]] for c in "YTZP"]
+			seeds.append(search_coords)
+		fails = _parallel_map(lambda bs: co_search(bs[0][1:], bs[1], bs[0][0]) if len(bs[0]) > 1 else None, zip(blocks, seeds), n_threads)
+		fails = [f for f in fails + [first_fail] if f is not None]
+		if stop_at_first_unstable and fails:
+			# as the serial search would, stop at the first failure
+			orbit_data['found_co'][min(fails):] = False
 
 	# get tunes and twiss
-	tline = Line('test_line')
-	tline.add_input_files(cell.input_files)
-	ob = OBJET5()
-	tline.add(ob)
-	tline.add(part_ob)
-	tline.add(DRIFT("fco", XL=0* cm_))
-	tline.add(FAISCNL(FNAME='zgoubi.fai',))
-
-	tline.add(cell)
-
-	tline.add(DRIFT("end", XL=0* cm_))
-	tline.add(FAISCNL("end",FNAME='zgoubi.fai',))
-	tline.add(MATRIX(IORD=1, IFOC=11))
-	tline.add(END())
-
-	for n, particle_ke in enumerate(ke_list):
+	def twiss_line():
+		"Each thread needs its own line"
+		tline = Line('test_line')
+		tline.add_input_files(cell.input_files)
+		ob = OBJET5()
+		tline.add(ob)
+		tline.add(part_ob)
+		tline.add(DRIFT("fco", XL=0* cm_))
+		tline.add(FAISCNL(FNAME='zgoubi.fai',))
+
+		tline.add(cell)
+
+		tline.add(DRIFT("end", XL=0* cm_))
+		tline.add(FAISCNL("end",FNAME='zgoubi.fai',))
+		tline.add(MATRIX(IORD=1, IFOC=11))
+		tline.add(END())
+		return tline, ob
+
+	def get_twiss(n, tline, ob):
+		"""Find the transfer matrix, tunes and twiss parameters at the closed orbit of energy index n.
+		Returns True if unstable, for stop_at_first_unstable"""
+		particle_ke = ke_list[n]
 		print("twiss, energy = ", particle_ke)
 		
 		rigidity = ke_to_rigidity(particle_ke,mass) / charge_sign
@@ -283,7 +707,7 @@ def get_cell_properties(cell, min_ke, max_ke=None, ke_steps=1, particle=None, to
 		try:
 			orbit_data['matrix'][n] = res.get_transfer_matrix()
 		except BadLineError:
-			continue
+			return False
 		
 		orbit_data['matrix_trace_YT'][n] = orbit_data['matrix'][n][0,0] + orbit_data['matrix'][n][1,1]
 		orbit_data['matrix_trace_ZP'][n] = orbit_data['matrix'][n][2,2] + orbit_data['matrix'][n][3,3]
@@ -314,7 +738,7 @@ def get_cell_properties(cell, min_ke, max_ke=None, ke_steps=1, particle=None, to
 		orbit_data['DISP_Z'][n] = twiss['disp_z']
 		orbit_data['DISP_PZ'][n] = twiss['disp_pz']
 
-		if not orbit_data['found_co'][n]: continue
+		if not orbit_data['found_co'][n]: return False
 		if full_tracking:
 			ptrack = res.get_all('plt')
 			by = ptrack['BY']
@@ -332,12 +756,156 @@ def get_cell_properties(cell, min_ke, max_ke=None, ke_steps=1, particle=None, to
 
 		if orbit_data['NU_Y'][n] == -1 or orbit_data['NU_Z'][n] == -1:
 			orbit_data['stable'][n] = False
-			if stop_at_first_unstable: break
+			return True
+		return False
+
+	def twiss_step(n, tline, ob):
+		"get_twiss(), skipping energies done in an earlier run"
+		if checkpoint.done("twiss", n):
+			return bool(orbit_data['found_co'][n] and (orbit_data['NU_Y'][n] == -1 or orbit_data['NU_Z'][n] == -1))
+		unstable = get_twiss(n, tline, ob)
+		checkpoint.finish("twiss", n)
+		return unstable
+
+	if batch_twiss:
+		found = numpy.flatnonzero(orbit_data['found_co'])
+		found = numpy.array([n for n in found if not checkpoint.done("twiss", n)], dtype=int)
+		ref_YTZP = numpy.array([orbit_data[c][found] for c in "YTZP"]).T
+		batch = batched_transfer_matrices(cell, particle, ke_list[found], ref_YTZP, full_tracking=full_tracking, n_threads=n_threads)
+		matrices = batch['matrix']
+		orbit_data['matrix'][found] = matrices
+		orbit_data['matrix_trace_YT'][found] = matrices[:,0,0] + matrices[:,1,1]
+		orbit_data['matrix_trace_ZP'][found] = matrices[:,2,2] + matrices[:,3,3]
+		orbit_data['stable_tm_YT'][found] = abs(orbit_data['matrix_trace_YT'][found]) < 2
+		orbit_data['stable_tm_ZP'][found] = abs(orbit_data['matrix_trace_ZP'][found]) < 2
+		orbit_data['stable'][found] = orbit_data['stable_tm_YT'][found] & orbit_data['stable_tm_ZP'][found]
+
+		mu_y, mu_z = calc_phase_ad_from_matrix(matrices)
+		# zgoubi gives -1 for undefined tunes
+		orbit_data['NU_Y'][found] = numpy.where(numpy.isnan(mu_y), -1, mu_y / (2*pi))
+		orbit_data['NU_Z'][found] = numpy.where(numpy.isnan(mu_z), -1, mu_z / (2*pi))
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			twiss = calc_twiss_from_matrix(matrices)
+			disp = calc_dispersion_from_matrix(matrices)
+		for key, values in zip(["BETA_Y", "ALPHA_Y", "GAMMA_Y", "BETA_Z", "ALPHA_Z", "GAMMA_Z"], twiss):
+			orbit_data[key][found] = values
+		for key, values in zip(["DISP_Y", "DISP_PY", "DISP_Z", "DISP_PZ"], disp):
+			orbit_data[key][found] = values
+		keys = ["tof", "S"]
+		if full_tracking:
+			keys += ["MAX_BY", "MIN_BY", "MAX_BZ", "MIN_BZ"]
+		for key in keys:
+			orbit_data[key][found] = batch[key]
+
+		unstable = (orbit_data['NU_Y'] == -1) | (orbit_data['NU_Z'] == -1)
+		unstable[orbit_data['found_co'] == False] = False
+		orbit_data['stable'][unstable] = False
+		if stop_at_first_unstable and unstable.any():
+			# as the serial loop would, stop at the first unstable energy
+			orbit_data['stable'][numpy.argmax(unstable)+1:] = False
+		checkpoint.finish("twiss", *range(ke_steps))
+	elif n_threads <= 1:
+		tline, ob = twiss_line()
+		for n in range(ke_steps):
+			if twiss_step(n, tline, ob) and stop_at_first_unstable: break
+	else:
+		thread_lines = threading.local()
+		def parallel_twiss(n):
+			"Runs in threads, each with its own line"
+			if not hasattr(thread_lines, "line"):
+				thread_lines.line = twiss_line()
+			return twiss_step(n, *thread_lines.line)
+		unstable = _parallel_map(parallel_twiss, range(ke_steps), n_threads)
+		if stop_at_first_unstable and any(unstable):
+			# as the serial loop would, stop at the first unstable energy
+			orbit_data['stable'][unstable.index(True)+1:] = False
 		
 	return orbit_data
 
 
-def get_cell_properties_nonperiodic(cell, min_ke, max_ke=None, ke_steps=1, particle=None, init_YTZP=None, init_twiss=None, full_tracking=False):
+def _adaptive_split(orbit_data, refine_tol, min_ke_step):
+	"""Used by get_cell_properties_adaptive(). Returns a boolean array, True for each interval between the energies of orbit_data (sorted by KE) that should be split.
+	"""
+	ke = orbit_data['KE']
+	split = numpy.zeros(len(orbit_data)-1, bool)
+	for flag in ['found_co', 'stable']:
+		split |= orbit_data[flag][1:] != orbit_data[flag][:-1]
+	for key, tol in refine_tol.items():
+		# the closed orbit is known wherever there is one, the other values only where stable
+		valid = orbit_data['found_co'] if key in ["Y", "T", "Z", "P"] else orbit_data['stable']
+		values = orbit_data[key]
+		# compare each value with the linear interpolation between its neighbours
+		good = valid[:-2] & valid[1:-1] & valid[2:]
+		frac = (ke[1:-1] - ke[:-2]) / (ke[2:] - ke[:-2])
+		with numpy.errstate(invalid='ignore'):
+			bad = good & (abs(values[1:-1] - (values[:-2] + frac * (values[2:] - values[:-2]))) > tol)
+		split[:-1] |= bad
+		split[1:] |= bad
+	split &= (ke[1:] - ke[:-1]) > min_ke_step
+	return split
+
+
+def get_cell_properties_adaptive(cell, min_ke, max_ke, particle=None, initial_steps=5, max_steps=100, refine_tol=None, min_ke_step=None, n_threads=1, **kwargs):
+	"""Like get_cell_properties(), but rather than a uniform list of energies, starts with initial_steps energies and adds more where the results change quickly, such as near resonances or the edge of stability.
+
+	An interval between two energies is split in half if the found_co or stable flags differ at its ends, or if the closed orbit or tunes at an energy are further than refine_tol from the linear interpolation between its neighbours (in which case the intervals either side are split). This repeats until nothing needs splitting, there are max_steps energies, or the intervals are less than min_ke_step.
+
+	refine_tol: dict of the allowed interpolation error of each column, default dict(Y=0.01, T=0.1, NU_Y=0.001, NU_Z=0.001) (cm, mrad)
+	min_ke_step: smallest interval to split, default (max_ke-min_ke)/1000
+	n_threads: the first scan is run with n_threads, then the new energies of each round are found in parallel. Each starts its closed orbit search from the closed orbits of its neighbours.
+	Other arguments are passed to get_cell_properties(), except checkpoint, which is not supported.
+
+	returns orbit_data, as from get_cell_properties(), sorted by KE. orbit_data.info['adaptive_rounds'] gives the number of rounds of refinement.
+	"""
+	if refine_tol is None:
+		refine_tol = dict(Y=0.01, T=0.1, NU_Y=0.001, NU_Z=0.001)
+	if min_ke_step is None:
+		min_ke_step = (max_ke - min_ke) / 1000
+	if "checkpoint" in kwargs:
+		raise ValueError("get_cell_properties_adaptive() does not support checkpoint")
+	init_YTZP = kwargs.pop("closed_orbit_init_YTZP", None)
+	if init_YTZP is None:
+		init_YTZP = [0, 0, 0, 0]
+
+	orbit_data = get_cell_properties(cell, min_ke, max_ke, initial_steps, particle=particle, closed_orbit_init_YTZP=init_YTZP, n_threads=n_threads, **kwargs)
+
+	def new_energy(ke_lo_hi):
+		"Find the properties at the mid point of an interval, starting from the closed orbit of its ends"
+		lo, hi = ke_lo_hi
+		ke = (orbit_data['KE'][lo] + orbit_data['KE'][hi]) / 2
+		found = [n for n in [lo, hi] if orbit_data['found_co'][n]]
+		if found:
+			start = numpy.mean([[orbit_data[c][n] for c in "YTZP"] for n in found], axis=0)
+		else:
+			start = init_YTZP
+		return get_cell_properties(cell, ke, particle=particle, closed_orbit_init_YTZP=list(start), **kwargs)
+
+	rounds = 0
+	while len(orbit_data) < max_steps:
+		split = numpy.flatnonzero(_adaptive_split(orbit_data, refine_tol, min_ke_step))
+		if len(split) == 0:
+			break
+		rounds += 1
+		# if there are not enough steps left, split the widest intervals
+		widths = orbit_data['KE'][split+1] - orbit_data['KE'][split]
+		split = split[numpy.argsort(-widths, kind='stable')][:max_steps - len(orbit_data)]
+		print("adaptive refinement round", rounds, "adding", len(split), "energies")
+		new_rows = _parallel_map(new_energy, [(n, n+1) for n in split], n_threads)
+
+		rows = numpy.concatenate([orbit_data.view(numpy.ndarray)] + [d.view(numpy.ndarray) for d in new_rows])
+		order = numpy.argsort(rows['KE'], kind='stable')
+		merged = GCPData(len(rows), info=orbit_data.info)
+		merged[:] = rows[order]
+		# per energy info, such as co_iterations
+		for key, value in orbit_data.info.items():
+			if isinstance(value, numpy.ndarray) and len(value) == len(orbit_data):
+				merged.info[key] = numpy.concatenate([value] + [d.info[key] for d in new_rows])[order]
+		orbit_data = merged
+	orbit_data.info['adaptive_rounds'] = rounds
+	return orbit_data
+
+
+def get_cell_properties_nonperiodic(cell, min_ke, max_ke=None, ke_steps=1, particle=None, init_YTZP=None, init_twiss=None, full_tracking=False, batch_twiss=False, twiss_profile=False):
 	"""Get the basic properties of a non-periodic cell. 
 
 	Works similarly to get_cell_properties(), but rather than finding a periodic solution for closed orbit and twiss parameters, takes them as input:
@@ -348,6 +916,8 @@ def get_cell_properties_nonperiodic(cell, min_ke, max_ke=None, ke_steps=1, parti
 	min_ke, max_ke, ke_steps: kinetic energy in eV. For a single step just set min_ke
 	particle: "p", "e", "mu-", "mu+", or a PARTICUL() instance
 	full_tracking=True is required in order get minimum and maximum magnetic fields along orbit
+	batch_twiss: find the transfer matrices for all energies at once with batched_transfer_matrices(), and propagate init_twiss through them, rather than running zgoubi for each energy
+	twiss_profile: also store the twiss profile in the 'twiss_profile' column, from the same zgoubi run as the transfer matrix. It has the start and end of the cell, or every integration step with full_tracking=True. Not available with batch_twiss
 
 	returns orbit_data, an array with ke_steps elements, with the following data
 	KE : particle KE in eV
@@ -381,6 +951,28 @@ def get_cell_properties_nonperiodic(cell, min_ke, max_ke=None, ke_steps=1, parti
 
 	part_ob, mass, charge_sign = part_info(particle)
 
+	if batch_twiss:
+		if twiss_profile:
+			raise ValueError("twiss_profile is not available with batch_twiss")
+		for key in ['DISP_PY', 'DISP_PZ']:
+			orbit_data[key+"0"] = init_twiss[key.lower()]
+		ref_YTZP = numpy.array([orbit_data[c+"0"] for c in "YTZP"]).T
+		batch = batched_transfer_matrices(cell, particle, ke_list, ref_YTZP, full_tracking=full_tracking)
+		matrices = batch['matrix']
+		orbit_data['matrix'] = matrices
+		mu_y, mu_z = calc_phase_ad_from_matrix(matrices)
+		orbit_data['NU_Y'] = numpy.where(numpy.isnan(mu_y), -1, mu_y / (2*pi))
+		orbit_data['NU_Z'] = numpy.where(numpy.isnan(mu_z), -1, mu_z / (2*pi))
+		end_twiss = propagate_twiss_through_matrix(matrices, init_twiss)
+		for key in end_twiss.dtype.names:
+			orbit_data[key.upper()] = end_twiss[key]
+		keys = ["tof", "S", "Y", "T", "Z", "P"]
+		if full_tracking:
+			keys += ["MAX_BY", "MIN_BY", "MAX_BZ", "MIN_BZ"]
+		for key in keys:
+			orbit_data[key] = batch[key]
+		return orbit_data
+
 	# get tunes and twiss
 	tline = Line('test_line')
 	tline.add_input_files(cell.input_files)
@@ -440,20 +1032,12 @@ def get_cell_properties_nonperiodic(cell, min_ke, max_ke=None, ke_steps=1, parti
 		orbit_data['DISP_Z0'][n] = init_twiss['disp_z']
 		orbit_data['DISP_PZ0'][n] = init_twiss['disp_pz']
 
-		# FIXME: can probably just propergate these thought the matrix
-		# see SY Lee pg 48
-		twiss_profiles = get_twiss_profiles(tline,None, input_twiss_parameters=init_twiss, calc_dispersion=0)
-		orbit_data['BETA_Y'][n] = twiss_profiles['beta_y'][-1]
-		orbit_data['ALPHA_Y'][n] = twiss_profiles['alpha_y'][-1]
-		orbit_data['GAMMA_Y'][n] = twiss_profiles['gamma_y'][-1]
-		orbit_data['DISP_Y'][n] = twiss_profiles['disp_y'][-1]
-		orbit_data['DISP_PY'][n] = twiss_profiles['disp_py'][-1]
-		orbit_data['BETA_Z'][n] = twiss_profiles['beta_z'][-1]
-		orbit_data['ALPHA_Z'][n] = twiss_profiles['alpha_z'][-1]
-		orbit_data['GAMMA_Z'][n] = twiss_profiles['gamma_z'][-1]
-		orbit_data['DISP_Z'][n] = twiss_profiles['disp_z'][-1]
-		orbit_data['DISP_PZ'][n] = twiss_profiles['disp_pz'][-1]
-
+		# the end twiss functions from the matrix of this run, see SY Lee pg 48
+		end_twiss = propagate_twiss_through_matrix(orbit_data['matrix'][n], init_twiss)
+		for key in end_twiss.dtype.names:
+			orbit_data[key.upper()][n] = end_twiss[key][0]
+		if twiss_profile:
+			orbit_data.set_heavy(n, 'twiss_profile', get_twiss_profiles(tline, None, input_twiss_parameters=init_twiss, calc_dispersion=0, results=res))
 
 		ftrack = res.get_all('fai')
 		ftrack = ftrack[ftrack['ID']==1]
@@ -485,17 +1069,12 @@ def get_cell_tracks(cell, data, particle, full_tracking=False, xterm=False, add_
 
 		tracks = get_tracks(cell=cell, start_YTZP=[ref_Y,ref_T,ref_Z,ref_P],
 		                    particle=particle, ke=particle_ke, full_tracking=full_tracking, xterm=xterm, add_faiscnl=add_faiscnl)
-		data[n]['ftrack'] = tracks['ftrack']
-		data[n]['ptrack'] = tracks['ptrack']
+		data.set_heavy(n, 'ftrack', tracks['ftrack'])
+		data.set_heavy(n, 'ptrack', tracks['ptrack'])
 
 
-def get_tracks(cell, start_YTZP, particle, ke, full_tracking=False, return_zgoubi_files=False, xterm=False, add_faiscnl=True):
-	"""Run a particle through a cell from a give starting point and return track from fai and plt files.
-	
-	This is mostly used by other functions in this module, but can be useful for debugging a lattice
-	
-	add_faiscnl: insert a faiscnl (beam store) after each element
-	"""
+def _tracks_line(cell, particle, ke, full_tracking, add_faiscnl):
+	"Make the line used by get_tracks() and get_tracks_multi(). Returns the line and its OBJET2"
 	split = 1
 	tline = Line('test_line')
 	tline.add_input_files(cell.input_files)
@@ -522,12 +1101,35 @@ def get_tracks(cell, start_YTZP, particle, ke, full_tracking=False, return_zgoub
 
 	rigidity = ke_to_rigidity(ke,mass) / charge_sign
 	ob.set(BORO=rigidity)
+	if full_tracking:
+		tline.full_tracking(True, drift_to_multi=True)
+	return tline, ob
+
+
+def _split_by_id(track, n_rays):
+	"Split a fai or plt track into a list with the records of each particle, in the order they were recorded. None for particles with no records"
+	if track is None:
+		return [None] * n_rays
+	order = numpy.argsort(track['ID'], kind='stable')
+	track = track[order]
+	ids = numpy.arange(1, n_rays + 1)
+	starts = numpy.searchsorted(track['ID'], ids, side='left')
+	ends = numpy.searchsorted(track['ID'], ids, side='right')
+	return [track[start:end] if end > start else None for start, end in zip(starts, ends)]
+
+
+def get_tracks(cell, start_YTZP, particle, ke, full_tracking=False, return_zgoubi_files=False, xterm=False, add_faiscnl=True):
+	"""Run a particle through a cell from a give starting point and return track from fai and plt files.
+	
+	This is mostly used by other functions in this module, but can be useful for debugging a lattice
+	
+	add_faiscnl: insert a faiscnl (beam store) after each element
+	"""
+	tline, ob = _tracks_line(cell, particle, ke, full_tracking, add_faiscnl)
 
 	ref_Y,ref_T,ref_Z,ref_P = start_YTZP
 	ob.clear()
 	ob.add(Y=ref_Y, T=ref_T, Z=ref_Z, P=ref_P, X=0, D=1)
-	if full_tracking:
-		tline.full_tracking(True, drift_to_multi=True)
 
 	res = tline.run(xterm=xterm)
 	try:
@@ -551,6 +1153,32 @@ def get_tracks(cell, start_YTZP, particle, ke, full_tracking=False, return_zgoub
 	return ret_data
 
 
+def get_tracks_multi(cell, starts_YTZP, particle, ke, full_tracking=False, xterm=False, add_faiscnl=True):
+	"""Like get_tracks(), but runs many particles through the cell in a single zgoubi run.
+	
+	starts_YTZP: array of shape (n, 4), the starting Y, T, Z and P of each particle
+	returns a dict with ftrack and ptrack, each a list with the track of each particle (or None if it has none)
+	"""
+	starts_YTZP = numpy.asarray(starts_YTZP, dtype=float).reshape(-1, 4)
+	tline, ob = _tracks_line(cell, particle, ke, full_tracking, add_faiscnl)
+	ob.clear()
+	ob.add(Y=starts_YTZP[:, 0], T=starts_YTZP[:, 1], Z=starts_YTZP[:, 2], P=starts_YTZP[:, 3], X=0, D=1)
+
+	res = tline.run(xterm=xterm)
+	try:
+		ftrack = res.get_all('fai')
+	except IOError:
+		ftrack = None
+	ptrack = None
+	if full_tracking:
+		try:
+			ptrack = res.get_all('plt')
+		except EmptyFileError:
+			zlog.warn("Empty plt file")
+	res.clean()
+	return dict(ftrack=_split_by_id(ftrack, len(starts_YTZP)), ptrack=_split_by_id(ptrack, len(starts_YTZP)))
+
+
 def plot_cell_properties(data, output_prefix="results/cell_", file_fmt=".pdf", ncells=1):
 	"""Produce a set of standard plots from the data structure
 	
@@ -774,11 +1402,11 @@ def get_twiss_params(cell, data, particle, output_prefix="results/twiss_profiles
 	
 		tline.full_tracking(False)
 		twiss_profiles = get_twiss_profiles(tline,'%s%s.txt'%(output_prefix, particle_ke), input_twiss_parameters=init_twiss, calc_dispersion=calc_dispersion)
-		data[n]['twiss_profile'] = twiss_profiles
+		data.set_heavy(n, 'twiss_profile', twiss_profiles)
 		if full_tracking:
 			tline.full_tracking(True)
 			twiss_profiles = get_twiss_profiles(tline, '%s%s_full.txt'%(output_prefix, particle_ke), calc_dispersion=calc_dispersion, input_twiss_parameters=init_twiss)
-			data[n]['full_twiss_profile'] = twiss_profiles
+			data.set_heavy(n, 'full_twiss_profile', twiss_profiles)
 
 
 def plot_twiss_params(data, output_prefix="results/twiss_profiles_", fields=None):
@@ -918,44 +1546,122 @@ def plot_cell_tracks(cell, data, particle, output_file="results/track.pdf", show
 		lp.show()
 
 
+# samples of magnet fields, shared by profile1d(), profile2d() and plot_element_fields()
+_field_sample_cache = collections.OrderedDict()
+_field_sample_cache_size = 32
+
+class _FieldSamples(object):
+	"""The field seen by high rigidity test rays through a magnet, tracked in one run.
+	ys: the starting Y of each ray
+	ptracks: the plt track of each ray (None if empty)
+	fieldpoints: for each ray with a track, an array of [y, z, x, by, bz, bx] at each step
+	"""
+	def __init__(self, magnet, min_y, max_y, y_steps, angle):
+		tline = Line('t')
+		try:
+			tline.add_input_files(magnet.input_files)
+		except AttributeError:
+			pass
+		# full tracking changes the elements, so use a copy to keep the magnet (and its hash) unchanged
+		tline.add(copy.deepcopy(magnet))
+
+		starts = numpy.zeros([y_steps, 4])
+		starts[:, 0] = numpy.linspace(min_y, max_y, y_steps)
+		starts[:, 1] = angle
+		self.ys = starts[:, 0]
+		self.ptracks = get_tracks_multi(tline, starts, 'p', 1e20, full_tracking=True)['ptrack']
+
+		self.fieldpoints = []
+		for pt in self.ptracks:
+			if pt is None:
+				zlog.warn('Empty track')
+				continue
+			fieldpoints = numpy.column_stack([pt['Y'], pt['Z'], pt['X'], pt['BY'], pt['BZ'], pt['BX']])
+			self.fieldpoints.append(fieldpoints[~numpy.isnan(fieldpoints[:, :3]).any(axis=1)])
+		self._interpolator = None
+
+	def interpolator(self):
+		"""Returns a linear interpolator of BZ, the scales used for its positions, and the extents of the samples:
+
+		    interpolator, (y_step, x_step, mean_sy), (xmin,xmax,ymin,ymax)
+
+		Positions are divided by the typical step along and between the rays, as the scales are different, see https://github.com/scipy/scipy/issues/2975
+		The triangulation is only done once, however many times it is used.
+		"""
+		if self._interpolator is not None:
+			return self._interpolator
+		import scipy.interpolate
+		if not hasattr(scipy.interpolate, "LinearNDInterpolator"):
+			print("Field profiles require scipy > 0.9")
+			raise
+
+		# get typecal steps, in x and y. should be close to xpas, and gap between orbits
+		x_diff_means = []
+		y_pos_means = []
+		for fmp in self.fieldpoints:
+			fmp_xs = fmp[:,2]
+			fmp_ys = fmp[:,0]
+			x_difs = fmp_xs[1:] - fmp_xs[:-1]
+			x_diff_means.append(x_difs.mean())
+			y_pos_means.append(fmp_ys.mean())
+
+		x_step = numpy.array(x_diff_means).mean()
+		y_pos_means = numpy.array(y_pos_means)
+		y_step =  (y_pos_means[1:] - y_pos_means[:-1]).mean()
+
+		if len(self.fieldpoints) == 0 or sum(len(fmp) for fmp in self.fieldpoints) == 0:
+			zlog.error("No tracks, can't make field profile")
+			raise NoTrackError
+		field_map_data = numpy.vstack(self.fieldpoints)
+
+		points = field_map_data[:,0:3:2].copy()
+		values = field_map_data[:,4] #bz
+
+		ymin,ymax,xmin,xmax = points[:,0].min(), points[:,0].max(), points[:,1].min(), points[:,1].max()
+
+		# scale positions, we return orginal extents, so this does not effect results
+		points[:,0] /= y_step
+		points[:,1] /= x_step
+		mean_sy = points[:,0].mean()
+		points[:,0] -= mean_sy
+
+		if numpy.abs(field_map_data[:,1]).max() > 1e-6:
+			zlog.warn("Some field points are not at z=0. Plot will be of projection onto z=0")
+
+		interpolator = scipy.interpolate.LinearNDInterpolator(points, values)
+		self._interpolator = interpolator, (y_step, x_step, mean_sy), (xmin,xmax,ymin,ymax)
+		return self._interpolator
+
+
+def _input_files_key(magnet):
+	"The names and modification times of the magnet's input files, so that samples are not reused once a field map is edited"
+	key = []
+	for fname in getattr(magnet, "input_files", []):
+		try:
+			mtime = os.path.getmtime(fname)
+		except OSError:
+			mtime = None
+		key.append((fname, mtime))
+	return tuple(key)
+
+def _sample_field(magnet, min_y, max_y, y_steps, angle):
+	"Returns the _FieldSamples for the magnet and ray grid, reusing earlier samples of the same magnet contents and input files"
+	key = (magnet.content_hash(), _input_files_key(magnet), float(min_y), float(max_y), int(y_steps), float(angle))
+	try:
+		_field_sample_cache[key] = samples = _field_sample_cache.pop(key)
+	except KeyError:
+		samples = _FieldSamples(magnet, min_y, max_y, y_steps, angle)
+		_field_sample_cache[key] = samples
+		while len(_field_sample_cache) > _field_sample_cache_size:
+			_field_sample_cache.popitem(last=False)
+	return samples
+
+
 def profile_get_tracks(magnet, min_y, max_y, y_steps, angle=0):
 	"""Internal function used by profile1d() and profile2d()
 
 	"""
-
-	tline = Line('t')
-	try:
-		tline.add_input_files(magnet.input_files)
-	except AttributeError:
-		pass
-	tline.add(magnet)
-
-	# test bunch of high rigidity particles
-	testparticles = GCPData(y_steps, info=dict(periodic=True, particle="p"))
-	testparticles['Y'] = numpy.linspace(min_y, max_y, y_steps)
-	testparticles['T'] = angle
-	testparticles['KE'] = 1e20
-	testparticles['stable'] =True
-
-	get_cell_tracks(tline, testparticles, 'p', full_tracking=True)
-
-	fieldpoints_list = []
-	for pt in testparticles['ptrack']:
-		fieldpoints = []
-		if pt is None:
-			zlog.warn('Empty track')
-			continue
-		for pp in pt:
-			y, z, x = pp['Y'], pp['Z'], pp['X']
-			by, bz, bx = pp['BY'], pp['BZ'], pp['BX']
-			if isnan(x) or isnan(y) or isnan(z):
-				continue
-			fieldpoints.append([y,z,x,by, bz, bx])
-	
-		field_map_data = numpy.array(fieldpoints)
-		fieldpoints_list.append(field_map_data)
-	
-	return fieldpoints_list
+	return _sample_field(magnet, min_y, max_y, y_steps, angle).fieldpoints
 
 
 def profile2d(magnet, min_y, max_y, y_steps, angle=0):
@@ -966,53 +1672,14 @@ def profile2d(magnet, min_y, max_y, y_steps, angle=0):
 	    returns int_field, (xmin,xmax,ymin,ymax)
 
 	"""
-	import scipy.interpolate
-	if not hasattr(scipy.interpolate, "griddata"):
-		print("profile2d() requires scipy > 0.9")
-		raise
-
-	field_map_data = profile_get_tracks(magnet, min_y, max_y, y_steps, angle)
-	
-	# due to scales being different we need to rescale
-	# see https://github.com/scipy/scipy/issues/2975
-	# get typecal steps, in x and y. should be close to xpas, and gap between orbits
-	x_diff_means = []
-	y_pos_means = []
-	for fmp in field_map_data:
-		fmp_xs = fmp[:,2]
-		fmp_ys = fmp[:,0]
-		x_difs = fmp_xs[1:] - fmp_xs[:-1]
-		x_diff_means.append(x_difs.mean())
-		y_pos_means.append(fmp_ys.mean())
-
-	x_step = numpy.array(x_diff_means).mean()
-	y_pos_means = numpy.array(y_pos_means)
-	y_step =  (y_pos_means[1:] - y_pos_means[:-1]).mean()
-
-	field_map_data = numpy.vstack(field_map_data)
-	if len(field_map_data) == 0:
-		zlog.error("No tracks, can't make field profile")
-		raise NoTrackError
-
-	points = field_map_data[:,0:3:2]
-	values = field_map_data[:,4] #bz
-
-	ymin,ymax,xmin,xmax = points[:,0].min(), points[:,0].max(), points[:,1].min(), points[:,1].max()
-
-	# scale positions, we return orginal extents, so this does not effect results
-	points[:,0] /= y_step
-	points[:,1] /= x_step
-	mean_sy = points[:,0].mean()
-	points[:,0] -= mean_sy
-	symin,symax,sxmin,sxmax = points[:,0].min(), points[:,0].max(), points[:,1].min(), points[:,1].max()
+	interpolator, (y_step, x_step, mean_sy), (xmin,xmax,ymin,ymax) = _sample_field(magnet, min_y, max_y, y_steps, angle).interpolator()
+	symin, symax = ymin / y_step - mean_sy, ymax / y_step - mean_sy
+	sxmin, sxmax = xmin / x_step, xmax / x_step
 
 	nsteps = 1j*y_steps*2 # j because of how mgrid works
 	grid_y, grid_x = numpy.mgrid[symin:symax:nsteps, sxmin:sxmax:nsteps]
 
-	if numpy.abs(field_map_data[:,1]).max() > 1e-6:
-		zlog.warn("Some field points are not at z=0. Plot will be of projection onto z=0")
-
-	int_field = scipy.interpolate.griddata(points, values, (grid_y, grid_x), method="linear")
+	int_field = interpolator((grid_y, grid_x))
 
 	return int_field, (xmin,xmax,ymin,ymax)
 
@@ -1022,58 +1689,22 @@ def profile1d(magnet, min_y, max_y, y_steps, angle=0):
 	
 	returns field, ys
 	"""
-	import scipy.interpolate
-	if not hasattr(scipy.interpolate, "griddata"):
-		print("profile1d() requires scipy > 0.9")
-		raise
-
-	field_map_data = profile_get_tracks(magnet, min_y, max_y, y_steps, angle)
-	
-	# due to scales being different we need to rescale
-	# see https://github.com/scipy/scipy/issues/2975
-	# get typecal steps, in x and y. should be close to xpas, and gap between orbits
-	x_diff_means = []
-	y_pos_means = []
-	for fmp in field_map_data:
-		fmp_xs = fmp[:,2]
-		fmp_ys = fmp[:,0]
-		x_difs = fmp_xs[1:] - fmp_xs[:-1]
-		x_diff_means.append(x_difs.mean())
-		y_pos_means.append(fmp_ys.mean())
-
-	x_step = numpy.array(x_diff_means).mean()
-	y_pos_means = numpy.array(y_pos_means)
-	y_step =  (y_pos_means[1:] - y_pos_means[:-1]).mean()
-
-	field_map_data = numpy.vstack(field_map_data)
-	if len(field_map_data) == 0:
-		zlog.error("No tracks, can't make field profile")
-		raise NoTrackError
-
-	points = field_map_data[:,0:3:2]
-	values = field_map_data[:,4] #bz
-
-	ymin,ymax,xmin,xmax = points[:,0].min(), points[:,0].max(), points[:,1].min(), points[:,1].max()
+	samples = _sample_field(magnet, min_y, max_y, y_steps, angle)
+	interpolator, (y_step, x_step, mean_sy), (xmin,xmax,ymin,ymax) = samples.interpolator()
 
 	xmid = (xmax + xmin)/2
 	if hasattr(magnet, "elements"):
-		magnet = magnet.elements().next()
+		magnet = next(magnet.elements())
 	if magnet._zgoubi_name in ["DIPOLES"]:
 		xmid = radians(magnet._looped_data[0]['ACN'])
 
-	# scale positions, we return original extents, so this does not effect results
-	points[:,0] /= y_step
-	points[:,1] /= x_step
-	points[:,0] -= points[:,0].mean()
+	symin, symax = ymin / y_step - mean_sy, ymax / y_step - mean_sy
 	sxmid = xmid / x_step
-	symin,symax,sxmin,sxmax = points[:,0].min(), points[:,0].max(), points[:,1].min(), points[:,1].max()
 
 	nsteps = 1j * y_steps # j because of how mgrid works
 	grid_y, grid_x = numpy.mgrid[symin:symax:nsteps, sxmid:sxmid:1j]
-	if numpy.abs(field_map_data[:,1]).max() > 1e-6:
-		zlog.warn("Some field points are not at z=0. Plot will be of projection onto z=0")
 
-	int_field = scipy.interpolate.griddata(points, values, (grid_y, grid_x), method="linear")
+	int_field = interpolator((grid_y, grid_x))
 	int_field = int_field.reshape([-1])
 
 	return int_field, numpy.linspace(ymin,ymax,y_steps)
@@ -1098,6 +1729,8 @@ def plot_element_fields(cell, min_y, max_y, y_steps, angle=None, output_prefix_r
 	
 	In 2d plots the trick of making rectangular magnets by using large radii is recognised for radii over 1e6cm
 
+	The test rays are tracked once for each element, over the extended range, and the samples are shared by all three plots (and kept for later calls with the same element contents). The longitudinal and "max" plots use the rays starting between min_y and max_y.
+
 	"""
 	from matplotlib import pyplot
 	if not hasattr(pyplot, "tight_layout"): pyplot.tight_layout = lambda :None
@@ -1147,15 +1780,10 @@ def plot_element_fields(cell, min_y, max_y, y_steps, angle=None, output_prefix_r
 				mask = numpy.logical_and(ys>=min_y, ys<=max_y)
 				pyplot.plot(ys[mask], bz[mask], '-b')
 			elif rad_method == "max":
-				testparticles = GCPData(ecount, info=dict(periodic=True, particle="p"))
-				testparticles['Y'] = numpy.linspace(min_y, max_y, y_steps)
-				testparticles['T'] = this_angle
-				testparticles['KE'] = 1e15
-				testparticles['stable'] =True
-				get_cell_tracks(tline, testparticles, 'p', full_tracking=True)
-
-				max_bz = [ pt["BZ"].max() for pt in testparticles['ptrack'] ]
-				pyplot.plot(testparticles['Y'], max_bz, "-b")
+				samples = _sample_field(tline, estart, estop, ecount, this_angle)
+				ys = [y for y, pt in zip(samples.ys, samples.ptracks) if pt is not None and min_y <= y <= max_y]
+				max_bz = [pt["BZ"].max() for y, pt in zip(samples.ys, samples.ptracks) if pt is not None and min_y <= y <= max_y]
+				pyplot.plot(ys, max_bz, "-b")
 			else:
 				raise ValueError('rad_method should be "interp" or "max"')
 
@@ -1167,16 +1795,12 @@ def plot_element_fields(cell, min_y, max_y, y_steps, angle=None, output_prefix_r
 			pyplot.clf()
 
 			if output_prefix_long:
-				testparticles = GCPData(y_steps, info=dict(periodic=True, particle="p"))
-				testparticles['Y'] = numpy.linspace(min_y, max_y, y_steps)
-				testparticles['T'] = this_angle
-				testparticles['KE'] = 1e15
-				testparticles['stable'] =True
-
-				get_cell_tracks(tline, testparticles, 'p', full_tracking=True)
+				# the same rays as the other plots, within min_y to max_y
+				samples = _sample_field(tline, estart, estop, ecount, this_angle)
 				pyplot.clf()
-				for pt in testparticles['ptrack']:
-					pyplot.plot(pt["S"], pt["BZ"], '-b')
+				for y, pt in zip(samples.ys, samples.ptracks):
+					if pt is not None and min_y <= y <= max_y:
+						pyplot.plot(pt["S"], pt["BZ"], '-b')
 				pyplot.xlabel("S (cm)")
 				pyplot.ylabel("$B_z$ (kGauss)")
 				pyplot.grid()
@@ -1188,7 +1812,7 @@ def plot_element_fields(cell, min_y, max_y, y_steps, angle=None, output_prefix_r
 			if output_prefix_2d:
 				bz2, extents = profile2d(tline, estart, estop, ecount, this_angle)
 				#check for rectangular magnets made with DIPOLES.
-				if e.RM > 1e6:
+				if mag_rm > 1e6:
 					# looks like using DIPOLES with large RM to fake rectangular magnet, so convert radians to cm
 					extents = extents[0]*mag_rm, extents[1]*mag_rm, extents[2], extents[3]
 
@@ -1219,7 +1843,41 @@ def plot_element_fields(cell, min_y, max_y, y_steps, angle=None, output_prefix_r
 				pyplot.clf()
 
 
-def get_dynamic_aperture(cell, data, particle, npass, nangles=3, tol=0.01, quick_mode=False, debug_log=None, island_avoid=0.01, start = 1e-6):
+def _da_update_bounds(trials, survived, island_survived, bounds, tol, min_val):
+	"""Used by get_dynamic_aperture(batch_trials=N). Narrows the bounds on the DA of one angle from a batch of trial emittances.
+
+	trials: the trial emittances
+	survived: boolean array, trials by particles, True for each particle that survived
+	island_survived: as survived, for the island check particles at a slightly larger emittance, or None for no island checks. An unstable trial counts as stable if all of its island check particles survived, unless it is 16 particles with half or more lost
+	bounds: (bound_min, bound_max), the highest stable and lowest unstable emittances so far, each None until found
+
+	The lowest unstable trial is the new upper bound, and the highest stable trial below it the new lower bound. Returns the stability of each trial, the new bounds, and the DA, which is None until the bounds are within tol of each other, or 0 if there is no stable emittance above min_val.
+	"""
+	count_s = survived.sum(axis=1)
+	count_p = survived.shape[1]
+	stabs = count_s == count_p
+	if island_survived is not None:
+		# check if this is just a small unstable island
+		island = ~stabs & ~((count_p == 16) & (count_s <= 8))
+		stabs[island] = island_survived[island].all(axis=1)
+
+	bound_min, bound_max = bounds
+	if not stabs.all():
+		bound_max = trials[~stabs].min()
+	below = stabs & (trials < bound_max) if bound_max is not None else stabs
+	if below.any():
+		bound_min = trials[below].max()
+
+	da = None
+	if bound_min is not None and bound_max is not None and ((bound_max-bound_min)/bound_min < tol):
+		da = bound_min
+	elif bound_min is None and bound_max < min_val:
+		zlog.warn("Not stable above min_val")
+		da = 0
+	return stabs, (bound_min, bound_max), da
+
+
+def get_dynamic_aperture(cell, data, particle, npass, nangles=3, tol=0.01, quick_mode=False, debug_log=None, island_avoid=0.01, start = 1e-6, batch_trials=0, n_threads=1, checkpoint=None):
 	"""Get Dynamic Aperture.
 	
 	cell: the cell to run
@@ -1234,6 +1892,9 @@ def get_dynamic_aperture(cell, data, particle, npass, nangles=3, tol=0.01, quick
 	island_avoid: when an unstable amplitude is found take a small step up, to see if it just a small island. set to zero to disable
 	debug_log: file name to write debug information to
 	start: starting emittance 
+	batch_trials: if non zero, test this many emittances for every angle in each zgoubi run, rather than one at a time. The island checks go in the same run. Each run narrows the bounds by a factor of batch_trials+1, so a few runs reach the tolerance.
+	n_threads: search this many energies in parallel
+	checkpoint: a directory to save data to as each energy is done, see get_cell_properties(). data must be a GCPData
 
 	From the starting emittance a search for the stability boundary is made.
 
@@ -1244,6 +1905,8 @@ def get_dynamic_aperture(cell, data, particle, npass, nangles=3, tol=0.01, quick
 		print("get_dynamic_aperture, npass=", npass, " nangles=", nangles, " quick_mode=", quick_mode, file=debug_log)
 		if data['stable'].sum() == 0:
 			print("no stable orbits", file=debug_log)
+	if quick_mode not in [False, "+y+z", "+t+p"]:
+		raise ValueError('quick mode must be "+y+z" or "+t+p"')
 
 	min_val = 1e-10 # unstable if below
 	step = 5 # step factor when unbounded
@@ -1270,6 +1933,17 @@ def get_dynamic_aperture(cell, data, particle, npass, nangles=3, tol=0.01, quick
 				print("WARN: Bounds equal, machine precision reached. Reduce tolerance")
 		return cur
 
+	def get_trials(bound_min, bound_max):
+		"The emittances to try in the next batch, as get_cur() but batch_trials at a time"
+		if bound_min is None and bound_max is None:
+			return start * step ** numpy.arange(batch_trials)
+		elif bound_min is None:
+			return bound_max / step ** numpy.arange(1, batch_trials+1)
+		elif bound_max is None:
+			return bound_min * step ** numpy.arange(1, batch_trials+1)
+		else:
+			return numpy.linspace(bound_min, bound_max, batch_trials+2)[1:-1]
+
 	def update_bounds(cur, stab, bound_min, bound_max):
 		if stab and (bound_min is None or bound_min < cur):
 			bound_min = cur
@@ -1279,61 +1953,56 @@ def get_dynamic_aperture(cell, data, particle, npass, nangles=3, tol=0.01, quick
 			print("WARN:  bounds unchanged", cur, stab, bound_min, bound_max, " Reduce tolerance")
 
 		return bound_min, bound_max
-	
-	def is_stable(cur_emit, tline, angle, it):
+
+	def offsets(cur_emit, angle, orbit):
+		"The offsets from the closed orbit of the particles for an emittance"
 		emit_h = sin(pi/2 - angle) * cur_emit # like 'cos(angle)' but goes to zero better
 		emit_v = sin(angle) * cur_emit
 
-
 		# get offsets from closed orbit
-		current_YTZP = emittance_to_coords(emit_h, emit_v, [alpha_y,alpha_z], [beta_y, beta_z])
+		current_YTZP = emittance_to_coords(emit_h, emit_v, [orbit['ALPHA_Y'],orbit['ALPHA_Z']], [orbit['BETA_Y'], orbit['BETA_Z']])
 		dY, dT, dZ, dP = current_YTZP[0][0], current_YTZP[1][1], current_YTZP[0][2], current_YTZP[1][3]
 		if debug_log:
 			print("cur_emit=", cur_emit, "  emit_h=", emit_h, " emit_v=", emit_v, file=debug_log)
 			print("dY, dT, dZ, dP", dY, dT, dZ, dP, file=debug_log)
 
-		#print dY, dT, dZ, dP
+		if quick_mode == "+y+z":
+			return [[dY, 0, dZ, 0]]
+		elif quick_mode == "+t+p":
+			return [[0, dT, 0, dP]]
+		parts = []
+		for yt_coords in [[dY,0],[-dY,0],[0,dT],[0,-dT]]:
+			for zp_coords in [[dZ,0],[-dZ,0],[0,dP],[0,-dP]]:
+				parts.append(yt_coords + zp_coords)
+		return parts
+
+	def survivors(tline, n_parts):
+		"Run the line, and return whether each particle survived to the end"
+		res = tline.run(xterm =0)
+		survived = numpy.zeros(n_parts, bool)
+		if res.test_rebelote(): # atlease one particle survived
+			fai = res.get_all(file="fai")
+			fai = fai[fai['PASS'] == fai['PASS'].max()]
+			survived[fai['ID'][fai['IEX'] == 1] - 1] = True
+		res.clean()
+		return survived
+
+	def is_stable(cur_emit, tline, angle, it, orbit):
 		ob = tline.get_objet()
 		ob.clear()
-		pn = 0
-		if quick_mode:
-			if quick_mode == "+y+z":
-				ob.add(Y=Yc+dY, T=Tc, Z=Zc+dZ, P=Pc, LET="A", D=1)
-			elif quick_mode == "+t+p":
-				ob.add(Y=Yc, T=Tc+dT, Z=Zc, P=Pc+dP, LET="B", D=1)
-			else:
-				raise ValueError('quick mode must be "+y+z" or "+t+p"')
-			pn=1
-		else:
-			for yt_coords in [[dY,0],[-dY,0],[0,dT],[0,-dT]]:
-				for zp_coords in [[dZ,0],[-dZ,0],[0,dP],[0,-dP]]:
-					#print pn,  yt_coords + zp_coords
-					Ye1, Te1, Ze1, Pe1 = yt_coords + zp_coords
-					ob.add(Y=Yc+Ye1, T=Tc+Te1, Z=Zc+Ze1, P=Pc+Pe1, LET=chr(ord('A')+(pn%26)), D=1)
-					pn+=1
+		for pn, (Ye1, Te1, Ze1, Pe1) in enumerate(offsets(cur_emit, angle, orbit)):
+			ob.add(Y=orbit['Y']+Ye1, T=orbit['T']+Te1, Z=orbit['Z']+Ze1, P=orbit['P']+Pe1, LET=chr(ord('A')+(pn%26)), D=1)
+		pn = len(ob.particles)
 		
 		print("DA: angle %.2f iteration %s"%(degrees(angle), it))
-		res = tline.run(xterm =0)
-		
-		if res.test_rebelote(): # atlease one particle survived
-			iexs = res.get_all(file="fai")['IEX'] # get losses
-			stab_c = sum(iexs==1)
-			if stab_c == pn:
-				stab = True
-			else:
-				stab = False
-
-		else: # all particles lost
-			stab = False
-			stab_c = 0
+		stab_c = survivors(tline, pn).sum()
+		stab = stab_c == pn
 		if debug_log:
 			print("stab=", stab, "  stab_c=", stab_c, file=debug_log)
 
-		res.clean()
-
 		return stab, pn, stab_c
 
-	def is_stable_test(cur_emit, tline, angle, it):
+	def is_stable_test(cur_emit, tline, angle, it, orbit):
 		da     = 0.12345
 		island = 0.00312
 		#island_size = island * 0.02 # big island
@@ -1346,33 +2015,28 @@ def get_dynamic_aperture(cell, data, particle, npass, nangles=3, tol=0.01, quick
 			print("In island", in_island, file=debug_log)
 		return stab, 16, 0
 
-	tline = Line('test_line')
-	tline.add_input_files(cell.input_files)
-	ob = OBJET2()
-	tline.add(ob)
-	part_ob, mass, charge_sign = part_info(particle)
-	tline.add(part_ob)
-	tline.add(cell)
-	
+	def da_line():
+		"Each thread needs its own line"
+		tline = Line('test_line')
+		tline.add_input_files(cell.input_files)
+		ob = OBJET2()
+		tline.add(ob)
+		tline.add(part_ob)
+		tline.add(cell)
+		
 
-	tline.add(REBELOTE(NPASS=npass, K=99))
-	tline.add(DRIFT("end",XL=1e-12))
-	tline.add(FAISCNL("end", FNAME='zgoubi.fai'))
-	tline.add(END())
-	tline.full_tracking(False)
+		tline.add(REBELOTE(NPASS=npass, K=99))
+		tline.add(DRIFT("end",XL=1e-12))
+		tline.add(FAISCNL("end", FNAME='zgoubi.fai'))
+		tline.add(END())
+		tline.full_tracking(False)
+		return tline, ob
 
-	for n, particle_ke in enumerate(data['KE']):
-		if not data[n]['stable']: continue
-		print("energy = ", particle_ke)
-		rigidity = ke_to_rigidity(particle_ke,mass) / charge_sign
-		ob.set(BORO=rigidity)
-		# closed orbit
-		Yc, Tc, Zc, Pc = [data[n]['Y'], data[n]['T'],data[n]['Z'],data[n]['P'] ]
-		alpha_y, beta_y, alpha_z, beta_z = data[n]['ALPHA_Y'], data[n]['BETA_Y'],data[n]['ALPHA_Z'],data[n]['BETA_Z']
-		
-		data[n]['DA'] = numpy.zeros([nangles])
-		data[n]['DA_angles'] = angles
+	part_ob, mass, charge_sign = part_info(particle)
 
+	def search_serial(particle_ke, tline, orbit):
+		"Bisect for each angle in turn"
+		das = numpy.zeros([nangles])
 		for an, angle in enumerate(angles):
 
 			cur_emit = 0 # just need to create it, get set by get_cur
@@ -1388,11 +2052,11 @@ def get_dynamic_aperture(cell, data, particle, npass, nangles=3, tol=0.01, quick
 				if debug_log:
 					print("\ncur_emit=", cur_emit, file=debug_log)
 
-				stab, count_p, count_s  = is_stable(cur_emit, tline, angle, it)
+				stab, count_p, count_s  = is_stable(cur_emit, tline, angle, it, orbit)
 
 				if not stab and island_avoid != 0 and not (count_p == 16 and count_s <= 8):
 					# check if this is just a small unstable island
-					stab, count_p, count_s = is_stable(cur_emit*(1+island_avoid), tline, angle, it)
+					stab, count_p, count_s = is_stable(cur_emit*(1+island_avoid), tline, angle, it, orbit)
 					if stab:
 						print("Stepped over small unstable island at", cur_emit, file=debug_log)
 
@@ -1403,24 +2067,92 @@ def get_dynamic_aperture(cell, data, particle, npass, nangles=3, tol=0.01, quick
 				bound_min, bound_max = update_bounds(cur_emit, stab, bound_min, bound_max)
 
 				if bound_min is not None and bound_max is not None and ((bound_max-bound_min)/bound_min < tol):
-					data[n]['DA'][an] = bound_min
+					das[an] = bound_min
 					break
 
 				if not stab and cur_emit < min_val:
 					zlog.warn("Not stable above min_val")
-					data[n]['DA'][an] = 0
+					das[an] = 0
 					break
 			else:
 				zlog.warn("Maximum iterations reached")
-				data[n]['DA'][an] = 0
+				das[an] = 0
+		return das
+
+	def search_batch(particle_ke, tline, orbit):
+		"Try batch_trials emittances for all angles in each run, and narrow the bounds of each angle"
+		das = numpy.zeros([nangles])
+		bounds = dict((an, (None, None)) for an in range(nangles))
+		checks = [1, 1+island_avoid] if island_avoid != 0 else [1]
+		it = 0
+		while bounds and it < 100:
+			it += 1
+			ob = tline.get_objet()
+			ob.clear()
+			# particle indices for each angle, trial emittance and island check
+			trials = {}
+			trial_parts = {}
+			for an in bounds:
+				trials[an] = get_trials(*bounds[an])
+				for tn, cur_emit in enumerate(trials[an]):
+					for cn, check in enumerate(checks):
+						first = len(ob.particles)
+						for pn, (Ye1, Te1, Ze1, Pe1) in enumerate(offsets(cur_emit * check, angles[an], orbit)):
+							ob.add(Y=orbit['Y']+Ye1, T=orbit['T']+Te1, Z=orbit['Z']+Ze1, P=orbit['P']+Pe1, LET=chr(ord('A')+(pn%26)), D=1)
+						trial_parts[an, tn, cn] = numpy.arange(first, len(ob.particles))
+			print("DA: energy %s iteration %s, %s particles"%(particle_ke, it, len(ob.particles)))
+			survived = survivors(tline, len(ob.particles))
+
+			for an in list(bounds):
+				n_trials = len(trials[an])
+				trial_survived = numpy.array([survived[trial_parts[an, tn, 0]] for tn in range(n_trials)])
+				island_survived = numpy.array([survived[trial_parts[an, tn, 1]] for tn in range(n_trials)]) if island_avoid != 0 else None
+				stabs, bounds[an], da = _da_update_bounds(trials[an], trial_survived, island_survived, bounds[an], tol, min_val)
+				for tn, cur_emit in enumerate(trials[an]):
+					if stabs[tn] and not trial_survived[tn].all():
+						print("Stepped over small unstable island at", cur_emit, file=debug_log)
+					if debug_log:
+						print("angle=", angles[an], " cur_emit=", cur_emit, " stab=", stabs[tn], file=debug_log)
+				if da is not None:
+					das[an] = da
+					del bounds[an]
+			if debug_log:
+				debug_log.flush()
+		if bounds:
+			zlog.warn("Maximum iterations reached")
+		return das
+
+	def da_energy(n):
+		if not data[n]['stable']: return
+		if checkpoint.done("DA", n): return
+		particle_ke = data[n]['KE']
+		print("energy = ", particle_ke)
+		tline, ob = da_line()
+		rigidity = ke_to_rigidity(particle_ke,mass) / charge_sign
+		ob.set(BORO=rigidity)
+		# closed orbit and twiss
+		orbit = dict((key, data[n][key]) for key in ['Y', 'T', 'Z', 'P', 'ALPHA_Y', 'BETA_Y', 'ALPHA_Z', 'BETA_Z'])
 
+		if batch_trials:
+			das = search_batch(particle_ke, tline, orbit)
+		else:
+			das = search_serial(particle_ke, tline, orbit)
+		data[n]['DA'] = das
+		data[n]['DA_angles'] = angles
 		print("DA", data[n]['DA'])
+		checkpoint.finish("DA", n)
+
+	checkpoint = _Checkpoint(checkpoint, data)
+
+	_parallel_map(da_energy, range(len(data)), n_threads)
 		
 
-def get_phase_space(cell, data, particle, npass, emits=None):
+def get_phase_space(cell, data, particle, npass, emits=None, checkpoint=None):
 	"""Track particle for npass turns
 
+	checkpoint: a directory to save data to as each energy is done, see get_cell_properties(). data must be a GCPData
 	"""
+	checkpoint = _Checkpoint(checkpoint, data)
 
 	tline = Line('test_line')
 	tline.add_input_files(cell.input_files)
@@ -1437,6 +2169,7 @@ def get_phase_space(cell, data, particle, npass, emits=None):
 	for n, particle_ke in enumerate(data['KE']):
 	#	if not data[n]['stable']: continue
 		if not data[n]['found_co']: continue
+		if checkpoint.done("phase_space", n): continue
 		print("get_phase_space ke", particle_ke, "n")
 		rigidity = ke_to_rigidity(particle_ke,mass) / charge_sign
 		ob = tline.get_objet()
@@ -1468,7 +2201,11 @@ def get_phase_space(cell, data, particle, npass, emits=None):
 			except IOError:
 				print("No fai file")
 				continue
-		data[n]['phase_space'] = fai_data
+		if isinstance(data, GCPData):
+			data.set_heavy(n, 'phase_space', fai_data)
+		else:
+			data[n]['phase_space'] = fai_data
+		checkpoint.finish("phase_space", n)
 
 
 
@@ -1538,7 +2275,6 @@ def plot_dynamic_aperture(cell, data, particle, npass, output_prefix="results/da
 
 			#pyplot.plot(fai_data['Y'], fai_data['T'], ','+color)
 
-		import pickle
 		pickle.dump(tracks, open('%s_%s.pickle'%(output_prefix, particle_ke), "w"))
 
 		print("dynamic aperture", numpy.median(data[n]['DA']))
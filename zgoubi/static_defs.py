@@ -5,6 +5,7 @@ import os.path
 from zgoubi.elements import zgoubi_element, PARTICUL
 from zgoubi.constants import *
 import copy
+import numpy
 
 __all__ = ["OBJET1", "OBJET2", "OBJET3", "OBJET_bunch", "OBJET5",
 "MCOBJET3", "zgoubi_particul", "ELECTRON", "PROTON", "MUON",
@@ -51,7 +52,19 @@ class OBJET1(zgoubi_element):
 class OBJET2(zgoubi_element):
 	"""Beam made of particles, with coords give explicitly
 	Equivilent to OBJET with a KOBJ=2
+
+	The particles are stored in a numpy structured array, with the fields in particle_data_def.
 	"""
+	particle_data_def = [
+	('Y', numpy.float64),
+	('T', numpy.float64),
+	('Z', numpy.float64),
+	('P', numpy.float64),
+	('X', numpy.float64),
+	('D', numpy.float64),
+	('LET', 'U1'),
+	]
+
 	def __init__(self ,**settings):
 		self._zgoubi_name = "OBJET"
 		self._class_name = "OBJET2"
@@ -59,40 +72,78 @@ class OBJET2(zgoubi_element):
 		self.label2 = ""
 		self._params = {}
 		self._params['BORO'] = 0
-		self._params['particles'] = []
 		self._params['IMAX'] = 0
 		self._params['IDMAX'] = 0
 		object.__setattr__(self, "ready", True)
+		self.clear()
 		self.set(settings)
 		self.sorted = False
-		
+
 	def add(self, **settings):
-		"add a particle"
-		particle_coords = dict(Y=0, T=0, Z=0, P=0, X=0, D=1, LET=' ')
+		"""add a particle. Any of Y, T, Z, P, X, D and LET can be given, other coordinates are 0, with D=1 and LET=' '.
+		To add many particles at once, pass arrays, eg::
+
+			ob.add(Y=numpy.linspace(0, 1, 100), D=1.1)
+
+		"""
+		n_new = numpy.broadcast(*[numpy.asarray(v) for v in settings.values()]).size if settings else 1
+		n_old = self._nparticles
+		if n_old + n_new > len(self._particles):
+			# grow the store by doubling, so that adding particles one at a time is not quadratic
+			new_store = numpy.zeros(max(2 * len(self._particles), n_old + n_new, 16), self.particle_data_def)
+			new_store[:n_old] = self._particles[:n_old]
+			self._particles = new_store
+		new_parts = self._particles[n_old:n_old+n_new]
+		new_parts[:] = (0, 0, 0, 0, 0, 1, ' ')
 		for k, v in settings.items():
-			particle_coords[k] = v
-			
-		self._params['particles'].append(particle_coords)
-		# keep list sorted by D, needed for output()
+			if k not in new_parts.dtype.names:
+				raise ValueError("no such particle coordinate: '" + str(k) + "' In element OBJET2")
+			new_parts[k] = v
+		self._nparticles = n_old + n_new
+		self._params['particles'] = self._particles[:self._nparticles]
+
+		# keep particles sorted by D, needed for output()
 		if self.sorted:
-			self._params['particles'].sort(key=itemgetter('D'))
-		
-		
+			parts = self._params['particles']
+			parts[:] = parts[numpy.argsort(parts['D'], kind='stable')]
+		self.changed()
+
 	def clear(self):
 		"remove all particles"
-		self._params['particles'] = []
-	
+		self._particles = numpy.zeros(0, self.particle_data_def)
+		self._nparticles = 0
+		self._params['particles'] = self._particles
+		self.changed()
+
+	def __setattr__(self, name, value):
+		"Parameters set as attributes, eg ob.BORO = 2000, go into _params, so that they are part of content_hash()"
+		if name == "particles":
+			self._particles = numpy.array(value, self.particle_data_def).reshape(-1)
+			self._nparticles = len(self._particles)
+			self._params['particles'] = self._particles
+			self.changed()
+		elif name in self.__dict__.get("_params", ()):
+			self.set_param(name, value)
+		else:
+			zgoubi_element.__setattr__(self, name, value)
+
+	def _hash_content(self, md5):
+		"The particles are hashed as raw data, rather than rendering them. IMAX and IDMAX are found from the particles by output()"
+		md5.update(repr((self.label1, self.label2, self.sorted, sorted((k, v) for k, v in self._params.items() if k not in ['particles', 'IMAX', 'IDMAX']))).encode("utf-8"))
+		md5.update(numpy.ascontiguousarray(self._params['particles']).tobytes())
+
 	def output(self):
 		out=''
-		self.IMAX = len(self.particles)
+		# IMAX and IDMAX are not part of the content hash, so they can be set without dropping it
+		self._params['IMAX'] = len(self.particles)
 		assert(self.IMAX <= 10000)
 		assert(self.IMAX >= 1)
 		
 		#count unique 'D' values
 		if self.sorted:
-			self.IDMAX = len(set([x['D'] for x in self.particles]))
+			self._params['IDMAX'] = len(numpy.unique(self.particles['D']))
 		else:
-			self.IDMAX = self.IMAX
+			self._params['IDMAX'] = self.IMAX
 		
 		# local short cuts for long function names
 		f = self.f2s
@@ -102,19 +153,17 @@ class OBJET2(zgoubi_element):
 		out += f(self.BORO) +nl
 		out += "2" + nl
 		out += i(self.IMAX) +' '+ i(self.IDMAX) + nl
-		
-		for part in self.particles:
-			out += f(part['Y']) +' '+ f(part['T']) +' '+ f(part['Z']) +' '
-			out += f(part['P']) +' '+ f(part['X']) +' '+ f(part['D'])
-			#if (part['LET'] != ''):
-			out += " '"+ part['LET'] + "'"
-			out += nl
+
+		# format all the particles with a single format operation
+		part_values = numpy.empty([self.IMAX, 7], dtype=object)
+		for n, c in enumerate(['Y', 'T', 'Z', 'P', 'X', 'D']):
+			part_values[:, n] = self.particles[c].astype(float)
+		part_values[:, 6] = self.particles['LET']
+		out += ("%.12e %.12e %.12e %.12e %.12e %.12e '%s'" + nl) * self.IMAX % tuple(part_values.ravel())
 		
 		# assume that we want to track all particles
-		for x in range(len(self.particles)):
-			out += i(1) + ' '
-			if ((x+1)%10 == 0):
-				out += nl # add a new line after 10 values
+		# a 1 for each, with a new line after 10 values
+		out += ("1 " * 10 + nl) * (self.IMAX // 10) + "1 " * (self.IMAX % 10)
 		
 		#print out
 		return out
@@ -171,6 +220,9 @@ class OBJET3(zgoubi_element):
 		return out
 
 class OBJET_bunch(zgoubi_element):
+	# the bunch can be changed without the element knowing
+	_hash_cacheable = False
+
 	def __init__(self,bunch=None, binary=False,**settings):
 		self._zgoubi_name = "OBJET"
 		self._class_name = "OBJET_bunch"
@@ -186,6 +238,11 @@ class OBJET_bunch(zgoubi_element):
 		else:
 			self.bunch.write_YTZPSD(os.path.join(rundir, "coords.dat"), binary=False)
 
+	def _hash_content(self, md5):
+		"The output, and the coordinates written by setup()"
+		md5.update(self.output().encode("utf-8"))
+		md5.update(numpy.ascontiguousarray(self.bunch.particles()).tobytes())
+
 	def output(self):
 		if self.bunch is None:
 			raise BadLineError("OBJET_bunch has no bunch set")
@@ -235,10 +292,12 @@ class OBJET5(zgoubi_element):
 			ellipse_twiss[k] = v
 			
 		self._params['ellipses'] = ellipse_twiss
+		self.changed()
 		
 	def clear_ellipse(self):
 		"remove all particles"
 		self._params['ellipses'] = None
+		self.changed()
 
 	def output(self):
 		# local short cuts for long function names
@@ -14,7 +14,8 @@ from zgoubi.common import *
 from zgoubi.constants import *
 from zgoubi.exceptions import *
 from zgoubi.rel_conv import *
-import itertools
+import threading
+import queue
 from zgoubi.core import zlog, dep_warn, Line
 from io import StringIO
 import copy
@@ -251,7 +252,7 @@ def show_file(file_path, mode):
 		command = 'xterm -e "less %s"'% file_path
 		os.system(command)
 
-def find_closed_orbit_range(line, init_YTZP=None, max_iterations=100, fai_label = None, tol = 1e-6, D=1, range_YTZP=None, count_YTZP=None, record_fname=None, extra_iterations=2):
+def find_closed_orbit_range(line, init_YTZP=None, max_iterations=100, fai_label = None, tol = 1e-6, D=1, range_YTZP=None, count_YTZP=None, record_fname=None, extra_iterations=2, n_threads=1):
 	"""Same as find_closed_orbit, but if init_YTZP is unstable, will generate a bunch or particles, with a spread of range_YTZP, and if any of those are stable will do a closed orbit search with that particle::
 
 		init_YTZP=[5,0,0,0], range_YTZP=[10,0,0,0], count_YTZP[50,0,0,0]
@@ -261,6 +262,8 @@ def find_closed_orbit_range(line, init_YTZP=None, max_iterations=100, fai_label
 		range_YTZP=[10,5,0,0], count_YTZP=[10,10,0,0]
 
 	would create 100 particles in a grid.
+
+	The surviving particles that moved least over the tracking are used as starting points for find_closed_orbit(), up to 10 of them. With n_threads > 1 these searches run in parallel, each on a copy of the line. When one converges the searches from worse ranked starting points are stopped, but the better ranked ones carry on, and the best ranked one to converge is returned, so the result is the same as with the serial search.
 	
 	"""
 	zlog.debug("enter function")
@@ -302,20 +305,17 @@ def find_closed_orbit_range(line, init_YTZP=None, max_iterations=100, fai_label
 	current_YTZP = numpy.array(init_YTZP)
 	objet.clear()	# remove existing particles
 	
-	# generate bunch
+	# generate bunch, a grid around init_YTZP
 	ranges = []
 	for x in range(4):
-		if range_YTZP[x] == 0 or count_YTZP[0] <= 1:
+		if range_YTZP[x] == 0 or count_YTZP[x] <= 1:
 			ranges.append([0])
 		else:
 			ranges.append(numpy.linspace(-range_YTZP[x], range_YTZP[x], count_YTZP[x]))
+	grid = numpy.array(numpy.meshgrid(*ranges, indexing='ij')).reshape(4, -1) + current_YTZP[:, numpy.newaxis]
+	objet.add(Y=grid[0], T=grid[1], Z=grid[2], P=grid[3], LET='A', D=D)
 
-	n_coords = 0
-	for coord in itertools.product(*ranges):
-		n_coords += 1
-		objet.add(Y=current_YTZP[0]+coord[0], T=current_YTZP[1]+coord[1], Z=current_YTZP[2]+coord[2], P=current_YTZP[3]+coord[3], LET='A', D=D)
-
-	zlog.debug("Search for a stable orbit with %s particles"%n_coords)
+	zlog.debug("Search for a stable orbit with %s particles"%grid.shape[1])
 	r = line.run(xterm=False)
 
 	if not r.run_success():
@@ -331,28 +331,72 @@ def find_closed_orbit_range(line, init_YTZP=None, max_iterations=100, fai_label
 		zlog.debug("%d particles survived"%len(surviving_particles))
 
 		#measure lengths and sort
-		surviving_particles2 = [ [ sqrt((p['Y']-p['Y0'])**2 + (p['T']-p['T0'])**2 + (p['Z']-p['Z0'])**2 + (p['P']-p['P0'])**2),p] for p in surviving_particles ]
-		surviving_particles2.sort()
+		lengths = numpy.sqrt(sum((surviving_particles[c] - surviving_particles[c+'0'])**2 for c in "YTZP"))
+		surviving_particles = surviving_particles[numpy.argsort(lengths, kind='stable')]
+		starts = numpy.array([surviving_particles[c] for c in ['Y0', 'T0', 'Z0', 'P0']]).T
 
 		if record_fname:
 			record_fh.write("#survivors %s\n"%len(surviving_particles))
-			for length, surviving_particle in surviving_particles2:
-				surviving_coords = (surviving_particle['Y0'], surviving_particle['T0'], surviving_particle['Z0'], surviving_particle['P0'], surviving_particle['Y'], surviving_particle['T'], surviving_particle['Z'], surviving_particle['P'])
-				record_fh.write("%s %s %s %s %s %s %s %s\n"%surviving_coords)
-
-
-		for length, surviving_particle in surviving_particles2[:10]:
-			surviving_init_coord = [surviving_particle['Y0'], surviving_particle['T0'], surviving_particle['Z0'], surviving_particle['P0']]
-		
-			# use stable particle to find closed orbit
-			result = find_closed_orbit(line=line, init_YTZP=surviving_init_coord, max_iterations=max_iterations, fai_label=fai_label, tol=tol, D=D, record_fname=record_fh, extra_iterations=extra_iterations)
-			if result is not None:
-				return result
+			numpy.savetxt(record_fh, numpy.array([surviving_particles[c] for c in ['Y0', 'T0', 'Z0', 'P0', 'Y', 'T', 'Z', 'P']]).T, fmt="%s")
+
+		if n_threads <= 1:
+			for surviving_init_coord in starts[:10]:
+				# use stable particle to find closed orbit
+				result = find_closed_orbit(line=line, init_YTZP=list(surviving_init_coord), max_iterations=max_iterations, fai_label=fai_label, tol=tol, D=D, record_fname=record_fh, extra_iterations=extra_iterations)
+				if result is not None:
+					return result
+		else:
+			candidates = queue.Queue()
+			cancels = []
+			for n, surviving_init_coord in enumerate(starts[:10]):
+				candidates.put((n, list(surviving_init_coord)))
+				cancels.append(threading.Event())
+			found = {}
+			errors = []
+			records = {}
+
+			def search():
+				"Take candidates from the queue in rank order, skipping those ranked below one that has converged"
+				while True:
+					try:
+						n, surviving_init_coord = candidates.get_nowait()
+					except queue.Empty:
+						return
+					if cancels[n].is_set():
+						continue
+					if record_fh:
+						records[n] = StringIO()
+					try:
+						result = find_closed_orbit(line=copy.deepcopy(line), init_YTZP=surviving_init_coord, max_iterations=max_iterations, fai_label=fai_label, tol=tol, D=D, record_fname=records.get(n), extra_iterations=extra_iterations, cancel=cancels[n])
+					except Exception:
+						errors.append(sys.exc_info())
+						for cancel in cancels:
+							cancel.set()
+						return
+					if result is not None:
+						found[n] = result
+						# the better ranked searches carry on, as one of them would be used by the serial search
+						for cancel in cancels[n+1:]:
+							cancel.set()
+
+			threads = [threading.Thread(target=search) for x in range(min(n_threads, len(starts)))]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+			if errors:
+				zlog.error("Exception in thread")
+				raise errors[0][1].with_traceback(errors[0][2])
+			if record_fh:
+				for n in sorted(records):
+					record_fh.write(records[n].getvalue())
+			if found:
+				return found[min(found)]
 		zlog.warning("Despite finding surviving particles, none were stable")	
 		return None
 
 
-def find_closed_orbit(line, init_YTZP=None, max_iterations=100, fai_label = None, tol = 1e-6, D=1, record_fname=None, plot_search=False, extra_iterations=2):
+def find_closed_orbit(line, init_YTZP=None, max_iterations=100, fai_label = None, tol = 1e-6, D=1, record_fname=None, plot_search=False, extra_iterations=2, cancel=None):
 	"""Find a closed orbit for the line. can optionally give a list of initial coordinates, init_YTZP, eg:
 	find_closed_orbit(line, init_YTZP=[1.2,2.1,0,0])
 	otherwise [0,0,0,0] are used.
@@ -363,6 +407,7 @@ def find_closed_orbit(line, init_YTZP=None, max_iterations=100, fai_label = None
 	
 	record_fname is used to record search details to a file that can be used with plot_find_closed_orbit().
 	extra_iterations allows some extra iterations to improve accuracy, even after tolerance reached
+	cancel: a threading.Event, once it is set the search stops and returns None. Used by find_closed_orbit_range() to stop the other searches when one has converged.
 	"""
 	zlog.debug("enter function")
 	if init_YTZP is None:
@@ -397,6 +442,9 @@ def find_closed_orbit(line, init_YTZP=None, max_iterations=100, fai_label = None
 	laps = []
 	close_orbit_found = 0
 	for iteration in range(max_iterations):
+		if cancel is not None and cancel.is_set():
+			zlog.debug("search cancelled")
+			return None
 		zlog.debug("start iteration: "+str(iteration)+ " with coords "+str(current_YTZP))
 		coords.append(current_YTZP)
 		objet.clear()	# remove existing particles
@@ -507,6 +555,109 @@ def find_closed_orbit(line, init_YTZP=None, max_iterations=100, fai_label = None
 		return None
 
 
+def find_closed_orbit_newton(line, init_YTZP=None, max_iterations=20, fai_label=None, tol=1e-6, D=1, steps_YTZP=None, record_fname=None, return_iterations=False):
+	"""Find a closed orbit for the line using Newton's method. Takes the same line as find_closed_orbit(), and can be used in its place.
+
+	Each iteration tracks a reference particle and particles with +- steps_YTZP offsets in Y, T, Z and P for one turn, in a single run. This gives the one turn map and its Jacobian, and a Newton step is taken to where the map would return to the start. Near the closed orbit the convergence is quadratic, so usually just a few runs are needed.
+
+	If there is a REBELOTE, only the first lap is used. Returns None if a particle is lost, or the search does not converge within max_iterations.
+	steps_YTZP: offsets used for the Jacobian, default [0.001, 0.01, 0.001, 0.01] (cm, mrad), as for OBJET5
+	record_fname: write the start and end of each iteration, for use with plot_find_closed_orbit()
+	return_iterations: if True return (closed_orbit, iterations)
+	"""
+	zlog.debug("enter function")
+	if init_YTZP is None:
+		init_YTZP = [0, 0, 0, 0]
+	if steps_YTZP is None:
+		steps_YTZP = [0.001, 0.01, 0.001, 0.01]
+	steps_YTZP = numpy.asarray(steps_YTZP, dtype=float)
+
+	if record_fname:
+		record_fh = open_file_or_name(record_fname, "w", mkdir=True)
+	for e in line.element_list:
+		if ("OBJET2" in str(type(e)).split("'")[1]):
+			objet = e
+			break
+	else:
+		raise ValueError("Line has no OBJET2 element")
+	line.full_tracking(False)
+
+	# reference particle, then + and - steps in each coordinate
+	offsets = numpy.zeros([9, 4])
+	for x in range(4):
+		offsets[2*x+1, x] = steps_YTZP[x]
+		offsets[2*x+2, x] = -steps_YTZP[x]
+
+	current_YTZP = numpy.array(init_YTZP, dtype=float)
+	closed_orbit = None
+	for iteration in range(max_iterations):
+		zlog.debug("start iteration: "+str(iteration)+ " with coords "+str(current_YTZP))
+		start = current_YTZP + offsets
+		objet.clear()
+		objet.add(Y=start[:, 0], T=start[:, 1], Z=start[:, 2], P=start[:, 3], LET='A', D=D)
+
+		r = line.run(xterm=False)
+		try:
+			ftrack = r.get_all('fai')
+		except IOError:
+			ftrack = numpy.zeros(0)
+		line.clean()
+		if len(ftrack) == 0:
+			zlog.warning("No particles reached the end of the cell. Iteration %d"%iteration)
+			break
+		if fai_label is not None:
+			ftrack = ftrack[numpy.char.strip(ftrack['element_label1'].astype(str)) == fai_label]
+		else:
+			ftrack = ftrack[ftrack['NOEL'] == ftrack['NOEL'].max()]
+		ftrack = ftrack[ftrack['PASS'] == ftrack['PASS'].min()]
+
+		end = numpy.zeros([9, 4]) + numpy.nan
+		ok = ftrack['IEX'] > 0
+		for x, coord in enumerate("YTZP"):
+			end[ftrack['ID'][ok] - 1, x] = ftrack[coord][ok]
+		if numpy.isnan(end).any():
+			zlog.warning("Particles lost near orbit. Iteration %d"%iteration)
+			break
+
+		if record_fname:
+			record_fh.write("#track 2\n")
+			numpy.savetxt(record_fh, [start[0], end[0]])
+			record_fh.flush()
+
+		# solve (J - I) dx = -(F(x) - x), with J from central differences
+		jacobian = ((end[1::2] - end[2::2]) / (2 * steps_YTZP[:, None])).T
+		residual = end[0] - current_YTZP
+		try:
+			step = numpy.linalg.solve(jacobian - numpy.identity(4), -residual)
+		except numpy.linalg.LinAlgError:
+			zlog.warning("One turn map is singular. Iteration %d"%iteration)
+			break
+		prev_YTZP = current_YTZP
+		current_YTZP = current_YTZP + step
+		zlog.debug("End iteration: "+str(iteration)+ " residual "+str(residual)+", new coords "+str(current_YTZP))
+
+		difs = numpy.zeros(4)
+		for x in range(4):
+			if abs(prev_YTZP[x]) < tol or abs(current_YTZP[x]) < tol:
+				difs[x] = abs(prev_YTZP[x] - current_YTZP[x])
+			else:
+				difs[x] = abs((prev_YTZP[x] - current_YTZP[x])/ prev_YTZP[x])
+		if difs.max() < tol:
+			closed_orbit = current_YTZP
+			break
+
+	iterations = iteration + 1
+	if closed_orbit is not None:
+		zlog.info("found closed orbit in %d iterations"%iterations)
+		print("found closed orbit in %d iterations"%iterations)
+		print("Y=%s, T=%s, Z=%s, P=%s" % tuple(closed_orbit))
+	elif iterations == max_iterations:
+		zlog.warn("Iterations did not converge, no closed orbit found")
+	if return_iterations:
+		return closed_orbit, iterations
+	return closed_orbit
+
+
 def plot_find_closed_orbit(data_fname, outfile=None):
 	"""When the closed orbit search fails it can be useful to see what happened. find_closed_orbit() and find_closed_orbit_range() can take an optional argument record_fname. This causes them to write a log file, which can be read by this function and plotted. ::
 
@@ -596,7 +747,7 @@ def plot_find_closed_orbit(data_fname, outfile=None):
 				pylab.show()
 
 
-def get_twiss_profiles(line, file_result=None, input_twiss_parameters=None, calc_dispersion = True, interpolate = True):
+def get_twiss_profiles(line, file_result=None, input_twiss_parameters=None, calc_dispersion = True, interpolate = True, results=None):
 	""" Calculates the twiss parameters at all points written to zgoubi.plt. 11 particle trajectories are used to calculate the
 	transfer matrix, just as is done in zgoubi. The code mirrors that found in mat1.f, mksa.f. The twiss parameters are first
 	calculated at the end of the cell using either input_twiss_parameters (format given below) or, if this is not supplied, 
@@ -616,6 +767,8 @@ def get_twiss_profiles(line, file_result=None, input_twiss_parameters=None, calc
 	
 	interpolate: If a azimuthal coordinate X exists, interpolate onto the reference X. X is azimuthal angle in the case of radial elements. 
 
+	results: the Results of a run of line that has already been done, in which case line is not run again (though it is still run to calculate dispersion).
+
 	The results are stored a in structured numpy array called twiss_profiles containing the following elements at every point tracked in the magnets 
 	(i.e. a point in zgoubi.plt)
 	[s_coord, label,  mu_y, beta_y, alpha_y, gamma_y, disp_y, disp_py, mu_z, beta_z, alpha_z, gamma_z, disp_z, disp_p]
@@ -641,224 +794,90 @@ def get_twiss_profiles(line, file_result=None, input_twiss_parameters=None, calc
 	if not (has_object5 and (has_matrix or input_twiss_parameters is not None)):
 		raise BadLineError("beamline need to have an OBJET with kobj=5 (OBJET5), and a MATRIX elementi to get tune")
 
-	#run Zgoubi
-	r = line.run(xterm = False)
+	#run Zgoubi, unless the results are already available
+	if results is None:
+		r = line.run(xterm = False)
+	else:
+		r = results
 
-	tof_ref = None
-	mass_mev = None
-	charge = None
-	
 	#extract rigidty from fai or plt file. At least one of these files must be available. 
-	#if fai file present, extract tof_ref, mass and charge.
 	try:
 		#rigidity used in calculation of dispersion
-		rig  = r.get_track('fai', ['BORO'])[0][0]
-		#tof of ref trajectory for later calculation of phase slip
-		tof_ref = r.get_track('fai', ['tof'])[0][0]
-		#mass, charge allows calculation of lorentz gamma
-		mass_mev = r.get_track('fai', ['M'])[0][0]
-		charge= r.get_track('fai', ['Q'])[0][0]
+		rig = r.get_all('fai')['BORO'][0]
 	except:
-		rig  = r.get_track('plt', ['BORO'])[0][0]
-	
-	##Calculate Lorentz factor if mass and charge are known
-	#if mass_mev is not None and charge is not None:
-		#ke = rigidity_to_ke(mass_mev*1e6, rig*1e-3, charge)
-		#gamma_lorentz = ke_to_gamma(mass_mev*1e6, ke)
-	
-
+		rig = r.get_all('plt')['BORO'][0]
 
 #!-----------------------------------------------------------------------------------------
 #!  PREPARE DATA FOR CALCULATION
 #!-----------------------------------------------------------------------------------------
 	try:
-		try:
-			plt_track = r.get_track('plt', ['LET', 'D0', 'Y0', 'T0', 'Z0', 'P0', 'D', 'Y', 'T', 'Z', 'P', 'S'])
-			track_type = 'plt'
-		except IOError:
-			plt_track = r.get_track('fai', ['LET', 'D0', 'Y0', 'T0', 'Z0', 'P0', 'D', 'Y', 'T', 'Z', 'P', 'S'])
-			track_type = 'fai'
-	except ValueError:
-		# also 'D' is now know as 'D-1'
-		try:
-			plt_track = r.get_track('plt', ['LET', 'D0-1', 'Y0', 'T0', 'Z0', 'P0', 'D-1', 'Y', 'T', 'Z', 'P', 'S'])
-			track_type = 'plt'
-		except IOError:
-			plt_track = r.get_track('fai', ['LET', 'D0-1', 'Y0', 'T0', 'Z0', 'P0', 'D-1', 'Y', 'T', 'Z', 'P', 'S'])
-			track_type = 'fai'
-		
-	X_exists = False
-	#try to get azimuthal coordinate X
-	try:
-		X1 = r.get_track('plt','X')
-		X = list(map(list, zip(*X1)))[0]
-		X_exists = True
+		track = r.get_all('plt')
+		track_type = 'plt'
 	except IOError:
-		pass
-
-	transpose_plt_track = list(map(list, zip(*plt_track)))
-	track_tag = transpose_plt_track[0]
-	D0 = transpose_plt_track[1]
-	Y0 = transpose_plt_track[2]
-	T0 = transpose_plt_track[3]
-	Z0 = transpose_plt_track[4]			
-	P0 = transpose_plt_track[5]
-	D = transpose_plt_track[6]
-	Y = transpose_plt_track[7]
-	T = transpose_plt_track[8]
-	Z = transpose_plt_track[9]
-	P = transpose_plt_track[10]	
-	S = transpose_plt_track[11]
-	
-	if track_type == 'plt':
-		#X = transpose_plt_track[13]
-		#read labels
-		label = [x[0].strip() for x in r.get_track('plt', ['element_label1'])]
-	else:
-		#X = [0 for x in xrange(len(S))]
-		label = [x[0].strip() for x in r.get_track('fai', ['element_label1'])]
-
-
-	#sort out individual tracks
-	alphabet = "A,B,C,D,E,F,G,H,I,J,K,L,M,N,P,Q,R,S,T,U,V,W,X,Y,Z"
-	alphabet = alphabet.split(",")
-
-	D0_alltracks = []
-	Y_alltracks = []
-	Y0_alltracks = []
-	T_alltracks = []
-	T0_alltracks = []
-	Z_alltracks = []
-	Z0_alltracks = []
-	P_alltracks = []
-	P0_alltracks = []		
-	S_alltracks = []
-	X_alltracks = []
-	label_ref = []
-	Y_track = []
-	T_track = []
-	Z_track = []
-	P_track = []
-	S_track = []
-	if X_exists:
-		X_track = []
-	#first add track coords for reference track
-	ref_indices = find_indices(track_tag, 'O')
-	D0_alltracks.append(D0[ref_indices[0]])
-	Y0_alltracks.append(Y0[ref_indices[0]])
-	T0_alltracks.append(T0[ref_indices[0]])
-	Z0_alltracks.append(Z0[ref_indices[0]])
-	P0_alltracks.append(P0[ref_indices[0]])
-	for i in ref_indices:
-		Y_track.append(Y[i])
-		T_track.append(T[i])
-		Z_track.append(Z[i])
-		P_track.append(P[i])
-		S_track.append(S[i])
-		if X_exists:
-			X_track.append(X[i])
-		label_ref.append(label[i])
-	Y_alltracks.append(Y_track)
-	T_alltracks.append(T_track)
-	Z_alltracks.append(Z_track)
-	P_alltracks.append(P_track)
-	S_alltracks.append(S_track)
+		track = r.get_all('fai')
+		track_type = 'fai'
+	# also 'D' is now know as 'D-1'
+	d0_col = 'D0' if 'D0' in track.dtype.names else 'D0-1'
+	X_exists = track_type == 'plt' and 'X' in track.dtype.names
+
+	#sort out individual tracks, the reference O first, then the others in alphabetical order
+	let_names, let_codes = numpy.unique(numpy.asarray(track['LET']).astype('U'), return_inverse=True)
+	let_names = [l.strip() for l in let_names]
+	# a stable sort keeps each ray in the order it was tracked
+	order = numpy.argsort(let_codes, kind='stable')
+	bounds = numpy.searchsorted(let_codes[order], numpy.arange(len(let_names)+1))
+	rays = dict((l, order[bounds[n]:bounds[n+1]]) for n, l in enumerate(let_names))
+	ray_indices = [rays.pop('O')] + [rays[l] for l in sorted(rays)]
+	ref_indices = ray_indices[0]
+
+	first = numpy.array([ind[0] for ind in ray_indices])
+	D0_alltracks = track[d0_col][first]
+	start_coords = numpy.array([track[c][first] for c in ['Y0', 'T0', 'Z0', 'P0']])
+	labels, label_codes = numpy.unique(numpy.asarray(track['element_label1'][ref_indices]).astype('U'), return_inverse=True)
+	label_ref = numpy.char.strip(labels)[label_codes]
+
+	coord_names = ['Y', 'T', 'Z', 'P', 'S']
+	n_ref = len(ref_indices)
+	len_trajs = [len(ind) for ind in ray_indices]
+	len_trajs_equal = all(l == n_ref for l in len_trajs)
 	if X_exists:
-		X_alltracks.append(X_track)
-	#add other tracks
-	for track_tag_name in alphabet:
-		Y_track = []
-		T_track = []
-		Z_track = []
-		P_track = []
-		S_track = []
-		if X_exists:	
-			X_track = []
-		indices = find_indices(track_tag, track_tag_name)
-		if len(indices) == 0:
-			break
-		else:
-			D0_alltracks.append(D0[indices[0]])
-			Y0_alltracks.append(Y0[indices[0]])
-			T0_alltracks.append(T0[indices[0]])
-			Z0_alltracks.append(Z0[indices[0]])
-			P0_alltracks.append(P0[indices[0]])
-			for i in indices:
-				Y_track.append(Y[i])
-				T_track.append(T[i])
-				Z_track.append(Z[i])
-				P_track.append(P[i])
-				S_track.append(S[i])
-				if X_exists:
-					X_track.append(X[i])
-			Y_alltracks.append(Y_track)
-			T_alltracks.append(T_track)
-			Z_alltracks.append(Z_track)
-			P_alltracks.append(P_track)
-			S_alltracks.append(S_track)
-			if X_exists:
-				X_alltracks.append(X_track)
+		X_ref = track['X'][ref_indices]
 
-	#check all trajectories have equal number of elements
-	len_trajs = [len(s) for s  in S_alltracks]
-	len_trajs_equal = len_trajs and all(len_trajs[0] == elem for elem in len_trajs)
-
-	
-	if not len_trajs_equal and not X_exists:
-		#interpolate all trajectories onto reference s
-		Y_alltracks_interp = [Y_alltracks[0]]
-		T_alltracks_interp = [T_alltracks[0]]
-		Z_alltracks_interp = [Z_alltracks[0]]
-		P_alltracks_interp = [P_alltracks[0]]
-		for index in range(1,len(S_alltracks)):
-			Y_alltracks_interp.append(numpy.interp(S_alltracks[0], S_alltracks[index], Y_alltracks[index]))
-			T_alltracks_interp.append(numpy.interp(S_alltracks[0], S_alltracks[index], T_alltracks[index]))
-			Z_alltracks_interp.append(numpy.interp(S_alltracks[0], S_alltracks[index], Z_alltracks[index]))
-			P_alltracks_interp.append(numpy.interp(S_alltracks[0], S_alltracks[index], P_alltracks[index]))
-		
-		Y_alltracks = Y_alltracks_interp
-		T_alltracks = T_alltracks_interp
-		Z_alltracks = Z_alltracks_interp
-		P_alltracks = P_alltracks_interp
-		S_alltracks = [S_alltracks[0] for s in range(len(S_alltracks))]
-	
 	if X_exists and interpolate:
 		#interpolate all trajectories onto reference X
-		
-		
 		#force X to increase monotonically. 
 		#At the start of each new element, add X from the end of the previous element. Also add 1e-15 to avoid degeneracy problems when
 		#interpolating
-		X_alltracks_m = []
-		for xt in X_alltracks:
-			offset = 0
-			xt_m = []
-			for ind, th in enumerate(xt):
-				if ind > 1:
-					if th < xt[ind-1]:
-						offset = offset + xt[ind-1] + 1e-15
-				xt_m.append(th+offset)
-			X_alltracks_m.append(xt_m)
-
-		Y_alltracks_interp = [Y_alltracks[0]]
-		T_alltracks_interp = [T_alltracks[0]]
-		Z_alltracks_interp = [Z_alltracks[0]]
-		P_alltracks_interp = [P_alltracks[0]]
-		S_alltracks_interp = [S_alltracks[0]]
-		for index in range(1,len(S_alltracks)):
-			Y_alltracks_interp.append(numpy.interp(X_alltracks_m[0], X_alltracks_m[index], Y_alltracks[index]))
-			T_alltracks_interp.append(numpy.interp(X_alltracks_m[0], X_alltracks_m[index], T_alltracks[index]))
-			Z_alltracks_interp.append(numpy.interp(X_alltracks_m[0], X_alltracks_m[index], Z_alltracks[index]))
-			P_alltracks_interp.append(numpy.interp(X_alltracks_m[0], X_alltracks_m[index], P_alltracks[index]))
-			S_alltracks_interp.append(numpy.interp(X_alltracks_m[0], X_alltracks_m[index], S_alltracks[index]))
-		
-		Y_alltracks = list(Y_alltracks_interp)
-		T_alltracks = list(T_alltracks_interp)
-		Z_alltracks = list(Z_alltracks_interp)
-		P_alltracks = list(P_alltracks_interp)
-		S_alltracks = list(S_alltracks_interp)
-		
-	#11 coordinate in Y0_alltracks,T0_alltracks etc correspond to 11 starting conditions required by MATRIX
+		def monotonic(xt):
+			offset = numpy.zeros(len(xt))
+			if len(xt) > 2:
+				drop = xt[2:] < xt[1:-1]
+				offset[2:][drop] = xt[1:-1][drop] + 1e-15
+			return xt + numpy.cumsum(offset)
+		X_ref_m = monotonic(X_ref)
+		coords = numpy.zeros([len(ray_indices), len(coord_names), n_ref])
+		for ray, ind in enumerate(ray_indices):
+			X_m = monotonic(track['X'][ind])
+			for n, c in enumerate(coord_names):
+				coords[ray, n] = track[c][ind] if ray == 0 else numpy.interp(X_ref_m, X_m, track[c][ind])
+	elif not len_trajs_equal and not X_exists:
+		#interpolate all trajectories onto reference s
+		S_ref = track['S'][ref_indices]
+		coords = numpy.zeros([len(ray_indices), len(coord_names), n_ref])
+		for ray, ind in enumerate(ray_indices):
+			for n, c in enumerate(coord_names):
+				coords[ray, n] = S_ref if c == 'S' else track[c][ind] if ray == 0 else numpy.interp(S_ref, track['S'][ind], track[c][ind])
+	else:
+		# equal lengths, or trajectories cut to the shortest
+		n_points = min(len_trajs)
+		coords = numpy.array([[track[c][ind[:n_points]] for c in coord_names] for ind in ray_indices])
+		if n_points != n_ref:
+			label_ref = label_ref[:n_points]
+			ref_indices = ref_indices[:n_points]
+			if X_exists:
+				X_ref = X_ref[:n_points]
+
+	#11 coordinate in start_coords, coords etc correspond to 11 starting conditions required by MATRIX
 
 #!-----------------------------------------------------------------------------------------
 #!  TRANSFER MATRIX CALCULATION AT ALL POINTS in PLT file (as in zgoubi source file mat1.f)
@@ -878,88 +897,25 @@ def get_twiss_profiles(line, file_result=None, input_twiss_parameters=None, calc
 #$\begin{pmatrix}
 #$ Y \\ T \\ Z \\ P \\ X \\ D \end{pmatrix}
 
-	#initialise transfer matrix
-	#transfer_matrix = zeros((6, 6))
+	# R[i, j, point] for rows Y, T, Z, P, S and columns Y0, T0, Z0, P0, (X0), D0
+	R = numpy.zeros([5, 6, coords.shape[2]])
 
 	#momentum ratio DP
 	# FORTRAN (mat1.f)   DP = ( FO(1,I10) - FO(1,I11) ) / (.5D0*( FO(1,I10) + FO(1,I11) ) )
 	DP = ((1+D0_alltracks[9])-(1+D0_alltracks[10]))/(0.5*((1+D0_alltracks[9])+(1+D0_alltracks[10])))
-
-	#Transfer matrix elements R(J-1,6), J in range (2,6)
 	# FORTRAN (mat1.f)   R(J-1,6)  = (F(J,I10) - F(J,I11)) /DP
-	R16_list = [x/DP for x in map(numpy.subtract, Y_alltracks[9], Y_alltracks[10])]
-	R26_list = [x/DP for x in map(numpy.subtract, T_alltracks[9], T_alltracks[10])]
-	R36_list = [x/DP for x in map(numpy.subtract, Z_alltracks[9], Z_alltracks[10])]
-	R46_list = [x/DP for x in map(numpy.subtract, P_alltracks[9], P_alltracks[10])]
-	R56_list = [x/DP for x in map(numpy.subtract, S_alltracks[9], S_alltracks[10])]
-	#-----------------------------------------------------------------------------------------
-
-	#assume it1=1
-	it1 = 1
-	for i in range(1, 5):
-		i2 = 2*i +it1-1
-		i3 = i2 + 1
-		#adjust indices since python lists are numbered from zero
-		i2 = i2 - 1
-		i3 = i3 - 1
-		if i == 1:
-			UO = Y0_alltracks[i2]-Y0_alltracks[i3]
-			R11_list =  [x/UO for x in map(numpy.subtract, Y_alltracks[i2], Y_alltracks[i3])]
-			R21_list =  [x/UO for x in map(numpy.subtract, T_alltracks[i2], T_alltracks[i3])]
-			R31_list =  [x/UO for x in map(numpy.subtract, Z_alltracks[i2], Z_alltracks[i3])]
-			R41_list =  [x/UO for x in map(numpy.subtract, P_alltracks[i2], P_alltracks[i3])]
-			R51_list =  [x/UO for x in map(numpy.subtract, S_alltracks[i2], S_alltracks[i3])]
-		elif i == 2:
-			UO = T0_alltracks[i2]-T0_alltracks[i3]
-			R12_list =  [x/UO for x in map(numpy.subtract, Y_alltracks[i2], Y_alltracks[i3])]
-			R22_list =  [x/UO for x in map(numpy.subtract, T_alltracks[i2], T_alltracks[i3])]
-			R32_list =  [x/UO for x in map(numpy.subtract, Z_alltracks[i2], Z_alltracks[i3])]
-			R42_list =  [x/UO for x in map(numpy.subtract, P_alltracks[i2], P_alltracks[i3])]
-			R52_list =  [x/UO for x in map(numpy.subtract, S_alltracks[i2], S_alltracks[i3])]
-		elif i == 3:
-			UO = Z0_alltracks[i2]-Z0_alltracks[i3]
-			R13_list =  [x/UO for x in map(numpy.subtract, Y_alltracks[i2], Y_alltracks[i3])]
-			R23_list =  [x/UO for x in map(numpy.subtract, T_alltracks[i2], T_alltracks[i3])]
-			R33_list =  [x/UO for x in map(numpy.subtract, Z_alltracks[i2], Z_alltracks[i3])]
-			R43_list =  [x/UO for x in map(numpy.subtract, P_alltracks[i2], P_alltracks[i3])]
-			R53_list =  [x/UO for x in map(numpy.subtract, S_alltracks[i2], S_alltracks[i3])]
-		elif i == 4:
-			UO = P0_alltracks[i2]-P0_alltracks[i3]
-			R14_list =  [x/UO for x in map(numpy.subtract, Y_alltracks[i2], Y_alltracks[i3])]
-			R24_list =  [x/UO for x in map(numpy.subtract, T_alltracks[i2], T_alltracks[i3])]
-			R34_list =  [x/UO for x in map(numpy.subtract, Z_alltracks[i2], Z_alltracks[i3])]
-			R44_list =  [x/UO for x in map(numpy.subtract, P_alltracks[i2], P_alltracks[i3])]
-			R54_list =  [x/UO for x in map(numpy.subtract, S_alltracks[i2], S_alltracks[i3])]
-		
+	R[:, 5] = (coords[9] - coords[10]) / DP
+
+	# columns 1 to 4 from the pairs of rays offset in Y0, T0, Z0, P0
+	for j in range(4):
+		UO = start_coords[j, 2*j+1] - start_coords[j, 2*j+2]
+		R[:, j] = (coords[2*j+1] - coords[2*j+2]) / UO
+
 #!----------------------------------
 #! Adjust units to SI (as in mksa.f)
 #!----------------------------------
-	unit_list = [1e-2, 1e-3, 1e-2, 1e-3, 1e-2, 1, 1e-6]
-	R21_list = [x*unit_list[1]/unit_list[0] for x in R21_list]
-	R31_list = [x*unit_list[2]/unit_list[0] for x in R31_list]
-	R41_list = [x*unit_list[3]/unit_list[0] for x in R41_list]
-	R51_list = [x*unit_list[4]/unit_list[0] for x in R51_list]
-
-	R12_list = [x*unit_list[0]/unit_list[1] for x in R12_list]
-	R32_list = [x*unit_list[2]/unit_list[1] for x in R32_list]
-	R42_list = [x*unit_list[3]/unit_list[1] for x in R42_list]
-	R52_list = [x*unit_list[4]/unit_list[1] for x in R52_list]
-
-	R13_list = [x*unit_list[0]/unit_list[2] for x in R13_list]
-	R23_list = [x*unit_list[1]/unit_list[2] for x in R23_list]
-	R43_list = [x*unit_list[3]/unit_list[2] for x in R43_list]
-	R53_list = [x*unit_list[4]/unit_list[2] for x in R53_list]
-
-	R14_list = [x*unit_list[0]/unit_list[3] for x in R14_list]
-	R24_list = [x*unit_list[1]/unit_list[3] for x in R24_list]
-	R34_list = [x*unit_list[2]/unit_list[3] for x in R34_list]
-	R54_list = [x*unit_list[4]/unit_list[3] for x in R54_list]
-
-	R16_list = [x*unit_list[0]/unit_list[5] for x in R16_list]
-	R26_list = [x*unit_list[1]/unit_list[5] for x in R26_list]
-	R36_list = [x*unit_list[2]/unit_list[5] for x in R36_list]
-	R46_list = [x*unit_list[3]/unit_list[5] for x in R46_list]
-	R56_list = [x*unit_list[4]/unit_list[5] for x in R56_list]
+	unit_list = numpy.array([1e-2, 1e-3, 1e-2, 1e-3, 1e-2, 1])
+	R *= (unit_list[:5, numpy.newaxis] / unit_list[numpy.newaxis, :])[..., numpy.newaxis]
 	
 #! Get inital twiss paramters. If no input_twiss_parameters supplied, assume cell is periodic and find results using get_twiss_parameters
 	if input_twiss_parameters is None:
@@ -985,7 +941,6 @@ def get_twiss_profiles(line, file_result=None, input_twiss_parameters=None, calc
 #!Calculate horizontal and vertical dispersion. Start tracking at y_co + del_p*disp_y
 #########################################################################
 
-	
 	if calc_dispersion:
 		del_p = 0.0001 #momentum shift
 		line = copy.copy(line)
@@ -1000,20 +955,21 @@ def get_twiss_profiles(line, file_result=None, input_twiss_parameters=None, calc
 
 		#reference index
 		ind0 = ref_indices[0]
+		D0_ref = track[d0_col][ind0]
 
 		closedorb_YTZP = None
 		#Try to find closed orbit of off-momentum particle, other wise use dispersion to estimate closed orbit
 		if input_twiss_parameters is None:
-			closedorb_YTZP = find_closed_orbit(line, init_YTZP=[0,0,0,0], tol=1e-5, D=(1+ D0[ind0])*(1+del_p))
+			closedorb_YTZP = find_closed_orbit(line, init_YTZP=[0,0,0,0], tol=1e-5, D=(1+ D0_ref)*(1+del_p))
 
 		if closedorb_YTZP is not None:
 			ob2.clear()
-			ob2.add(Y=closedorb_YTZP[0], T=closedorb_YTZP[1],Z=0,P=0, D=(1+ D0[ind0])*(1+del_p))
+			ob2.add(Y=closedorb_YTZP[0], T=closedorb_YTZP[1],Z=0,P=0, D=(1+ D0_ref)*(1+del_p))
 		else:
 			#Closed orbit of off-momentum particle determined by dispersion (for small del_p)
 			ob2.clear()
-			ob2.add(Y=Y0[ind0] + del_p*disp_y_0*cm_, T=T0[ind0] + del_p*disp_py_0*mm_, 
-				Z=Z0[ind0] + del_p*disp_z_0*cm_, P=P0[ind0] + del_p*disp_pz_0*mm_, D=(1+ D0[ind0])*(1+del_p))
+			ob2.add(Y=track['Y0'][ind0] + del_p*disp_y_0*cm_, T=track['T0'][ind0] + del_p*disp_py_0*mm_, 
+				Z=track['Z0'][ind0] + del_p*disp_z_0*cm_, P=track['P0'][ind0] + del_p*disp_pz_0*mm_, D=(1+ D0_ref)*(1+del_p))
 		
 		reb.set(NPASS=0)
 		#restore full_tracking if necessary 
@@ -1021,62 +977,25 @@ def get_twiss_profiles(line, file_result=None, input_twiss_parameters=None, calc
 		    line.full_tracking(True)
 		
 		r = line.run(xterm = False)
-		
-		if track_type == 'plt':
-		    plt_track_disp = r.get_track('plt', ['LET', 'Y', 'T', 'Z', 'P', 'S'])
-		else:
-		    plt_track_disp = r.get_track('fai', ['LET', 'Y', 'T', 'Z', 'P', 'S'])
-
-		transpose_plt_track_disp = list(map(list, zip(*plt_track_disp)))
-		y_disp = transpose_plt_track_disp[1]
-		t_disp = transpose_plt_track_disp[2]
-		z_disp = transpose_plt_track_disp[3]
-		p_disp = transpose_plt_track_disp[4]
-		s_disp = transpose_plt_track_disp[5]
+		track_disp = r.get_all(track_type)
+		disp_coords = [track_disp[c] for c in ['Y', 'T', 'Z', 'P']]
 		
 		if X_exists and interpolate:
-			X1d = r.get_track('plt','X')
-			x_disp = list(map(list, zip(*X1d)))[0]
-			y_disp = numpy.interp(X_alltracks_m[0], x_disp, y_disp)
-			t_disp = numpy.interp(X_alltracks_m[0], x_disp, t_disp)
-			z_disp = numpy.interp(X_alltracks_m[0], x_disp, z_disp)
-			p_disp = numpy.interp(X_alltracks_m[0], x_disp, p_disp)
-			s_disp = numpy.interp(X_alltracks_m[0], x_disp, s_disp)
+			x_disp = track_disp['X']
+			disp_coords = [numpy.interp(X_ref_m, x_disp, dc) for dc in disp_coords]
 				
-		disp_y_list = [xd*cm/del_p for xd in map(numpy.subtract, y_disp, Y_alltracks[0])]
-		disp_py_list = [xd*mm/del_p for xd in map(numpy.subtract, t_disp, T_alltracks[0])]
-		disp_z_list = [xd*mm/del_p for xd in map(numpy.subtract, z_disp, Z_alltracks[0])]
-		disp_pz_list = [xd*mm/del_p for xd in map(numpy.subtract, p_disp, P_alltracks[0])]
-			
-		##go on to calculate phase slip and transition gamma if enough information available
-		#if tof_ref is not None:
-			##calculate off-momentum tof. Assume just one point
-			#tof_delp = r.get_track('fai', ['tof'])[0][0]
-			##calculate phase slip factor, often given the symbol eta
-			#phase_slip = abs((tof_delp - tof_ref)/(del_p*tof_ref))
-
-
-			##calculate transition gamma if gamma_lorentz is known, i.e. if mass and charge are known
-			#if mass_mev is not None and charge is not None:
-				#momentum_compaction = phase_slip + (1/(gamma_lorentz**2))
-				#gamma_transition = (1/momentum_compaction)**0.5
-			#else:
-				#gamma_transition = None
-		#else:
-			#phase_slip = None
-			#gamma_transition = None
+		disp_y_list = (disp_coords[0] - coords[0, 0]) * cm / del_p
+		disp_py_list = (disp_coords[1] - coords[0, 1]) * mm / del_p
+		disp_z_list = (disp_coords[2] - coords[0, 2]) * mm / del_p
+		disp_pz_list = (disp_coords[3] - coords[0, 3]) * mm / del_p
 
 		#replace original objet
 		line.replace(ob2,objet)
 	else:
-		#disp_y_list = [0]*len(Y_alltracks[0])
-		disp_y_list = [-1]*len(Y_alltracks[0])
-		disp_py_list = [-1]*len(Y_alltracks[0])
-		disp_z_list = [-1]*len(Y_alltracks[0])
-		disp_pz_list = [-1]*len(Y_alltracks[0])
-		phase_slip = None
-		gamma_transition = None
-
+		disp_y_list = -numpy.ones(coords.shape[2])
+		disp_py_list = -numpy.ones(coords.shape[2])
+		disp_z_list = -numpy.ones(coords.shape[2])
+		disp_pz_list = -numpy.ones(coords.shape[2])
 
 
 #! Calculate twiss parameters at all points in plt file 
@@ -1087,135 +1006,59 @@ def get_twiss_profiles(line, file_result=None, input_twiss_parameters=None, calc
 #! - e.g. S.Y.Lee Accelerator physics equation 2.54
 #! - The phase advance can be found by applying a Floquet transformation to the transfer matrix (S.Y.Lee eqn 2.65)
 
- 
-	if file_result is not None:
-		fresults = open(file_result, 'w')
-		print('#%8s %5s %9s %9s %9s %9s %9s %9s %9s %9s %9s %9s %9s %9s' % ("s", "label", \
-			"mu_y", "beta_y", "alpha_y", "gamma_y","disp_y","disp_py",\
-			"mu_z", "beta_z", "alpha_z", "gamma_z","disp_z","disp_pz"), file=fresults)
-              
-	mu_y_list = []
-	beta_y_list = []
-	alpha_y_list = []
-	gamma_y_list = []
-	mu_z_list = []
-	beta_z_list = []
-	alpha_z_list = []
-	gamma_z_list = []
-	sign_sine_y_old = 1.0
-	sign_sine_z_old = 1.0
-	n_pi_y = 0
-	n_pi_z = 0
-	try:
-		for i in range(len(R11_list)):
-
-			#check stability first
-			if beta_y_0 != 0.0:
-				# Horizontal plane
-				#-----------------
-				beta_y = (R11_list[i]**2)*beta_y_0 - 2.0*R11_list[i]*R12_list[i]*alpha_y_0 + (R12_list[i]**2)*gamma_y_0
-				beta_y_list.append(beta_y)
-
-				# Horizontal phase advance calculation
-				# To account for range of acos=(0,Pi), check sign of sin(angle) to know when to change from angle to (2*Pi-angle) etc.	
-				sine_angle = R12_list[i]/sqrt(beta_y*beta_y_0)
-				if abs(sine_angle) > 1: 
-					if i!=0:
-						mu_y_list.append(mu_y_list[i-1])
-					else:
-						mu_y_list.append(0)
-				else:
-					sign_sine_y = numpy.sign(asin(sine_angle))
-					if sign_sine_y - sign_sine_y_old == -2:
-						n_pi_y = n_pi_y + 1
-					sign_sine_y_old = sign_sine_y
-					try:
-						if sign_sine_y >= 0:
-							mu_y_list.append(n_pi_y*2*pi+acos(sqrt(beta_y_0/beta_y)*R11_list[i]-alpha_y_0*R12_list[i]/(beta_y*beta_y_0)**0.5))
-						else:
-							mu_y_list.append(n_pi_y*2*pi-acos(sqrt(beta_y_0/beta_y)*R11_list[i]-alpha_y_0*R12_list[i]/(beta_y*beta_y_0)**0.5))
-					except ValueError:
-						zlog.warn("Failed to calculate mu_y at i=%s"%i)
-						mu_y_list.append(0.0)
-
-				alpha_y_list.append(-R11_list[i]*R21_list[i]*beta_y_0 + (R11_list[i]*R22_list[i]+R12_list[i]*R21_list[i])*alpha_y_0 \
-					- R12_list[i]*R22_list[i]*gamma_y_0)
-				gamma_y_list.append((R21_list[i]**2)*beta_y_0-2*R21_list[i]*R22_list[i]*alpha_y_0+(R22_list[i]**2)*gamma_y_0)
-
-			else:
-				mu_y_list.append(0.0)
-				beta_y_list.append(0.0)
-				alpha_y_list.append(0.0)
-				gamma_y_list.append(0.0)
-
-			#check stability first
-			if beta_z_0 != 0.0:
-				# Vertical plane
-				#---------------
-				beta_z = (R33_list[i]**2)*beta_z_0 - 2.0*R33_list[i]*R34_list[i]*alpha_z_0 + (R34_list[i]**2)*gamma_z_0
-				beta_z_list.append(beta_z)
-
-				# Vertical phase advance calculation
-				sine_angle = R34_list[i]/sqrt(beta_z*beta_z_0)
-				if abs(sine_angle) > 1:
-					if i!=0:
-						mu_z_list.append(mu_z_list[i-1])
-					else:
-						mu_y_list.append(0)
-				else:
-					sign_sine_z = numpy.sign(asin(sine_angle))
-					if sign_sine_z - sign_sine_z_old == -2:
-						n_pi_z = n_pi_z + 1
-					sign_sine_z_old = sign_sine_z
-					try:
-						if sign_sine_z >= 0:
-							mu_z_list.append(n_pi_z*2*pi+acos(sqrt(beta_z_0/beta_z)*R33_list[i]-alpha_z_0*R34_list[i]/(beta_z*beta_z_0)**0.5))
-						else: 
-							mu_z_list.append(n_pi_z*2*pi-acos(sqrt(beta_z_0/beta_z)*R33_list[i]-alpha_z_0*R34_list[i]/(beta_z*beta_z_0)**0.5))
-					except ValueError:
-						zlog.warn("Failed to calculate mu_z at i=%s"%i)
-						mu_z_list.append(0.0)
-
-				alpha_z_list.append(-R33_list[i]*R43_list[i]*beta_z_0 + (R33_list[i]*R44_list[i]+R34_list[i]*R43_list[i])*alpha_z_0 \
-					- R34_list[i]*R44_list[i]*gamma_z_0)
-				gamma_z_list.append((R43_list[i]**2)*beta_z_0-2*R43_list[i]*R44_list[i]*alpha_z_0+(R44_list[i]**2)*gamma_z_0)
-
-			else:
-				mu_z_list.append(0.0)
-				beta_z_list.append(0.0)
-				alpha_z_list.append(0.0)
-				gamma_z_list.append(0.0)
-
-			if file_result is not None:
-				print('%2f %5s %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f' % (S_alltracks[0][i], label_ref[i], \
-					mu_y_list[i], beta_y_list[i], alpha_y_list[i], gamma_y_list[i],disp_y_list[i],disp_py_list[i],\
-					mu_z_list[i], beta_z_list[i], alpha_z_list[i], gamma_z_list[i],disp_z_list[i],disp_pz_list[i]), file=fresults)
-
-
-	except (IndexError, ZeroDivisionError, ValueError):
-		print("Error calculating twiss parameters from twiss matrix")
-		print("i=", i, "(", label[i], ")")
-		print("Matrix:")
-		for ai in range(1,7):
-			for aj in range(1,7):
-				if aj == 5 or ai == 6:
-					print("-\t", end=' ')
-					continue
-				print(eval("R%s%s_list[i]"%(ai,aj)),"\t", end=' ')
-			print()
-		raise
-
-	if file_result is not None:
-		fresults.close()
+	def plane_twiss(i, beta_0, alpha_0, gamma_0, plane):
+		"twiss functions along the line for one plane, from the 2x2 block of R starting at row and column i"
+		n_points = R.shape[2]
+		if beta_0 == 0.0:
+			return [numpy.zeros(n_points)] * 4
+		c, s = R[i, i], R[i, i+1]
+		cp, sp = R[i+1, i], R[i+1, i+1]
+		beta = c**2*beta_0 - 2.0*c*s*alpha_0 + s**2*gamma_0
+		alpha = -c*cp*beta_0 + (c*sp + s*cp)*alpha_0 - s*sp*gamma_0
+		gamma = cp**2*beta_0 - 2*cp*sp*alpha_0 + sp**2*gamma_0
+
+		if numpy.any(beta*beta_0 <= 0):
+			bad = numpy.flatnonzero(beta*beta_0 <= 0)[0]
+			print("Error calculating twiss parameters from twiss matrix")
+			print("i=", bad, "(", label_ref[bad], ")")
+			print("Matrix:")
+			print(R[:, :, bad])
+			raise ValueError("beta_%s is not positive at i=%s" % (plane, bad))
+
+		# Phase advance calculation
+		# To account for range of acos=(0,Pi), check sign of sin(angle) to know when to change from angle to (2*Pi-angle) etc.
+		# Where the sine is out of range, the phase advance is held at its previous value
+		sine_angle = s / numpy.sqrt(beta*beta_0)
+		valid = abs(sine_angle) <= 1
+		sign_sine = numpy.sign(sine_angle[valid])
+		sign_sine_old = numpy.concatenate([[1.0], sign_sine[:-1]])
+		n_pi = numpy.cumsum(sign_sine - sign_sine_old == -2)
+		with numpy.errstate(invalid='ignore'):
+			angle = numpy.arccos(numpy.sqrt(beta_0/beta[valid])*c[valid] - alpha_0*s[valid]/numpy.sqrt(beta[valid]*beta_0))
+		failed = numpy.isnan(angle)
+		if failed.any():
+			zlog.warn("Failed to calculate mu_%s at i=%s" % (plane, numpy.flatnonzero(valid)[failed]))
+		mu_valid = numpy.where(failed, 0.0, n_pi*2*pi + numpy.where(sign_sine >= 0, angle, -angle))
+
+		# carry the last valid phase advance forward, starting from 0
+		last_valid = numpy.maximum.accumulate(numpy.where(valid, numpy.arange(n_points), -1))
+		mu = numpy.zeros(n_points)
+		mu_all = numpy.zeros(n_points)
+		mu_all[valid] = mu_valid
+		mu[last_valid >= 0] = mu_all[last_valid[last_valid >= 0]]
+		return mu, beta, alpha, gamma
+
+	mu_y_list, beta_y_list, alpha_y_list, gamma_y_list = plane_twiss(0, beta_y_0, alpha_y_0, gamma_y_0, "y")
+	mu_z_list, beta_z_list, alpha_z_list, gamma_z_list = plane_twiss(2, beta_z_0, alpha_z_0, gamma_z_0, "z")
 
 	#create structured numpy array to hold twiss profile results
 	twiss_profiles = numpy.zeros(len(label_ref), dtype=[('s','f8'),('x','f8'),('label','a10'),('mu_y','f8'),('beta_y','f8'),('alpha_y','f8'),('gamma_y','f8'),\
 						('disp_y','f8'),('disp_py','f8'),('mu_z','f8'),('beta_z','f8'),('alpha_z','f8'),('gamma_z','f8'),('disp_z','f8'),('disp_pz','f8')])
 
 	#fill structured array
-	twiss_profiles['s'] = [s*cm for s in S_alltracks[0]]
+	twiss_profiles['s'] = coords[0, 4] * cm
 	if X_exists:
-		twiss_profiles['x'] = X_alltracks[0]
+		twiss_profiles['x'] = X_ref
 	twiss_profiles['label'] = label_ref
 	twiss_profiles['mu_y'] = mu_y_list
 	twiss_profiles['beta_y'] = beta_y_list
@@ -1229,6 +1072,16 @@ def get_twiss_profiles(line, file_result=None, input_twiss_parameters=None, calc
 	twiss_profiles['gamma_z'] = gamma_z_list
 	twiss_profiles['disp_z'] = disp_z_list
 	twiss_profiles['disp_pz'] = disp_pz_list
+
+	if file_result is not None:
+		with open(file_result, 'w') as fresults:
+			print('#%8s %5s %9s %9s %9s %9s %9s %9s %9s %9s %9s %9s %9s %9s' % ("s", "label", \
+				"mu_y", "beta_y", "alpha_y", "gamma_y","disp_y","disp_py",\
+				"mu_z", "beta_z", "alpha_z", "gamma_z","disp_z","disp_pz"), file=fresults)
+			for i in range(len(label_ref)):
+				print('%2f %5s %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f %9.6f' % (coords[0, 4, i], label_ref[i], \
+					mu_y_list[i], beta_y_list[i], alpha_y_list[i], gamma_y_list[i],disp_y_list[i],disp_py_list[i],\
+					mu_z_list[i], beta_z_list[i], alpha_z_list[i], gamma_z_list[i],disp_z_list[i],disp_pz_list[i]), file=fresults)
 	
 	return twiss_profiles
 
@@ -1274,7 +1127,50 @@ def calc_momentum_compaction(phase_slip, gamma_lorentz):
 
 	return momentum_compaction, gamma_transition
 
-def fourier_tune(line, initial_YTZP, D_in, npass, plot_fourier=False, coords=None):
+def refined_tune(coords, window=True, iterations=40):
+	"""Find the tune from turn by turn coordinates, to much better than the 1/N resolution of an FFT of N turns. Starting from the FFT peak, the amplitude of the Fourier transform is maximised with a golden section search, as in NAFF. With the Hann window (window=True) a few hundred turns give the tune to better than 1e-6.
+
+	coords: the coordinate (eg Y) on each turn. A 2D array gives the tune of each row, so many particles can be done at once.
+
+	Returns the tune, between 0 and 0.5, as a float, or an array with one value per row.
+	"""
+	coords = numpy.asarray(coords, dtype=float)
+	single = coords.ndim == 1
+	signal = numpy.atleast_2d(coords)
+	n_turns = signal.shape[-1]
+	turns = numpy.arange(n_turns)
+	signal = signal - signal.mean(axis=-1)[:, numpy.newaxis]
+	if window:
+		signal = signal * (1 - numpy.cos(2*pi*turns/n_turns))
+
+	# the FFT peak, ignoring the DC bin
+	peak = numpy.abs(numpy.fft.rfft(signal, axis=-1))[:, 1:].argmax(axis=-1) + 1
+
+	def amplitude(tune):
+		return numpy.abs((signal * numpy.exp(-2j*pi*tune[:, numpy.newaxis]*turns)).sum(axis=-1))
+
+	# the maximum is within a bin of the peak
+	lo = numpy.maximum((peak - 1) / n_turns, 0)
+	hi = numpy.minimum((peak + 1) / n_turns, 0.5)
+	g = (sqrt(5) - 1) / 2
+	a = hi - g*(hi - lo)
+	b = lo + g*(hi - lo)
+	fa = amplitude(a)
+	fb = amplitude(b)
+	for iteration in range(iterations):
+		# keep the side with the larger amplitude, and add one new point in it
+		left = fa > fb
+		hi = numpy.where(left, b, hi)
+		lo = numpy.where(left, lo, a)
+		x = numpy.where(left, hi - g*(hi - lo), lo + g*(hi - lo))
+		fx = amplitude(x)
+		a, b, fa, fb = numpy.where(left, x, b), numpy.where(left, a, x), numpy.where(left, fx, fb), numpy.where(left, fa, fx)
+	tune = (lo + hi) / 2
+	if single:
+		return float(tune[0])
+	return tune
+
+def fourier_tune(line, initial_YTZP, D_in, npass, plot_fourier=False, coords=None, refine=True):
 	"""Calculate tune using FFT. nturns determines the number of passes through the lattice.
        Can supply set of horizontal and vertical coordinates in coords = [ycoords,zcoords], otherwise
          routine will calculate coordinates
@@ -1285,6 +1181,7 @@ def fourier_tune(line, initial_YTZP, D_in, npass, plot_fourier=False, coords=Non
 		D_in: relative momentum of tracked particle.
 
 		coords: If supplied, no tracking needed. Simply take FFT of coords.
+		refine: find the tune with refined_tune(), rather than taking the FFT bin with the largest peak, which is only accurate to 1/npass.
 
        Set plot_fourier= True to show Fourier spectrum. Default is False
 	"""
@@ -1329,34 +1226,21 @@ def fourier_tune(line, initial_YTZP, D_in, npass, plot_fourier=False, coords=Non
 		ycoords = coords[0]
 		zcoords = coords[1]
 
-	#perform FFT
-	import pylab
-	yfft = pylab.fft(ycoords)
-	zfft = pylab.fft(zcoords)
-	#extract amplitudes
-	yampfreq = numpy.abs(yfft)
-	zampfreq = numpy.abs(zfft)
-
-	import operator
-	ysortfreqamp = sorted(enumerate(yampfreq), key=operator.itemgetter(1))
-	ysortfreqamp.reverse()
-	zsortfreqamp = sorted(enumerate(zampfreq), key=operator.itemgetter(1))
-	zsortfreqamp.reverse()
-
-	#drop peak at index 0
-	if ysortfreqamp[0][0] == 0:
-		del ysortfreqamp[0]
-	if zsortfreqamp[0][0] == 0:
-		del zsortfreqamp[0]
-
-	ypeaksloc = sorted([ysortfreqamp[0][0], ysortfreqamp[1][0]])
-	zpeaksloc = sorted([zsortfreqamp[0][0], zsortfreqamp[1][0]])
-
-	yfouriertune = ypeaksloc[0]/len(ycoords)
-	zfouriertune = zpeaksloc[0]/len(zcoords)
+	#perform FFT, and extract amplitudes
+	yampfreq = numpy.abs(numpy.fft.fft(ycoords))
+	zampfreq = numpy.abs(numpy.fft.fft(zcoords))
+
+	if refine:
+		yfouriertune = refined_tune(ycoords)
+		zfouriertune = refined_tune(zcoords)
+	else:
+		#the largest peak below half the sampling frequency, dropping the peak at index 0
+		yfouriertune = (yampfreq[1:len(ycoords)//2+1].argmax() + 1) / len(ycoords)
+		zfouriertune = (zampfreq[1:len(zcoords)//2+1].argmax() + 1) / len(zcoords)
 
 	#plot tunes if desired	
 	if(plot_fourier):
+		import pylab
 		pylab.subplot(211)
 		pylab.plot(yampfreq, 'k-')
 		pylab.ylim((0, max(yampfreq[1:-1])))
@@ -2115,6 +1999,7 @@ def plot_data_xy_multi(data_x_list, data_y_list, filename, labels=None, style=''
 
 def calc_transfer_matrix(start_bunch, end_bunch):
 	"""Track a bunch generated with OBJET5 through a line, and pass the start and end bunch to this function to calculate the twiss matrix. No unit conversion is done, so units match the passed bunch.
+	The particle arrays can also have extra leading dimensions, e.g. shape (n, 11) for n sets of OBJET5 rays, then an array of n matrices is returned.
 	NOT COMPLETE:
 	only use cells in top 4 rows
 	"""
@@ -2129,58 +2014,108 @@ def calc_transfer_matrix(start_bunch, end_bunch):
 
 	co = list(" DYTZPS") # coordinates
 
-	tm = numpy.zeros([6,6])
-	tm[4,4] = 1
-	tm[5,5] = 1
+	tm = numpy.zeros(start.shape[:-1] + (6,6))
+	tm[...,4,4] = 1
+	tm[...,5,5] = 1
 
 	IT1 = 0 # offset of particles A to J
 	I10 = IT1+9
 	I11 = IT1+10
 	# FO(1,I10) => start['D'][I10] 
-	DP = (start['D'][I10] - start['D'][I11] ) / 0.5 /( start['D'][I10] + start['D'][I11])
+	DP = (start['D'][...,I10] - start['D'][...,I11] ) / 0.5 /( start['D'][...,I10] + start['D'][...,I11])
 
 	for j in range(2,6):
-		tm[j-2, 5] = (end[co[j]][I10] - end[co[j]][I11]) / DP
+		tm[...,j-2, 5] = (end[co[j]][...,I10] - end[co[j]][...,I11]) / DP
 		#print co[j], I10, I11, (end[co[j]][I10] - end[co[j]][I11]) / DP
 
 		for i in range(1,5):
 			i2 = 2*i + IT1-1
 			i3 = i2 + 1
-			u0 = start[co[i+1]][i2] - start[co[i+1]][i3]
-			tm[j-2, i-1] = (end[co[j]][i2] - end[co[j]][i3]) / u0
+			u0 = start[co[i+1]][...,i2] - start[co[i+1]][...,i3]
+			tm[...,j-2, i-1] = (end[co[j]][...,i2] - end[co[j]][...,i3]) / u0
 			#print co[j],i2, i3, (end[co[j]][i2] - end[co[j]][i3]) / u0
 			if (j == 5):
-				tm[4,i-1] = (end[co[6]][i2] - end[co[6]][i3]) /u0
+				tm[...,4,i-1] = (end[co[6]][...,i2] - end[co[6]][...,i3]) /u0
 				#print co[6], i2, i3, (end[co[6]][i2] - end[co[6]][i3]) /u0
-	tm[4,5] = (end[co[6]][I10] - end[co[6]][I11] ) /DP
+	tm[...,4,5] = (end[co[6]][...,I10] - end[co[6]][...,I11] ) /DP
 
-	if (tm[0,0] + tm[1,1] > 2) or (tm[2,2] + tm[3,3] > 2):
+	if numpy.any(tm[...,0,0] + tm[...,1,1] > 2) or numpy.any(tm[...,2,2] + tm[...,3,3] > 2):
 		zlog.warning("Lattice is unstable")
 	
 	return tm
 
 
+def calc_phase_ad_from_matrix(trans_matrix):
+	"""Calculate the phase advance (mu_y,mu_z) from a transfer matrix. Either use Results.get_transfer_matrix() or calc_transfer_matrix() to get matrix.
+	The phase advance is in the range 0 to 2 pi, taking the sign of sin(mu) from the matrix, as zgoubi does.
+	Also takes an array of matrices, returning arrays, with nan where the matrix is unstable. For a single unstable matrix ValueError is raised."""
+	tm = numpy.asarray(trans_matrix)
+	mus = []
+	for i in [0, 2]:
+		with numpy.errstate(invalid='ignore'):
+			mu = numpy.arccos(0.5 * (tm[...,i,i]+tm[...,i+1,i+1]))
+		mu = numpy.where(tm[...,i,i+1] < 0, 2*pi - mu, mu)
+		if tm.ndim == 2:
+			if isnan(mu):
+				raise ValueError("Transfer matrix is unstable")
+			mu = float(mu)
+		mus.append(mu)
+	return tuple(mus)
+
 def calc_twiss_from_matrix(trans_matrix):
-	"Calculate the twiss parameters (beta_y, alpha_y, gamma_y, beta_z, alpha_z, gamma_z) from a transfer matrix. Either use Results.get_transfer_matrix() or calc_transfer_matrix() to get matrix."
-	tm = trans_matrix
-
-	mu_y = acos(0.5 * (tm[0,0]+tm[1,1]))
-	beta_y = tm[0,1]/sin(mu_y)
-	alpha_y = (tm[0,0]-cos(mu_y))/sin(mu_y)
-	gamma_y = - tm[1,0]/sin(mu_y)
-
-	mu_z = acos(0.5 * (tm[2,2]+tm[3,3]))
-	beta_z = tm[2,3]/sin(mu_z)
-	alpha_z = (tm[2,2]-cos(mu_z))/sin(mu_z)
-	gamma_z = - tm[3,2]/sin(mu_z)
+	"""Calculate the twiss parameters (beta_y, alpha_y, gamma_y, beta_z, alpha_z, gamma_z) from a transfer matrix. Either use Results.get_transfer_matrix() or calc_transfer_matrix() to get matrix.
+	Also takes an array of matrices, returning arrays, with nan where the matrix is unstable."""
+	tm = numpy.asarray(trans_matrix)
+	mu_y, mu_z = calc_phase_ad_from_matrix(tm)
+
+	beta_y = tm[...,0,1]/numpy.sin(mu_y)
+	alpha_y = (tm[...,0,0]-numpy.cos(mu_y))/numpy.sin(mu_y)
+	gamma_y = - tm[...,1,0]/numpy.sin(mu_y)
+
+	beta_z = tm[...,2,3]/numpy.sin(mu_z)
+	alpha_z = (tm[...,2,2]-numpy.cos(mu_z))/numpy.sin(mu_z)
+	gamma_z = - tm[...,3,2]/numpy.sin(mu_z)
+	if tm.ndim == 2:
+		return tuple(float(x) for x in (beta_y, alpha_y, gamma_y, beta_z, alpha_z, gamma_z))
 	return (beta_y, alpha_y, gamma_y, beta_z, alpha_z, gamma_z)
 
-def calc_phase_ad_from_matrix(trans_matrix):
-	"Calculate the phase advance (mu_y,mu_z) from a transfer matrix. Either use Results.get_transfer_matrix() or calc_transfer_matrix() to get matrix."
-	tm = trans_matrix
-	mu_y = acos(0.5 * (tm[0,0]+tm[1,1]))
-	mu_z = acos(0.5 * (tm[2,2]+tm[3,3]))
-	return (mu_y,mu_z)
+def calc_dispersion_from_matrix(trans_matrix):
+	"""Calculate the periodic dispersion (disp_y, disp_py, disp_z, disp_pz) from a transfer matrix, or an array of matrices.
+	Solves D = M D + M[:,5] in each plane."""
+	tm = numpy.asarray(trans_matrix)
+	disps = []
+	for i in [0, 2]:
+		m = tm[...,i:i+2,i:i+2]
+		a = numpy.eye(2) - m
+		det = a[...,0,0]*a[...,1,1] - a[...,0,1]*a[...,1,0]
+		b0, b1 = tm[...,i,5], tm[...,i+1,5]
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			disps.append((a[...,1,1]*b0 - a[...,0,1]*b1) / det)
+			disps.append((a[...,0,0]*b1 - a[...,1,0]*b0) / det)
+	return tuple(disps)
+
+def propagate_twiss_through_matrix(trans_matrix, twiss):
+	"""Propagate twiss parameters through a transfer matrix, or an array of matrices.
+	twiss is a twiss_param_array() (or a similar array with one row per matrix). Returns a twiss array with one row per matrix.
+	"""
+	tm = numpy.asarray(trans_matrix)
+	twiss = numpy.asarray(twiss)
+	out = numpy.zeros(tm.shape[:-2], dtype=twiss.dtype)
+	if tm.ndim == 2:
+		twiss = twiss.reshape(())
+	for i, p in [(0, "y"), (2, "z")]:
+		c, s = tm[...,i,i], tm[...,i,i+1]
+		cp, sp = tm[...,i+1,i], tm[...,i+1,i+1]
+		beta, alpha, gamma = twiss["beta_"+p], twiss["alpha_"+p], twiss["gamma_"+p]
+		out["beta_"+p] = c*c*beta - 2*c*s*alpha + s*s*gamma
+		out["alpha_"+p] = -c*cp*beta + (c*sp + s*cp)*alpha - s*sp*gamma
+		out["gamma_"+p] = cp*cp*beta - 2*cp*sp*alpha + sp*sp*gamma
+		disp, dispp = twiss["disp_"+p], twiss["disp_p"+p]
+		out["disp_"+p] = c*disp + s*dispp + tm[...,i,5]
+		out["disp_p"+p] = cp*disp + sp*dispp + tm[...,i+1,5]
+	if tm.ndim == 2:
+		out = out.reshape(1)
+	return out
 
 def uniquify_labels(line):
 	"""Returns a new line where every element has a unique label.